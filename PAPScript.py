@@ -23,40 +23,59 @@ For support and documentation:
 """
 
 import os
-import glob
 import time
+import socket
 import datetime
 import logging
+import argparse
 import csv
-import RPi.GPIO as GPIO
-import Adafruit_MCP3008
-import serial
-import pynmea2
-import board
-import busio
-import digitalio
-from threading import Timer
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import deque
 from pathlib import Path
+from adc_sampling import BurstSampler, robust_estimate
+from drivers import create_hardware
+from binstore import make_record, encode_records, recover_binary_file, BinaryStore
+from datastore import encode_csv_rows, recover_csv_file
+from partitions import PartitionedWriter, PartitionSet
+from metrics import registry, SnapshotWriter
+from rollups import RollupStore, rollup_path
+from livering import RingWriter
+from compression import ReadingCompressor
+from calibration import RAW_COLUMNS, VERSION_COLUMN, load_calibration
+from spatial import POSITION_COLUMNS, positions_path, catch_up as catch_up_positions
+from capture import WaveformRecorder, summarize as summarize_capture, append_index, capture_id, VOLTS_PER_COUNT
 
-# Configure logging
-log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f"{log_dir}/piaquapulse.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+def configure_logging(log_dir="logs"):
+    """Log to the console and to logs/piaquapulse.log."""
+    os.makedirs(log_dir, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(f"{log_dir}/piaquapulse.log"),
+            logging.StreamHandler()
+        ]
+    )
+
 # Configuration constants
 CONFIG = {
+    # Hardware backend: 'pi' for the real sensors, 'sim' for simulated ones
+    # (see drivers.py)
+    'HARDWARE_BACKEND': os.environ.get('PIAQUAPULSE_HARDWARE', 'pi'),
     # GPIO Pins
     'BUTTON_PIN': 17,
+    'BUTTON_DEBOUNCE': 0.2,  # Presses closer together than this (seconds) count as one
     'LED_PIN': 27,
     'ONE_WIRE_PIN': 4,  # DS18B20 data pin (BCM)
+    # DS18B20 probes by ROM ID, in column order; the first is the primary
+    # probe written to the Temperature column. Empty = all probes found.
+    'TEMP_PROBE_IDS': [],
+    'W1_BULK_READ': True,  # Convert all probes at once where supported
+    'DS18B20_MAX_RETRIES': 3,  # Extra attempts per probe after a CRC failure
     # MCP3008 Configuration
     'CLK_PIN': 11,
     'MISO_PIN': 9,
@@ -64,182 +83,488 @@ CONFIG = {
     'CS_PIN': 8,
     'PH_CHANNEL': 0,    # pH sensor on MCP3008 channel 0
     'TURBIDITY_CHANNEL': 1,  # Turbidity sensor on MCP3008 channel 1
-    # Sensor calibration values
+    'ADC_BURST_SAMPLES': 200,  # Samples per channel in each burst
+    'ADC_SAMPLE_INTERVAL': 0.0,  # Optional delay (seconds) between sampling rounds
+    'ADC_FILTER': 'mad',  # Noise filter: 'mad', 'trimmed' or 'median'
+    # Adaptive sampling: instead of a fixed burst, sample pH and turbidity
+    # until the standard error of both estimates is within PH_TOLERANCE and
+    # TURBIDITY_TOLERANCE, checking every ADC_BLOCK_SAMPLES rounds after the
+    # first ADC_MIN_SAMPLES, for at most ADC_MAX_SAMPLES rounds or
+    # ADC_MAX_TIME seconds. The achieved standard errors are logged in extra
+    # data file columns.
+    'ADC_ADAPTIVE': False,
+    'ADC_MIN_SAMPLES': 20,
+    'ADC_MAX_SAMPLES': 1000,
+    'ADC_BLOCK_SAMPLES': 10,
+    'ADC_MAX_TIME': 2.0,
+    'PH_TOLERANCE': 0.01,  # pH units
+    'TURBIDITY_TOLERANCE': 1.0,  # NTU
+    # Sensor calibration values. These only seed the first version in
+    # CALIBRATION_FILE; later calibrations are added with calibration.py.
     'PH_4_VOLTAGE': 3.1,  # Voltage at pH 4 (calibration point)
     'PH_7_VOLTAGE': 2.6,  # Voltage at pH 7 (calibration point)
+    'CALIBRATION_FILE': 'calibration.json',
+    # Log the raw ADC counts and voltages of pH and turbidity and the
+    # calibration version with each reading, so history can be recalibrated.
+    # CSV backend only; set to False for the binary backend.
+    'STORE_RAW': True,
     # Serial port for GPS
     'GPS_PORT': '/dev/ttyS0',
     'GPS_BAUD': 9600,
+    'GPS_MAX_FIX_AGE': 5,  # Seconds before a cached fix is considered stale
     # Data storage
     'DATA_FILE': 'river_data.csv',
+    # Storage backend: 'csv' writes DATA_FILE, 'binary' writes BINARY_DATA_FILE
+    # in the fixed-width record format described in binstore.py. Set
+    # PIAQUAPULSE_STORAGE_BACKEND instead so the dashboard reads the same file.
+    'STORAGE_BACKEND': os.environ.get('PIAQUAPULSE_STORAGE_BACKEND', 'csv'),
+    'BINARY_DATA_FILE': 'river_data.bin',
+    # Split the data file into 'daily' or 'monthly' partitions (None = one
+    # file), e.g. river_data-2024-06-01.csv, stored in PARTITION_DIR (None =
+    # next to the data file). Closed partitions are compressed in the
+    # background with PARTITION_COMPRESSION: 'gzip', 'zstd' (needs the
+    # zstandard package) or None. See partitions.py.
+    'PARTITIONING': None,
+    'PARTITION_DIR': None,
+    'PARTITION_COMPRESSION': 'gzip',
+    # Data writer batching: rows are written once WRITE_BATCH_SIZE are queued
+    # or WRITE_FLUSH_INTERVAL seconds after the first queued row
+    'WRITE_BATCH_SIZE': 1,
+    'WRITE_FLUSH_INTERVAL': 0.0,
+    # Durability per batch: 'none', 'flush' or 'fsync' (see datastore.py)
+    'WRITE_DURABILITY': 'flush',
+    # Hourly/daily rollups are updated with every reading and saved next to
+    # the data file at most every ROLLUP_SAVE_INTERVAL seconds (see rollups.py)
+    'ROLLUP_SAVE_INTERVAL': 60,
+    # Readings with a GPS fix are also appended to a positions file next to
+    # the data file, which the dashboard's /spatial map queries use (see spatial.py)
+    'SPATIAL_INDEX': True,
+    # Only store the readings needed to reconstruct each value within its
+    # tolerance: 'deadband' or 'swinging_door' (None = store every reading).
+    # Readings are stored at least every COMPRESSION_MAX_SILENCE seconds.
+    # Secondary DS18B20 probes use the temperature tolerance. See compression.py.
+    # Set PIAQUAPULSE_COMPRESSION instead so the dashboard uses the same method.
+    'COMPRESSION': os.environ.get('PIAQUAPULSE_COMPRESSION') or None,
+    'COMPRESSION_TOLERANCES': {
+        'temperature': 0.05,  # °C
+        'ph': 0.02,
+        'turbidity': 2.0,  # NTU
+    },
+    'COMPRESSION_MAX_SILENCE': 600,
     # Automatic logging (seconds)
     'AUTO_LOG_INTERVAL': 300,  # Log every 5 minutes by default
+    # Continuous mode logs every CONTINUOUS_INTERVAL seconds (sub-second
+    # intervals are allowed), skips the success blink and uses the cached GPS
+    # fix without waiting. CSV timestamps have one second resolution; the
+    # binary backend keeps the exact scheduled time.
+    'CONTINUOUS_MODE': False,
+    'CONTINUOUS_INTERVAL': 1.0,
+    # What to do when a reading overruns the next deadline: 'skip' drops the
+    # missed deadlines, 'catchup' runs them back to back
+    'OVERRUN_POLICY': 'skip',
+    # Acquisition deadlines (seconds) for each concurrently read source.
+    # The GPS deadline is derived from the GPS timeout of each reading.
+    'SENSOR_DEADLINES': {
+        'temperature': 3.0,
+        'analog': 3.0,
+    },
+    # Upload to a collection server with uploader.py (None = no upload).
+    # STATION_ID identifies this Pi to the server.
+    'STATION_ID': socket.gethostname(),
+    'UPLOAD_URL': None,  # e.g. 'http://collector.example.org:5000/ingest'
+    'UPLOAD_TOKEN': None,  # Sent as a Bearer token, if set
+    'UPLOAD_CURSOR_FILE': 'upload_cursor.json',
+    'UPLOAD_POLL_INTERVAL': 30,  # Seconds between checks for new readings
+    # Adaptive batch size (rows): grows by UPLOAD_BATCH_STEP while batches
+    # upload within UPLOAD_TARGET_SECONDS, halves when they are slow or fail
+    'UPLOAD_INITIAL_BATCH': 100,
+    'UPLOAD_BATCH_STEP': 100,
+    'UPLOAD_MAX_BATCH': 5000,
+    'UPLOAD_TARGET_SECONDS': 5.0,
+    # Metrics snapshot served by the dashboard at /metrics (see metrics.py),
+    # written every METRICS_INTERVAL seconds
+    'METRICS_FILE': 'metrics.json',
+    'METRICS_INTERVAL': 15,
+    # Shared memory ring of the last LIVE_RING_SIZE readings, read by the
+    # dashboard without touching the data file (see livering.py; None = off)
+    'LIVE_RING_NAME': 'piaquapulse',
+    'LIVE_RING_SIZE': 1024,
+    # Waveform capture: stream the pH and turbidity channels as fast as the
+    # ADC allows for CAPTURE_DURATION seconds into CAPTURE_DIR (see
+    # capture.py). Started by holding the button for CAPTURE_BUTTON_HOLD
+    # seconds (None = never) or when a value changes by more than its
+    # CAPTURE_THRESHOLDS entry from one reading to the next, at most once
+    # every CAPTURE_COOLDOWN seconds. Other readings wait for the capture.
+    'CAPTURE_DIR': 'captures',
+    'CAPTURE_DURATION': 10.0,
+    'CAPTURE_SEGMENT_ROUNDS': 65536,  # Rounds per buffer and .npy segment
+    'CAPTURE_BUTTON_HOLD': 2.0,
+    'CAPTURE_THRESHOLDS': {},  # e.g. {'turbidity': 100.0, 'ph': 0.5}
+    'CAPTURE_COOLDOWN': 600,
+    # Summary of each capture: power in these frequency bands (Hz) and the
+    # time until the signal stays within CAPTURE_SETTLE_TOLERANCE volts
+    'CAPTURE_BANDS': [[0, 1], [1, 10], [10, 100], [100, 1000]],
+    'CAPTURE_SETTLE_TOLERANCE': 0.01,
 }
 
-# Initialize GPIO
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(CONFIG['BUTTON_PIN'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(CONFIG['LED_PIN'], GPIO.OUT)
-
-# Initialize MCP3008 for analog sensors
-mcp = Adafruit_MCP3008.MCP3008(
-    clk=CONFIG['CLK_PIN'],
-    cs=CONFIG['CS_PIN'],
-    miso=CONFIG['MISO_PIN'],
-    mosi=CONFIG['MOSI_PIN']
-)
-
-# Initialize 1-Wire interface for DS18B20
-os.system('modprobe w1-gpio')
-os.system('modprobe w1-therm')
-base_dir = '/sys/bus/w1/devices/'
-# Find the device file that corresponds to the temperature sensor
-temp_sensor_folder = None
+# Hardware backend, created on first use so that importing this module
+# does not touch any hardware
+hardware = None
+hardware_lock = threading.Lock()
+
+def get_hardware():
+    """Get the configured hardware backend, creating it if needed."""
+    global hardware
+    with hardware_lock:
+        if hardware is None:
+            hardware = create_hardware(CONFIG['HARDWARE_BACKEND'], CONFIG)
+            logger.info(f"Using '{hardware.name}' hardware backend")
+        return hardware
+
+def set_led(on):
+    """Turn the status LED on or off."""
+    gpio = get_hardware().gpio
+    gpio.output(CONFIG['LED_PIN'], gpio.HIGH if on else gpio.LOW)
+
+# The MCP3008 is bit-banged over GPIO, so only one thread may talk to it at a time
+adc_lock = threading.Lock()
+
+# Held for the duration of a reading, so that readings never overlap
+reading_lock = threading.Lock()
+
+# Metrics (see metrics.py). Gauges and driver counters are read from their
+# owners only when a snapshot is written.
+def stage_histogram(stage):
+    """Duration histogram of one stage of a reading."""
+    return registry.histogram('piaquapulse_stage_duration_seconds',
+                              "Time spent in each stage of a reading", stage=stage)
+
+def sensor_error_counter(sensor):
+    """Count of readings in which a sensor returned no value."""
+    return registry.counter('piaquapulse_sensor_errors_total',
+                            "Readings in which a sensor returned no value", sensor=sensor)
+
+readings_counter = {
+    trigger: registry.counter('piaquapulse_readings_total', "Readings taken", trigger=trigger)
+    for trigger in ('auto', 'manual')
+}
+gps_timeout_counter = registry.counter('piaquapulse_gps_timeouts_total',
+                                       "GPS waits that ended without a fix")
+coalesced_press_counter = registry.counter('piaquapulse_coalesced_presses_total',
+                                          "Button presses served by a reading already running or queued")
+capture_counter = registry.counter('piaquapulse_waveform_captures_total',
+                                   "Waveform captures recorded")
+missed_deadline_counter = registry.counter('piaquapulse_missed_deadlines_total',
+                                           "Sources that missed their acquisition deadline")
+scheduler_lateness = registry.histogram('piaquapulse_scheduler_lateness_seconds',
+                                        "How late automatic readings started",
+                                        buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+adc_rounds_histogram = registry.histogram('piaquapulse_adc_sampling_rounds',
+                                          "ADC sampling rounds taken by adaptive sampling",
+                                          buckets=(20, 50, 100, 200, 500, 1000, 2000))
+metrics_writer = None
+
+def get_metrics_writer():
+    """Get the metrics snapshot writer, creating it on first use."""
+    global metrics_writer
+    if metrics_writer is None:
+        metrics_writer = SnapshotWriter(registry, CONFIG['METRICS_FILE'],
+                                        interval=CONFIG['METRICS_INTERVAL'])
+    return metrics_writer
+
+# DS18B20 probes on the 1-Wire bus (created on first use) and the ROM IDs in use
+temp_bus = None
+temp_probe_ids = []
+
+def get_temp_bus():
+    """Get the DS18B20 bus, creating it if needed."""
+    global temp_bus
+    if temp_bus is None:
+        temp_bus = get_hardware().create_temp_bus(
+            max_retries=CONFIG['DS18B20_MAX_RETRIES'],
+            use_bulk_read=CONFIG['W1_BULK_READ']
+        )
+    return temp_bus
 
 def initialize_temp_sensor():
-    """Initialize and find the DS18B20 temperature sensor."""
-    global temp_sensor_folder
+    """Initialize and find the DS18B20 temperature probes."""
+    global temp_probe_ids
     try:
-        device_folders = glob.glob(base_dir + '28*')
-        if device_folders:
-            temp_sensor_folder = device_folders[0]
-            logger.info(f"DS18B20 sensor found at: {temp_sensor_folder}")
-            return True
+        found = get_temp_bus().discover()
+        if CONFIG['TEMP_PROBE_IDS']:
+            missing = [rom_id for rom_id in CONFIG['TEMP_PROBE_IDS'] if rom_id not in found]
+            if missing:
+                logger.warning(f"Configured DS18B20 probes not found: {', '.join(missing)}")
+            temp_probe_ids = list(CONFIG['TEMP_PROBE_IDS'])
         else:
-            logger.error("DS18B20 sensor not found. Check connections.")
-            return False
+            temp_probe_ids = list(found)
+        return bool(found)
     except Exception as e:
         logger.error(f"Error initializing DS18B20 sensor: {e}")
         return False
 
-def read_ds18b20():
+def read_temperature_probes():
     """
-    Read temperature from DS18B20 sensor.
+    Read all DS18B20 probes in one pass.
     
     Returns:
-        float: Temperature in Celsius, or None if error
+        dict: ROM ID -> temperature in Celsius (None for failed probes),
+        in probe order
     """
-    global temp_sensor_folder
-    
-    if not temp_sensor_folder:
+    if not temp_probe_ids:
         if not initialize_temp_sensor():
-            return None
-            
+            return {}
     try:
-        device_file = temp_sensor_folder + '/w1_slave'
-        with open(device_file, 'r') as f:
-            lines = f.readlines()
-            
-        # Check if CRC is valid (YES at the end of first line)
-        if lines[0].strip()[-3:] != 'YES':
-            logger.warning("DS18B20 CRC check failed, retrying...")
-            time.sleep(0.2)
-            return read_ds18b20()
-            
-        # Extract temperature from second line
-        equals_pos = lines[1].find('t=')
-        if equals_pos != -1:
-            temp_string = lines[1][equals_pos+2:]
-            temp_c = float(temp_string) / 1000.0
-            logger.debug(f"Raw temperature reading: {temp_c}°C")
-            
-            # Basic validation
-            if -55.0 <= temp_c <= 125.0:  # DS18B20 operating range
-                return round(temp_c, 2)
-            else:
-                logger.warning(f"DS18B20 reading out of range: {temp_c}°C")
-                return None
+        readings = get_temp_bus().read_all()
+        return {rom_id: readings.get(rom_id) for rom_id in temp_probe_ids}
     except Exception as e:
         logger.error(f"Error reading DS18B20 temperature: {e}")
+        return {}
+
+def adc_to_voltage(reading):
+    """Convert a raw MCP3008 reading (0-1023) to volts (0-3.3V)."""
+    return (reading * 3.3) / 1023.0
+
+# Current calibration version, loaded on first use (see calibration.py)
+calibration = None
+
+def get_calibration():
+    """Get the current calibration, creating the calibration file if needed."""
+    global calibration
+    if calibration is None:
+        calibration = load_calibration(CONFIG['CALIBRATION_FILE'],
+                                       CONFIG['PH_4_VOLTAGE'], CONFIG['PH_7_VOLTAGE'])
+        logger.info(f"Using calibration version {calibration.version}")
+    return calibration
+
+def ph_curve(voltage):
+    """pH for a sensor voltage, unrounded and unchecked."""
+    # pH 4 and pH 7 calibration points create a linear relationship
+    return float(get_calibration().ph(voltage))
+
+def ph_from_voltage(voltage):
+    """
+    Convert pH sensor voltage to a pH value.
+
+    Args:
+        voltage: Sensor output voltage
+
+    Returns:
+        float: pH value (0-14 scale), or None if out of range
+    """
+    ph_value = ph_curve(voltage)
+
+    # Basic validation
+    if 0.0 <= ph_value <= 14.0:
+        return round(ph_value, 2)
+    else:
+        logger.warning(f"pH reading out of range: {ph_value}")
         return None
 
-def read_ph_sensor():
+def turbidity_curve(voltage):
+    """Turbidity in NTU for a sensor voltage, unrounded and unchecked."""
+    # Polynomial in volts, linear until the sensor is calibrated; voltage
+    # decreases as turbidity increases, 0 NTU above the clear-water voltage
+    return float(get_calibration().turbidity(voltage))
+
+def ntu_from_voltage(voltage):
     """
-    Read pH value from analog pH sensor via MCP3008.
-    
+    Convert turbidity sensor voltage to NTU.
+
+    Args:
+        voltage: Sensor output voltage
+
     Returns:
-        float: pH value (0-14 scale), or None if error
+        float: Turbidity in NTU, or None if out of range
     """
-    try:
-        # Get average reading to reduce noise
-        readings = []
-        for _ in range(10):
-            reading = mcp.read_adc(CONFIG['PH_CHANNEL'])
-            readings.append(reading)
-            time.sleep(0.1)
-            
-        # Remove highest and lowest readings and average the rest
-        readings.remove(max(readings))
-        readings.remove(min(readings))
-        avg_reading = sum(readings) / len(readings)
-        
-        # Convert to voltage (0-1023 -> 0-3.3V)
-        voltage = (avg_reading * 3.3) / 1023.0
-        logger.debug(f"pH sensor voltage: {voltage}V")
-        
-        # Convert voltage to pH using calibration values
-        # pH 4 and pH 7 calibration points create a linear relationship
-        slope = (7.0 - 4.0) / (CONFIG['PH_7_VOLTAGE'] - CONFIG['PH_4_VOLTAGE'])
-        ph_value = 7.0 + slope * (CONFIG['PH_7_VOLTAGE'] - voltage)
-        
-        # Basic validation
-        if 0.0 <= ph_value <= 14.0:
-            return round(ph_value, 2)
-        else:
-            logger.warning(f"pH reading out of range: {ph_value}")
-            return None
-    except Exception as e:
-        logger.error(f"Error reading pH sensor: {e}")
+    ntu = turbidity_curve(voltage)
+
+    # Basic validation (SEN0189 range is typically 0-3000 NTU)
+    if 0 <= ntu <= 3000:
+        return round(ntu, 2)
+    else:
+        logger.warning(f"Turbidity reading out of range: {ntu} NTU")
         return None
 
-def read_turbidity_sensor():
+# Burst samplers, created on first use and keyed by their channel list
+adc_samplers = {}
+
+def read_adc_channels(channels):
     """
-    Read turbidity value from SEN0189 sensor via MCP3008.
-    
+    Take one burst of interleaved samples from several MCP3008 channels.
+
+    Args:
+        channels: Tuple of MCP3008 channel numbers
+
+    Returns:
+        list: Filtered raw reading for each channel, in the same order
+    """
+    return robust_estimate(get_adc_sampler(channels).sample(), CONFIG['ADC_FILTER']).tolist()
+
+def get_adc_sampler(channels):
+    """Burst sampler for a tuple of channels, sized for the sampling mode."""
+    sampler = adc_samplers.get(channels)
+    if sampler is None:
+        samples = CONFIG['ADC_MAX_SAMPLES'] if CONFIG['ADC_ADAPTIVE'] else CONFIG['ADC_BURST_SAMPLES']
+        sampler = adc_samplers[channels] = BurstSampler(
+            get_hardware().adc, channels,
+            samples=samples,
+            interval=CONFIG['ADC_SAMPLE_INTERVAL'],
+            lock=adc_lock
+        )
+    return sampler
+
+def propagate_error(curve, reading, error):
+    """
+    Standard error of a sensor value from the standard error of its raw
+    reading, using the slope of the conversion curve across +/- one error.
+    """
+    step = max(error, 0.5)
+    low = curve(adc_to_voltage(reading - step))
+    high = curve(adc_to_voltage(reading + step))
+    return abs(high - low) / (2 * step) * error
+
+def read_adc_channels_adaptive(channels, tolerances, curves):
+    """
+    Sample several MCP3008 channels until each estimate is within tolerance.
+
+    Args:
+        channels: Tuple of MCP3008 channel numbers
+        tolerances: Acceptable standard error of each sensor value
+        curves: Function converting volts to the sensor value, per channel
+
     Returns:
-        float: Turbidity in NTU (Nephelometric Turbidity Units), or None if error
+        tuple: (filtered raw readings, standard errors in sensor units)
+    """
+    propagate = [lambda reading, error, curve=curve: propagate_error(curve, reading, error)
+                 for curve in curves]
+    estimates, errors, count = get_adc_sampler(channels).sample_adaptive(
+        tolerances,
+        method=CONFIG['ADC_FILTER'],
+        min_samples=CONFIG['ADC_MIN_SAMPLES'],
+        block=CONFIG['ADC_BLOCK_SAMPLES'],
+        max_time=CONFIG['ADC_MAX_TIME'],
+        propagate=propagate
+    )
+    adc_rounds_histogram.observe(count)
+    logger.debug(f"Adaptive sampling took {count} rounds, standard errors {errors.tolist()}")
+    return estimates.tolist(), errors.tolist()
+
+def read_analog_sensors(with_details=False):
     """
+    Read pH and turbidity together in a single interleaved sampling pass.
+
+    Both sensors share the MCP3008, so they are sampled in one burst, of
+    fixed size or, with ADC_ADAPTIVE, until both values are precise enough.
+
+    Args:
+        with_details: Also return the raw readings and standard errors
+
+    Returns:
+        tuple: (pH value, turbidity in NTU), either of which may be None,
+        followed with with_details by a dict with 'raw', the filtered ADC
+        counts, and 'errors', the standard errors (None unless sampling was
+        adaptive), each by sensor ('ph', 'turbidity')
+    """
+    channels = (CONFIG['PH_CHANNEL'], CONFIG['TURBIDITY_CHANNEL'])
+    errors = {'ph': None, 'turbidity': None}
+    details = {'raw': {'ph': None, 'turbidity': None}, 'errors': errors}
     try:
-        # Get average reading to reduce noise
-        readings = []
-        for _ in range(10):
-            reading = mcp.read_adc(CONFIG['TURBIDITY_CHANNEL'])
-            readings.append(reading)
-            time.sleep(0.1)
-            
-        # Remove highest and lowest readings and average the rest
-        readings.remove(max(readings))
-        readings.remove(min(readings))
-        avg_reading = sum(readings) / len(readings)
-        
-        # Convert to voltage (0-1023 -> 0-3.3V)
-        voltage = (avg_reading * 3.3) / 1023.0
-        logger.debug(f"Turbidity sensor voltage: {voltage}V")
-        
-        # Convert voltage to NTU based on SEN0189 datasheet
-        # Typically: voltage decreases as turbidity increases
-        # This is an approximation and should be calibrated for your specific sensor
-        if voltage > 2.5:
-            ntu = 0  # Clear water
-        else:
-            # Polynomial approximation based on typical calibration curve
-            # NTU = -1120.4*voltage*voltage + 5742.3*voltage - 4352.9
-            # Simplified linear approximation:
-            ntu = 3000 * (1 - voltage / 2.5)
-            
-        # Basic validation (SEN0189 range is typically 0-3000 NTU)
-        if 0 <= ntu <= 3000:
-            return round(ntu, 2)
+        if CONFIG['ADC_ADAPTIVE']:
+            (ph_reading, turbidity_reading), (errors['ph'], errors['turbidity']) = \
+                read_adc_channels_adaptive(
+                    channels,
+                    (CONFIG['PH_TOLERANCE'], CONFIG['TURBIDITY_TOLERANCE']),
+                    (ph_curve, turbidity_curve))
         else:
-            logger.warning(f"Turbidity reading out of range: {ntu} NTU")
-            return None
+            ph_reading, turbidity_reading = read_adc_channels(channels)
+    except Exception as e:
+        logger.error(f"Error reading analog sensors: {e}")
+        return (None, None, details) if with_details else (None, None)
+
+    details['raw'] = {'ph': ph_reading, 'turbidity': turbidity_reading}
+    ph = turbidity = None
+    try:
+        voltage = adc_to_voltage(ph_reading)
+        logger.debug(f"pH sensor voltage: {voltage}V")
+        ph = ph_from_voltage(voltage)
+    except Exception as e:
+        logger.error(f"Error reading pH sensor: {e}")
+    try:
+        voltage = adc_to_voltage(turbidity_reading)
+        logger.debug(f"Turbidity sensor voltage: {voltage}V")
+        turbidity = ntu_from_voltage(voltage)
     except Exception as e:
         logger.error(f"Error reading turbidity sensor: {e}")
-        return None
+    if with_details:
+        return ph, turbidity, details
+    return ph, turbidity
+
+# Waveform recorder for the analog channels, created on first capture
+waveform_recorder = None
+
+def capture_waveform(when):
+    """
+    Record and summarize a waveform capture of the pH and turbidity channels.
+
+    Args:
+        when: Epoch seconds of the reading the capture is logged as
+
+    Returns:
+        tuple: (pH, turbidity, details) as from read_analog_sensors(), with
+        the values converted from the median of each channel and the
+        capture's name in details['capture']
+    """
+    global waveform_recorder
+    channels = (CONFIG['PH_CHANNEL'], CONFIG['TURBIDITY_CHANNEL'])
+    if waveform_recorder is None:
+        waveform_recorder = WaveformRecorder(get_hardware().adc, channels,
+                                             segment_rounds=CONFIG['CAPTURE_SEGMENT_ROUNDS'],
+                                             lock=adc_lock)
+    name = capture_id(when)
+    directory = os.path.join(CONFIG['CAPTURE_DIR'], name)
+    suffix = 1
+    while os.path.exists(directory):
+        suffix += 1
+        directory = os.path.join(CONFIG['CAPTURE_DIR'], f"{name}-{suffix}")
+    logger.info(f"Recording a {CONFIG['CAPTURE_DURATION']}s waveform capture to {directory}")
+    metadata = waveform_recorder.record(CONFIG['CAPTURE_DURATION'], directory)
+    capture_counter.inc()
+    logger.info(f"Captured {metadata['rounds']} rounds at {metadata['rate']:.0f} Hz")
+    metadata = summarize_capture(directory, [tuple(band) for band in CONFIG['CAPTURE_BANDS']],
+                                 CONFIG['CAPTURE_SETTLE_TOLERANCE'])
+    append_index(CONFIG['CAPTURE_DIR'], metadata,
+                 datetime.datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S"))
+
+    details = {'raw': {'ph': None, 'turbidity': None}, 'errors': {}, 'capture': metadata['id']}
+    values = {}
+    for sensor, channel, convert in (('ph', CONFIG['PH_CHANNEL'], ph_from_voltage),
+                                     ('turbidity', CONFIG['TURBIDITY_CHANNEL'], ntu_from_voltage)):
+        summary = metadata['summary'].get(str(channel))
+        values[sensor] = None
+        if summary is not None:
+            details['raw'][sensor] = summary['median'] / VOLTS_PER_COUNT
+            values[sensor] = convert(summary['median'])
+    return values['ph'], values['turbidity'], details
+
+# Background NMEA reader, started on first use
+gps_service = None
+
+def start_gps_service():
+    """Start the background GPS reader if it is not already running."""
+    global gps_service
+    if gps_service is None or not gps_service.running:
+        gps_service = get_hardware().create_gps_service()
+        gps_service.start()
+    return gps_service
 
 def get_gps_data(timeout=10):
     """
-    Get GPS coordinates from NEO-6M GPS module.
+    Get GPS coordinates from the background GPS service.
+
+    Returns the cached fix immediately when it is fresh, otherwise waits up
+    to timeout seconds for the service to receive one. No serial I/O is done
+    here.
     
     Args:
         timeout: Time in seconds to wait for a GPS fix
@@ -248,84 +573,418 @@ def get_gps_data(timeout=10):
         str: Comma-separated latitude,longitude, or None if error/timeout
     """
     try:
-        # Open serial port
-        with serial.Serial(CONFIG['GPS_PORT'], baudrate=CONFIG['GPS_BAUD'], timeout=1) as ser:
-            start_time = time.time()
-            
-            # Try to get a valid GPS reading within timeout period
-            while (time.time() - start_time) < timeout:
-                line = ser.readline().decode('ascii', errors='replace').strip()
-                
-                # Look for GPRMC or GNRMC sentences which contain location data
-                if line.startswith('$GPRMC') or line.startswith('$GNRMC'):
-                    try:
-                        msg = pynmea2.parse(line)
-                        if msg.status == 'A':  # A=Active (valid), V=Void (invalid)
-                            # Format coordinates as decimal degrees
-                            lat = float(msg.latitude)
-                            lon = float(msg.longitude)
-                            logger.debug(f"GPS fix obtained: {lat}, {lon}")
-                            return f"{lat:.6f},{lon:.6f}"
-                    except Exception as e:
-                        logger.debug(f"Error parsing NMEA sentence: {e}")
-                
-                # Brief pause to reduce CPU usage
-                time.sleep(0.1)
-                
+        service = start_gps_service()
+        fix = service.wait_for_fix(timeout, max_age=CONFIG['GPS_MAX_FIX_AGE'])
+        if fix is None:
+            gps_timeout_counter.inc()
             logger.warning(f"GPS timeout after {timeout} seconds, no valid fix")
             return None
+        logger.debug(f"GPS fix: {fix!r}")
+        return str(fix)
     except Exception as e:
         logger.error(f"Error reading GPS module: {e}")
         return None
 
+class AcquisitionEngine:
+    """
+    Read independent sensor sources concurrently and merge the results.
+
+    Each source runs on its own worker thread and is given its own deadline,
+    so a cycle takes as long as the slowest source rather than the sum of
+    all of them. A source that misses its deadline is reported as None; if
+    it is still running when the next cycle starts it is not resubmitted.
+    """
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="acquire")
+        self.pending = {}
+
+    def acquire(self, sources, deadlines):
+        """
+        Run all sources in parallel and wait for each up to its deadline.
+
+        Args:
+            sources: Dict mapping source name to a zero-argument callable
+            deadlines: Dict mapping source name to a deadline in seconds,
+                measured from the start of the cycle
+
+        Returns:
+            dict: Source name -> result, or None if the source failed or was late
+        """
+        start = time.monotonic()
+        futures = {}
+        results = {}
+        for name, func in sources.items():
+            previous = self.pending.get(name)
+            if previous is not None and not previous.done():
+                logger.warning(f"Source '{name}' still busy from previous cycle, skipping")
+                results[name] = None
+                continue
+            futures[name] = self.pending[name] = self.executor.submit(
+                self._timed, stage_histogram(name), func)
+
+        # Collect in deadline order so each wait is bounded by its own deadline
+        for name in sorted(futures, key=lambda n: deadlines[n]):
+            remaining = start + deadlines[name] - time.monotonic()
+            try:
+                results[name] = futures[name].result(timeout=max(remaining, 0))
+            except FutureTimeoutError:
+                logger.warning(f"Source '{name}' missed its {deadlines[name]}s deadline")
+                missed_deadline_counter.inc()
+                results[name] = None
+            except Exception as e:
+                logger.error(f"Error reading source '{name}': {e}")
+                results[name] = None
+
+        logger.debug(f"Acquisition cycle took {time.monotonic() - start:.3f}s")
+        return results
+
+    @staticmethod
+    def _timed(histogram, func):
+        """Run a source, recording its duration even if it finishes late."""
+        with histogram.time():
+            return func()
+
+    def shutdown(self):
+        """Stop accepting work and release the worker threads."""
+        self.executor.shutdown(wait=False)
+
+acquisition_engine = AcquisitionEngine()
+
+# Column names of the CSV data file
+DATA_FILE_HEADER = [
+    'Timestamp', 
+    'Temperature (°C)', 
+    'pH', 
+    'Turbidity (NTU)', 
+    'GPS Location',
+    'Notes'
+]
+
+def probe_column(rom_id):
+    """CSV column name for a secondary DS18B20 probe."""
+    return f"Temperature {rom_id} (°C)"
+
+# Columns for the standard errors of adaptively sampled values
+ERROR_COLUMNS = {
+    'ph': 'pH Std Error',
+    'turbidity': 'Turbidity Std Error (NTU)',
+}
+
+def data_file_header():
+    """
+    Column names for a new data file: the standard columns followed by the
+    standard error columns when sampling is adaptive, the raw value columns
+    when they are stored, the numeric latitude and longitude and one column
+    for each DS18B20 probe after the primary one.
+    """
+    errors = list(ERROR_COLUMNS.values()) if CONFIG['ADC_ADAPTIVE'] else []
+    raw = raw_columns() if CONFIG['STORE_RAW'] else []
+    return (DATA_FILE_HEADER + errors + raw + list(POSITION_COLUMNS)
+            + [probe_column(rom_id) for rom_id in temp_probe_ids[1:]])
+
+def raw_columns():
+    """Columns of the raw analog values and calibration version."""
+    return [name for names in RAW_COLUMNS.values() for name in names] + [VERSION_COLUMN]
+
+def read_data_file_header(path):
+    """Column names of an existing data file, or None if it is missing or empty."""
+    try:
+        with open(path, 'r', newline='') as f:
+            return next(csv.reader(f), None)
+    except FileNotFoundError:
+        return None
+
 def ensure_data_file_exists():
     """Ensure that the data file exists with proper headers."""
+    if CONFIG['STORAGE_BACKEND'] == 'binary' or CONFIG['PARTITIONING']:
+        return True  # The data writer creates the file with its header
     file_exists = os.path.isfile(CONFIG['DATA_FILE'])
     if not file_exists:
         try:
             logger.info(f"Creating new data file: {CONFIG['DATA_FILE']}")
             with open(CONFIG['DATA_FILE'], 'w', newline='') as f:
                 writer = csv.writer(f)
-                writer.writerow([
-                    'Timestamp', 
-                    'Temperature (°C)', 
-                    'pH', 
-                    'Turbidity (NTU)', 
-                    'GPS Location',
-                    'Notes'
-                ])
+                writer.writerow(data_file_header())
             return True
         except Exception as e:
             logger.error(f"Error creating data file: {e}")
             return False
     return True
 
-def log_reading(manual=False):
+# Owner of the open data file, created on first use
+data_writer = None
+data_writer_lock = threading.Lock()
+# Columns of the CSV data file being written
+data_file_columns = DATA_FILE_HEADER
+
+def data_file_path():
+    """Data file of the configured storage backend."""
+    if CONFIG['STORAGE_BACKEND'] == 'binary':
+        return CONFIG['BINARY_DATA_FILE']
+    return CONFIG['DATA_FILE']
+
+def check_storage_config():
+    """
+    Check that the storage settings can be honoured.
+
+    Raises:
+        ValueError: If the configured backend can't store what is asked of it
+    """
+    if CONFIG['STORAGE_BACKEND'] not in ('csv', 'binary'):
+        raise ValueError(f"Unknown storage backend '{CONFIG['STORAGE_BACKEND']}', expected 'csv' or 'binary'")
+    if CONFIG['STORAGE_BACKEND'] == 'binary' and CONFIG['STORE_RAW']:
+        raise ValueError("The binary storage backend has no room for raw values and calibration "
+                         "versions; set STORE_RAW to False or use the CSV backend")
+
+def get_data_writer():
+    """Create the data writer for the configured storage backend if needed."""
+    global data_writer, data_file_columns
+    with data_writer_lock:
+        if data_writer is None:
+            check_storage_config()
+            if CONFIG['STORAGE_BACKEND'] == 'binary':
+                encode, recover = encode_records, recover_binary_file
+            else:
+                encode = encode_csv_rows
+                recover = lambda f: recover_csv_file(f, data_file_columns)
+            data_writer = PartitionedWriter(
+                data_file_path(), encode, recover,
+                partitioning=CONFIG['PARTITIONING'],
+                directory=CONFIG['PARTITION_DIR'],
+                compression=CONFIG['PARTITION_COMPRESSION'],
+                batch_size=CONFIG['WRITE_BATCH_SIZE'],
+                flush_interval=CONFIG['WRITE_FLUSH_INTERVAL'],
+                durability=CONFIG['WRITE_DURABILITY']
+            )
+            if CONFIG['STORAGE_BACKEND'] != 'binary':
+                # Keep writing the columns of an existing file
+                _, path = data_writer.path_for(time.time())
+                data_file_columns = read_data_file_header(path) or data_file_header()
+                missing = [rom_id for rom_id in temp_probe_ids[1:]
+                           if probe_column(rom_id) not in data_file_columns]
+                if missing:
+                    logger.warning(f"{path} has no column for DS18B20 probes "
+                                   f"{', '.join(missing)}; start a new data file to log them")
+                if CONFIG['ADC_ADAPTIVE'] and not set(ERROR_COLUMNS.values()) <= set(data_file_columns):
+                    logger.warning(f"{path} has no standard error columns; "
+                                   f"start a new data file to log them")
+                if CONFIG['STORE_RAW'] and not set(raw_columns()) <= set(data_file_columns):
+                    logger.warning(f"{path} has no raw value columns; "
+                                   f"start a new data file to log them")
+        return data_writer
+
+# Hourly and daily rollups of the data file, loaded on first use
+rollup_store = None
+
+def get_rollups():
+    """Load the rollups and add readings they are missing, if not done yet."""
+    global rollup_store
+    with data_writer_lock:
+        if rollup_store is None:
+            path = data_file_path()
+            rollup_store = RollupStore(rollup_path(path))
+            rollup_store.load()
+            try:
+                rollup_store.catch_up(PartitionSet(path, CONFIG['PARTITION_DIR']))
+            except Exception as e:
+                logger.error(f"Error bringing rollups up to date with {path}: {e}")
+        return rollup_store
+
+# Positions file of the readings with a GPS fix, opened on first use
+positions_store = None
+
+def get_positions_store():
+    """Open the positions file and add readings it is missing, if not done yet."""
+    global positions_store
+    with data_writer_lock:
+        if positions_store is None and CONFIG['SPATIAL_INDEX']:
+            path = data_file_path()
+            positions_store = BinaryStore(positions_path(path))
+            try:
+                catch_up_positions(positions_store.path, PartitionSet(path, CONFIG['PARTITION_DIR']))
+            except Exception as e:
+                logger.error(f"Error bringing {positions_store.path} up to date with {path}: {e}")
+        return positions_store
+
+# Shared memory ring of recent readings, created on first use
+live_ring = None
+
+def publish_live(record):
+    """Publish a reading to the dashboard's shared memory ring, if enabled."""
+    global live_ring
+    if not CONFIG['LIVE_RING_NAME'] or not CONFIG['LIVE_RING_SIZE']:
+        return
+    try:
+        if live_ring is None:
+            live_ring = RingWriter(CONFIG['LIVE_RING_NAME'], CONFIG['LIVE_RING_SIZE'])
+        live_ring.publish(record)
+    except Exception as e:
+        logger.error(f"Error publishing reading to shared memory: {e}")
+
+# Drops readings that can be reconstructed from the stored ones, if enabled
+compressor = None
+
+def get_compressor():
+    """Create the reading compressor if compression is enabled."""
+    global compressor
+    if compressor is None and CONFIG['COMPRESSION']:
+        tolerances = CONFIG['COMPRESSION_TOLERANCES']
+        compressor = ReadingCompressor(
+            CONFIG['COMPRESSION'], tolerances,
+            max_silence=CONFIG['COMPRESSION_MAX_SILENCE'],
+            default_tolerance=tolerances.get('temperature')
+        )
+    return compressor
+
+def compressed_values(reading):
+    """Values of a reading that the compressor keeps within tolerance."""
+    values = {
+        'temperature': reading['temperature'],
+        'ph': reading['ph'],
+        'turbidity': reading['turbidity'],
+    }
+    values.update((probe_column(rom_id), value) for rom_id, value in list(reading['probes'].items())[1:])
+    return values
+
+def store_reading(reading):
+    """
+    Queue a reading for the data writer of the configured storage backend,
+    unless compression leaves it out.
+
+    Args:
+        reading: Reading dictionary as built by log_reading()
+    """
+    # Loaded before the first write so that catching up cannot count this reading twice
+    rollups = get_rollups()
+    get_positions_store()
+    record = reading_record(reading)
+    compressor = get_compressor()
+    if compressor is None:
+        write_reading(reading, record)
+    else:
+        for stored in compressor.add(reading['time'], compressed_values(reading),
+                                     reading['notes'], reading):
+            write_reading(stored, record if stored is reading else None)
+    publish_live(record)
+    rollups.save_if_due(CONFIG['ROLLUP_SAVE_INTERVAL'])
+
+def reading_record(reading):
+    """Binary store record of a reading."""
+    return make_record(
+        reading['time'],
+        reading['temperature'],
+        reading['ph'],
+        reading['turbidity'],
+        reading['gps'],
+        manual=reading['manual']
+    )
+
+def write_reading(reading, record=None):
+    """
+    Queue a reading for the data writer of the configured storage backend,
+    and add it to the rollups and, if it has a GPS fix, the positions file.
+    Only stored readings are added, so the rollups match a rebuild from the
+    data file when compression leaves readings out.
+    """
+    writer = get_data_writer()
+    if record is None:
+        record = reading_record(reading)
+    if rollup_store is not None:
+        rollup_store.update(reading['time'], {
+            'temperature': reading['temperature'],
+            'ph': reading['ph'],
+            'turbidity': reading['turbidity'],
+        })
+    if positions_store is not None and reading['gps'] is not None:
+        try:
+            positions_store.append(record)
+        except Exception as e:
+            logger.error(f"Error writing to {positions_store.path}: {e}")
+    if CONFIG['STORAGE_BACKEND'] == 'binary':
+        writer.write(record, reading['time'])
+    else:
+        row = [
+            reading['timestamp'],
+            reading['temperature'] if reading['temperature'] is not None else "ERROR",
+            reading['ph'] if reading['ph'] is not None else "ERROR",
+            reading['turbidity'] if reading['turbidity'] is not None else "ERROR",
+            reading['gps'] if reading['gps'] is not None else "NO FIX",
+            reading['notes']
+        ]
+        # Extra columns, matched by name so existing files keep their layout
+        extra = {probe_column(rom_id): value for rom_id, value in reading['probes'].items()}
+        extra.update((ERROR_COLUMNS[sensor], error) for sensor, error in reading['errors'].items())
+        for sensor, (counts_column, voltage_column) in RAW_COLUMNS.items():
+            counts = reading['raw'].get(sensor)
+            if counts is not None:
+                extra[counts_column] = round(counts, 2)
+                extra[voltage_column] = round(adc_to_voltage(counts), 4)
+        extra[VERSION_COLUMN] = reading['calibration']
+        if reading['gps'] is not None:
+            extra.update(zip(POSITION_COLUMNS, reading['gps'].split(',')))
+        for column in data_file_columns[len(DATA_FILE_HEADER):]:
+            value = extra.get(column)
+            row.append(value if value is not None else "ERROR")
+        writer.write(row, reading['time'])
+
+def log_reading(manual=False, when=None, cycle=None):
     """
     Log sensor readings to the data file.
     
     Args:
         manual: Whether reading was triggered manually (True) or automatically (False)
+        when: Epoch seconds to timestamp the reading with (default: now)
+        cycle: Queued Cycle being run, which button presses can join until
+            the sensors have been read
     
     Returns:
         dict: Sensor readings, or None if error
     """
+    with reading_lock:
+        with stage_histogram('cycle').time():
+            return _log_reading(manual, when, cycle)
+
+def _log_reading(manual, when=None, cycle=None):
+    """Take and store one reading; the caller must hold reading_lock."""
     try:
         # Turn on LED to indicate activity
-        GPIO.output(CONFIG['LED_PIN'], GPIO.HIGH)
+        set_led(True)
         
         # Get timestamp
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now = datetime.datetime.now() if when is None else datetime.datetime.fromtimestamp(when)
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
         
-        # Get sensor readings
+        # Get sensor readings, all sources in parallel
+        # (with shorter GPS timeout for manual readings)
         logger.info("Taking sensor readings...")
-        temp = read_ds18b20()
-        ph = read_ph_sensor()
-        turbidity = read_turbidity_sensor()
-        
-        # Get GPS coordinates (with shorter timeout for manual readings)
-        timeout = 5 if manual else 10
-        coords = get_gps_data(timeout=timeout)
+        if CONFIG['CONTINUOUS_MODE']:
+            timeout = 0
+        else:
+            timeout = 5 if manual else 10
+        deadlines = dict(CONFIG['SENSOR_DEADLINES'], gps=timeout + 1)
+        capture = cycle is not None and cycle.capture
+        if capture:
+            # Recording plus summarizing; the other sources finish meanwhile
+            deadlines['analog'] = 2 * CONFIG['CAPTURE_DURATION'] + deadlines['analog']
+            analog = lambda: capture_waveform(now.timestamp())
+        else:
+            analog = lambda: read_analog_sensors(with_details=True)
+        results = acquisition_engine.acquire({
+            'temperature': read_temperature_probes,
+            'analog': analog,
+            'gps': lambda: get_gps_data(timeout=timeout),
+        }, deadlines)
+        probes = results['temperature'] or {}
+        temp = next(iter(probes.values()), None)  # Primary probe
+        ph, turbidity, details = results['analog'] or (None, None, {'raw': {}, 'errors': {}})
+        # Standard errors of adaptively sampled values that were read
+        errors = {sensor: round(error, 4) for sensor, error in details['errors'].items()
+                  if error is not None and {'ph': ph, 'turbidity': turbidity}[sensor] is not None}
+        coords = results['gps']
+        if cycle is not None:
+            # Presses from now on need a reading of their own
+            manual = acquisition_worker.close(cycle)
         
         # Create notes field
         notes = "Manual reading" if manual else "Auto reading"
@@ -333,46 +992,46 @@ def log_reading(manual=False):
         if ph is None: notes += ", pH sensor error"
         if turbidity is None: notes += ", Turbidity sensor error"
         if coords is None: notes += ", No GPS fix"
+        if details.get('capture'): notes += f", Waveform capture {details['capture']}"
+        readings_counter['manual' if manual else 'auto'].inc()
+        for sensor, value in (('temperature', temp), ('ph', ph), ('turbidity', turbidity)):
+            if value is None:
+                sensor_error_counter(sensor).inc()
         
         # Log sensor readings
+        if len(probes) > 1:
+            logger.info(f"Probe temperatures: {probes}")
         logger.info(f"Logging data: Temp={temp}°C, pH={ph}, Turbidity={turbidity}NTU, GPS={coords}")
         
-        # Ensure data file exists
-        if not ensure_data_file_exists():
-            logger.error("Failed to ensure data file exists")
-            GPIO.output(CONFIG['LED_PIN'], GPIO.LOW)
-            return None
-        
-        # Write data to CSV file
-        with open(CONFIG['DATA_FILE'], 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                timestamp,
-                temp if temp is not None else "ERROR",
-                ph if ph is not None else "ERROR",
-                turbidity if turbidity is not None else "ERROR",
-                coords if coords is not None else "NO FIX",
-                notes
-            ])
-        
         # Create reading dictionary to return
         reading = {
             'timestamp': timestamp,
+            'time': now.timestamp(),
             'temperature': temp,
             'ph': ph,
             'turbidity': turbidity,
             'gps': coords,
-            'notes': notes
+            'notes': notes,
+            'manual': manual,
+            'probes': probes,
+            'errors': errors,
+            'raw': details['raw'],
+            'calibration': get_calibration().version
         }
         
+        with stage_histogram('store').time():
+            store_reading(reading)
+        if not capture:
+            check_capture_trigger(reading)
+        
         # Turn off LED
-        GPIO.output(CONFIG['LED_PIN'], GPIO.LOW)
+        set_led(False)
         
-        # Blink LED to indicate success
-        for _ in range(3):
-            GPIO.output(CONFIG['LED_PIN'], GPIO.HIGH)
+        # Blink LED to indicate success (too slow for continuous mode)
+        for _ in range(0 if CONFIG['CONTINUOUS_MODE'] else 3):
+            set_led(True)
             time.sleep(0.1)
-            GPIO.output(CONFIG['LED_PIN'], GPIO.LOW)
+            set_led(False)
             time.sleep(0.1)
             
         return reading
@@ -380,87 +1039,423 @@ def log_reading(manual=False):
     except Exception as e:
         logger.error(f"Error logging reading: {e}")
         # Ensure LED is off
-        GPIO.output(CONFIG['LED_PIN'], GPIO.LOW)
+        set_led(False)
         return None
 
+class Cycle:
+    """One queued reading and the triggers waiting for it."""
+    def __init__(self, manual, when=None, capture=False):
+        self.manual = manual
+        self.when = when
+        self.capture = capture  # Logged from a waveform capture
+        self.open = True  # Button presses can still join
+        self.reading = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the reading.
+
+        Returns:
+            dict: Sensor readings, or None if the reading failed, was
+            cancelled or did not finish within timeout
+        """
+        self.done.wait(timeout)
+        return self.reading
+
+class AcquisitionWorker:
+    """
+    Single thread taking every reading, in order of priority.
+
+    Button presses and scheduled readings are queued as cycles instead of
+    being read on the thread that triggered them, so the sensors, GPS and
+    data file only ever have one user. Manual cycles run before scheduled
+    ones. A trigger joins the cycle whose sensors are being read, if any,
+    or one that is waiting to run: a press joins any such cycle (which is
+    then logged as manual) and a scheduled reading joins a manual one. A
+    burst of presses thus gives one reading, a press never duplicates a
+    reading due at the same time, and readings are taken in time order.
+    Waveform captures are queued like manual readings but only ever join
+    another capture.
+    """
+    MANUAL, SCHEDULED = 0, 1
+
+    def __init__(self):
+        self.queue = []  # (priority, sequence, cycle)
+        self.sequence = 0
+        self.current = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.last_press = None
+
+    def start(self):
+        """Start the worker thread, if not running. A stopped worker can't be restarted."""
+        with self.condition:
+            if self.stopping:
+                raise RuntimeError("Acquisition worker was stopped; create a new one")
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="acquisition", daemon=True)
+                self.thread.start()
+
+    def submit(self, manual=False, when=None, capture=False):
+        """
+        Queue a reading, or join one already running or queued.
+
+        Args:
+            manual: Whether the reading was triggered manually
+            when: Epoch seconds to timestamp the reading with (default: when it starts)
+            capture: Take the reading as a waveform capture
+
+        Returns:
+            Cycle: The cycle that will take the reading
+        """
+        with self.condition:
+            if not self.stopping:
+                self.start()
+            joinable = [cycle for _, _, cycle in sorted(self.queue, key=lambda item: item[:2])]
+            if not manual and not capture:
+                joinable = [cycle for cycle in joinable if cycle.manual]
+            if self.current is not None:
+                joinable.insert(0, self.current)
+            for cycle in joinable:
+                if cycle.open and cycle.capture == capture:
+                    if manual:
+                        cycle.manual = True
+                        coalesced_press_counter.inc()
+                    return cycle
+            cycle = Cycle(manual, when, capture)
+            if self.stopping:
+                cycle.done.set()
+                return cycle
+            self.sequence += 1
+            heapq.heappush(self.queue, (self.MANUAL if manual or capture else self.SCHEDULED,
+                                        self.sequence, cycle))
+            self.condition.notify()
+            return cycle
+
+    def press(self):
+        """
+        Queue a manual reading for a button press, without blocking.
+
+        Returns:
+            Cycle: The cycle that will take the reading, or None if the press
+            was contact bounce
+        """
+        now = time.monotonic()
+        with self.condition:
+            if self.last_press is not None and now - self.last_press < CONFIG['BUTTON_DEBOUNCE']:
+                return None
+            self.last_press = now
+        return self.submit(manual=True)
+
+    def close(self, cycle):
+        """
+        Stop a running cycle from accepting presses.
+
+        Returns:
+            bool: Whether the cycle is now manual
+        """
+        with self.condition:
+            cycle.open = False
+            return cycle.manual
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.stopping)
+                if self.stopping:
+                    return
+                _, _, cycle = heapq.heappop(self.queue)
+                self.current = cycle
+            try:
+                cycle.reading = log_reading(cycle.manual, cycle.when, cycle)
+            finally:
+                with self.condition:
+                    self.current = None
+                    cycle.open = False
+                cycle.done.set()
+            kind = "Manual" if cycle.manual else "Automatic"
+            if cycle.capture:
+                kind += " capture"
+            if cycle.reading:
+                logger.info(f"{kind} reading logged successfully")
+            else:
+                logger.error(f"Failed to log {kind.lower()} reading")
+
+    def stop(self, timeout=None):
+        """Finish the running reading and cancel the queued ones."""
+        with self.condition:
+            self.stopping = True
+            cancelled = [cycle for _, _, cycle in self.queue]
+            self.queue.clear()
+            thread = self.thread
+            self.thread = None
+            self.condition.notify_all()
+        for cycle in cancelled:
+            cycle.done.set()
+        if thread:
+            thread.join(timeout)
+
+# Takes all readings of the running system
+acquisition_worker = AcquisitionWorker()
+
+# When the button was last pressed, to tell a hold from a release and press again
+button_state = {'pressed': None}
+
 def button_callback(channel):
-    """Callback function for button press."""
-    logger.info("Button press detected - manually logging readings")
-    # Debounce button press
-    time.sleep(0.2)
-    if GPIO.input(channel) == GPIO.LOW:  # Confirm button is still pressed
-        # Log readings
-        reading = log_reading(manual=True)
-        if reading:
-            logger.info("Manual reading logged successfully")
-        else:
-            logger.error("Failed to log manual reading")
+    """
+    Callback function for button press; returns immediately. A press
+    queues a manual reading; if the button is still down CAPTURE_BUTTON_HOLD
+    seconds later, a timer also queues a waveform capture.
+    """
+    if acquisition_worker.press():
+        logger.info("Button press detected - manual reading queued")
+        hold = CONFIG['CAPTURE_BUTTON_HOLD']
+        if hold:
+            pressed = button_state['pressed'] = time.monotonic()
+            timer = threading.Timer(hold, check_button_hold, args=(pressed,))
+            timer.daemon = True
+            timer.start()
+
+def check_button_hold(pressed):
+    """Queue a waveform capture if the press at pressed is still held."""
+    gpio = get_hardware().gpio
+    if button_state['pressed'] != pressed or gpio.input(CONFIG['BUTTON_PIN']) != gpio.LOW:
+        return
+    acquisition_worker.submit(manual=True, capture=True)
+    logger.info("Button held - waveform capture queued")
+
+# Values of the last reading, and when the last capture was triggered by a change
+capture_trigger_state = {'values': None, 'triggered': None}
+
+def check_capture_trigger(reading):
+    """
+    Queue a waveform capture if a value changed by more than its
+    CAPTURE_THRESHOLDS entry since the previous reading.
+
+    Returns:
+        bool: Whether a capture was queued
+    """
+    thresholds = CONFIG['CAPTURE_THRESHOLDS']
+    previous = capture_trigger_state['values']
+    capture_trigger_state['values'] = {sensor: reading[sensor] for sensor in thresholds}
+    if not thresholds or previous is None:
+        return False
+    changed = [sensor for sensor, threshold in thresholds.items()
+               if reading[sensor] is not None and previous.get(sensor) is not None
+               and abs(reading[sensor] - previous[sensor]) > threshold]
+    if not changed:
+        return False
+    triggered = capture_trigger_state['triggered']
+    now = time.monotonic()
+    if triggered is not None and now - triggered < CONFIG['CAPTURE_COOLDOWN']:
+        return False
+    capture_trigger_state['triggered'] = now
+    acquisition_worker.submit(capture=True)
+    logger.info(f"{', '.join(changed)} changed beyond the capture threshold - waveform capture queued")
+    return True
 
 class AutoLogger:
-    """Class to handle automatic logging at regular intervals."""
-    def __init__(self, interval=CONFIG['AUTO_LOG_INTERVAL']):
+    """
+    Class to handle automatic logging at regular intervals.
+
+    Readings fire at absolute deadlines on the monotonic clock (start +
+    n * interval), so the time a reading takes does not push later readings
+    back, and each reading is timestamped with its scheduled time. How late
+    each reading actually started is recorded as jitter.
+    """
+    # Number of recent jitter samples kept for the statistics
+    JITTER_WINDOW = 1000
+
+    def __init__(self, interval=None, overrun_policy=None):
+        if interval is None:
+            interval = (CONFIG['CONTINUOUS_INTERVAL'] if CONFIG['CONTINUOUS_MODE']
+                        else CONFIG['AUTO_LOG_INTERVAL'])
         self.interval = interval
-        self.timer = None
+        self.overrun_policy = overrun_policy or CONFIG['OVERRUN_POLICY']
+        if self.overrun_policy not in ('skip', 'catchup'):
+            raise ValueError(f"Unknown overrun policy '{self.overrun_policy}'")
         self.running = False
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.jitter = deque(maxlen=self.JITTER_WINDOW)
+        self.readings = 0
+        self.overruns = 0
+        self.skipped = 0
         
     def start(self):
         """Start automatic logging."""
         self.running = True
-        self.schedule_next()
-        logger.info(f"Automatic logging started (every {self.interval} seconds)")
-        
-    def schedule_next(self):
-        """Schedule the next automatic reading."""
-        if self.running:
-            self.timer = Timer(self.interval, self.log_and_reschedule)
-            self.timer.daemon = True
-            self.timer.start()
-            
-    def log_and_reschedule(self):
-        """Log readings and schedule the next logging."""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="auto-logger", daemon=True)
+        self.thread.start()
+        logger.info(f"Automatic logging started (every {self.interval} seconds, "
+                    f"overrun policy '{self.overrun_policy}')")
+
+    def _run(self):
+        """Scheduler loop: wait for each deadline, then take a reading."""
+        # Wall clock time corresponding to monotonic time zero, for timestamps
+        start = time.monotonic()
+        wall_offset = time.time() - start
+        deadline = start + self.interval
+        while not self.stop_event.wait(max(deadline - time.monotonic(), 0)):
+            lateness = time.monotonic() - deadline
+            self.jitter.append(lateness)
+            scheduler_lateness.observe(lateness)
+            self.log_reading(wall_offset + deadline)
+            deadline += self.interval
+
+            now = time.monotonic()
+            if now > deadline:
+                self.overruns += 1
+                if self.overrun_policy == 'skip':
+                    missed = int((now - deadline) // self.interval) + 1
+                    deadline += missed * self.interval
+                    self.skipped += missed
+                    logger.warning(f"Reading overran its interval, skipped {missed} deadline(s)")
+
+            # Report jitter once per window (at least once an hour)
+            if self.readings % min(self.JITTER_WINDOW, max(int(3600 / self.interval), 1)) == 0:
+                self.log_jitter()
+
+    def log_reading(self, when):
+        """Queue one scheduled reading and wait until it is taken."""
         logger.info("Auto-logging triggered")
-        reading = log_reading(manual=False)
-        if reading:
-            logger.info("Automatic reading logged successfully")
-        else:
-            logger.error("Failed to log automatic reading")
-        self.schedule_next()
+        acquisition_worker.submit(manual=False, when=when).wait()
+        self.readings += 1
+
+    def jitter_stats(self):
+        """
+        Summarize how late recent readings started relative to their deadlines.
+
+        Returns:
+            dict: Sample count, mean/p50/p99/max lateness in seconds, and the
+            total number of readings, overruns and skipped deadlines
+        """
+        samples = sorted(self.jitter)
+        stats = {
+            'samples': len(samples),
+            'readings': self.readings,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+        }
+        if samples:
+            stats.update({
+                'mean': sum(samples) / len(samples),
+                'p50': samples[len(samples) // 2],
+                'p99': samples[min(int(len(samples) * 0.99), len(samples) - 1)],
+                'max': samples[-1],
+            })
+        return stats
+
+    def log_jitter(self):
+        """Log the current jitter statistics."""
+        stats = self.jitter_stats()
+        if stats['samples']:
+            logger.info(f"Scheduler jitter over {stats['samples']} readings: "
+                        f"mean={stats['mean'] * 1000:.1f}ms p50={stats['p50'] * 1000:.1f}ms "
+                        f"p99={stats['p99'] * 1000:.1f}ms max={stats['max'] * 1000:.1f}ms, "
+                        f"overruns={stats['overruns']} skipped={stats['skipped']}")
         
     def stop(self):
         """Stop automatic logging."""
         self.running = False
-        if self.timer:
-            self.timer.cancel()
+        self.stop_event.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=15)
+        self.log_jitter()
         logger.info("Automatic logging stopped")
 
+# Driver and writer state, read when a metrics snapshot is written
+registry.counter_func('piaquapulse_ds18b20_crc_retries_total', "DS18B20 reads retried after a CRC failure",
+                      lambda: temp_bus.crc_retries if temp_bus else 0)
+registry.counter_func('piaquapulse_gps_parse_errors_total', "NMEA sentences that failed to parse",
+                      lambda: gps_service.parse_errors if gps_service else 0)
+registry.counter_func('piaquapulse_readings_compressed_out_total',
+                      "Readings left out of the data file by compression",
+                      lambda: compressor.dropped if compressor else 0)
+registry.counter_func('piaquapulse_rows_written_total', "Readings written to the data file",
+                      lambda: data_writer.items_written if data_writer else 0)
+registry.counter_func('piaquapulse_write_errors_total', "Data file batches that failed to write",
+                      lambda: data_writer.errors if data_writer else 0)
+registry.counter_func('piaquapulse_rows_dropped_total', "Readings given up on after data file writes kept failing",
+                      lambda: data_writer.dropped if data_writer else 0)
+registry.gauge('piaquapulse_write_queue_depth', "Readings queued for the data writer",
+               lambda: data_writer.queue_depth if data_writer else 0)
+registry.gauge('piaquapulse_gps_fix_age_seconds', "Age of the latest GPS fix",
+               lambda: gps_service.fix.age if gps_service and gps_service.fix else None)
+
+# Automatic logger, created by main()
+auto_logger = None
+
 def cleanup():
     """Clean up resources before exit."""
     logger.info("Cleaning up resources...")
     # Stop automatic logging if running
     if auto_logger and auto_logger.running:
         auto_logger.stop()
+    acquisition_worker.stop()
+    acquisition_engine.shutdown()
+    # Store the reading compression held back, then write out any queued readings
+    if compressor:
+        for reading in compressor.flush():
+            write_reading(reading)
+    if data_writer:
+        data_writer.close()
+    if rollup_store and rollup_store.dirty:
+        rollup_store.save()
+    if live_ring:
+        live_ring.close()
+    if gps_service:
+        gps_service.stop()
+    # Stop the periodic metrics snapshots and write a final one
+    get_metrics_writer().stop()
+    get_metrics_writer().write()
     # Clean up GPIO
-    GPIO.cleanup()
+    if hardware:
+        hardware.cleanup()
     logger.info("Cleanup complete")
 
-if __name__ == "__main__":
+def main():
+    """Run the monitoring system until interrupted."""
+    global auto_logger
+    parser = argparse.ArgumentParser(description="PiAquaPulse water quality monitoring system")
+    parser.add_argument('--simulate', action='store_true',
+                        help="Use simulated sensors instead of the Raspberry Pi hardware")
+    args = parser.parse_args()
+    if args.simulate:
+        CONFIG['HARDWARE_BACKEND'] = 'sim'
+    try:
+        check_storage_config()
+    except ValueError as e:
+        parser.error(str(e))
+
+    configure_logging()
     try:
         logger.info("Starting PiAquaPulse water quality monitoring system")
         
         # Blink LED to indicate startup
         for _ in range(5):
-            GPIO.output(CONFIG['LED_PIN'], GPIO.HIGH)
+            set_led(True)
             time.sleep(0.1)
-            GPIO.output(CONFIG['LED_PIN'], GPIO.LOW)
+            set_led(False)
             time.sleep(0.1)
         
         # Initialize temperature sensor
         if not initialize_temp_sensor():
             logger.warning("Temperature sensor not initialized, will retry later")
         
+        # Start reading GPS in the background so a fix is ready for the first reading
+        start_gps_service()
+        
+        # Keep the /metrics snapshot current whether or not readings are taken
+        get_metrics_writer().start()
+        
         # Set up button interrupt
-        GPIO.add_event_detect(CONFIG['BUTTON_PIN'], GPIO.FALLING, 
-                            callback=button_callback, bouncetime=300)
+        gpio = get_hardware().gpio
+        gpio.add_event_detect(CONFIG['BUTTON_PIN'], gpio.FALLING, 
+                              callback=button_callback, bouncetime=300)
         
         # Create and ensure data file exists
         ensure_data_file_exists()
@@ -471,7 +1466,7 @@ if __name__ == "__main__":
         
         # Take initial reading
         logger.info("Taking initial reading...")
-        log_reading(manual=False)
+        acquisition_worker.submit(manual=False)
         
         # Main loop - keep program running
         logger.info("Entering main loop")
@@ -487,3 +1482,6 @@ if __name__ == "__main__":
         # Clean up resources
         cleanup()
         logger.info("PiAquaPulse system shutdown complete")
+
+if __name__ == "__main__":
+    main()
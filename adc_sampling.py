@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Burst ADC sampling and robust filters
+
+Reads many interleaved samples from several MCP3008 channels in one tight
+loop into a preallocated NumPy array, and reduces them with vectorized
+robust estimators (trimmed mean, median, MAD-filtered mean).
+
+In adaptive mode a burst is taken in blocks and stops as soon as the
+standard error of every channel's estimate is within its tolerance, so
+calm water needs only a few samples while noisy water gets as many as the
+sample and time caps allow.
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import time
+import threading
+import numpy as np
+
+# Scale factor from median absolute deviation to standard deviation for
+# normally distributed noise
+MAD_TO_SIGMA = 1.4826
+
+# Standard deviation of the rounding to whole ADC counts; the spread never
+# counts as less than this, even when every sample is identical
+QUANTIZATION_SIGMA = 1 / np.sqrt(12)
+
+
+class BurstSampler:
+    """
+    Sample several ADC channels in interleaved bursts.
+
+    Samples are written into a buffer allocated once up front, one row per
+    sampling round and one column per channel, so a burst does no list
+    building or per-sample allocation beyond the driver call itself.
+    """
+    def __init__(self, adc, channels, samples=200, interval=0.0, lock=None):
+        """
+        Args:
+            adc: Object with a read_adc(channel) method (e.g. Adafruit_MCP3008.MCP3008)
+            channels: Sequence of channel numbers to sample
+            samples: Number of sampling rounds per burst
+            interval: Optional delay in seconds between sampling rounds
+            lock: Lock guarding the ADC bus; a private one is used if omitted
+        """
+        self.adc = adc
+        self.channels = list(channels)
+        self.samples = samples
+        self.interval = interval
+        self.lock = lock or threading.Lock()
+        self.buffer = np.empty((samples, len(self.channels)), dtype=np.uint16)
+
+    def sample(self):
+        """
+        Take one burst of samples.
+
+        Returns:
+            numpy.ndarray: View of shape (samples, channels) into the sample
+            buffer. It is overwritten by the next burst, so copy it if it
+            must be kept.
+        """
+        buffer = self.buffer
+        read_adc = self.adc.read_adc
+        channels = list(enumerate(self.channels))
+        with self.lock:
+            for i in range(self.samples):
+                row = buffer[i]
+                for column, channel in channels:
+                    row[column] = read_adc(channel)
+                if self.interval:
+                    time.sleep(self.interval)
+        return buffer
+
+    def sample_adaptive(self, tolerances, method='mad', min_samples=20, block=10,
+                        max_time=None, propagate=None):
+        """
+        Sample in blocks until every channel's estimate is precise enough.
+
+        After each block of rounds, once min_samples rounds are taken, the
+        robust estimate and its standard error are computed over all samples
+        so far. Sampling stops when each error is within its tolerance, when
+        the buffer (samples rounds) is full or after max_time seconds.
+
+        Args:
+            tolerances: Largest acceptable standard error for each channel
+            method: Robust estimator, one of FILTERS
+            min_samples: Rounds taken before the first check
+            block: Rounds between checks
+            max_time: Optional time cap in seconds
+            propagate: Optional function for each channel mapping
+                (estimate, standard error) in counts to the standard error in
+                the units of its tolerance, e.g. pH
+
+        Returns:
+            tuple: (estimates in counts, standard errors in tolerance units,
+            number of rounds taken)
+
+        Raises:
+            ValueError: If block is less than one round
+        """
+        if block < 1:
+            raise ValueError(f"ADC sampling block must be at least 1 round, got {block}")
+        buffer = self.buffer
+        read_adc = self.adc.read_adc
+        channels = list(enumerate(self.channels))
+        tolerances = np.asarray(tolerances, dtype=np.float64)
+        count = 0
+        with self.lock:
+            started = time.monotonic()
+            while count < self.samples:
+                for i in range(count, min(count + block, self.samples)):
+                    row = buffer[i]
+                    for column, channel in channels:
+                        row[column] = read_adc(channel)
+                    if self.interval:
+                        time.sleep(self.interval)
+                count = i + 1
+                if count < min(min_samples, self.samples):
+                    continue
+                samples = buffer[:count]
+                estimates = robust_estimate(samples, method)
+                errors = standard_error(samples, method)
+                if propagate is not None:
+                    errors = np.array([convert(e, se) for convert, e, se
+                                       in zip(propagate, estimates, errors)])
+                if np.all(errors <= tolerances):
+                    break
+                if max_time is not None and time.monotonic() - started >= max_time:
+                    break
+        return estimates, errors, count
+
+    def column(self, channel):
+        """Index of a channel in the sample buffer."""
+        return self.channels.index(channel)
+
+
+def trimmed_mean(samples, proportion=0.1, axis=0):
+    """
+    Mean after discarding the lowest and highest proportion of samples.
+
+    Args:
+        samples: Array of samples
+        proportion: Fraction cut from each end (0 <= proportion < 0.5)
+        axis: Axis along which to reduce
+
+    Returns:
+        numpy.ndarray: Trimmed mean along axis
+    """
+    ordered = np.sort(samples, axis=axis)
+    count = ordered.shape[axis]
+    cut = int(count * proportion)
+    # Always keep at least one sample
+    cut = min(cut, (count - 1) // 2)
+    kept = np.take(ordered, np.arange(cut, count - cut), axis=axis)
+    return kept.mean(axis=axis)
+
+
+def median(samples, axis=0):
+    """Median of the samples along axis."""
+    return np.median(samples, axis=axis)
+
+
+def mad(samples, axis=0):
+    """Median absolute deviation of the samples along axis."""
+    center = np.median(samples, axis=axis, keepdims=True)
+    return np.median(np.abs(samples - center), axis=axis)
+
+
+def mad_mean(samples, threshold=3.5, axis=0):
+    """
+    Mean of the samples that lie within threshold robust standard deviations
+    of the median. Spikes and dropouts are rejected before averaging.
+
+    Args:
+        samples: Array of samples
+        threshold: Rejection threshold in MAD-derived standard deviations
+        axis: Axis along which to reduce
+
+    Returns:
+        numpy.ndarray: Filtered mean along axis
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    center = np.median(samples, axis=axis, keepdims=True)
+    deviation = np.abs(samples - center)
+    sigma = MAD_TO_SIGMA * np.median(deviation, axis=axis, keepdims=True)
+    # With no spread at all (sigma == 0) keep the samples equal to the median
+    keep = deviation <= threshold * sigma
+    counts = keep.sum(axis=axis)
+    return np.where(keep, samples, 0.0).sum(axis=axis) / counts
+
+
+FILTERS = {
+    'trimmed': trimmed_mean,
+    'median': median,
+    'mad': mad_mean,
+}
+
+
+# Standard error of each estimator relative to that of the mean, for
+# normally distributed noise
+EFFICIENCY = {
+    'trimmed': 1.0,
+    'median': np.sqrt(np.pi / 2),
+    'mad': 1.0,
+}
+
+
+def standard_error(samples, method='mad', axis=0):
+    """
+    Standard error of robust_estimate(samples, method), from the MAD.
+
+    Args:
+        samples: Array of samples in ADC counts
+        method: One of FILTERS
+        axis: Axis along which to reduce
+
+    Returns:
+        numpy.ndarray: Standard error along axis, in counts
+    """
+    count = np.shape(samples)[axis]
+    sigma = np.maximum(MAD_TO_SIGMA * mad(samples, axis=axis), QUANTIZATION_SIGMA)
+    return EFFICIENCY[method] * sigma / np.sqrt(count)
+
+
+def robust_estimate(samples, method='mad', axis=0):
+    """
+    Reduce samples with one of the named filters in FILTERS.
+
+    Raises:
+        ValueError: If method is not a known filter
+    """
+    try:
+        return FILTERS[method](samples, axis=axis)
+    except KeyError:
+        raise ValueError(f"Unknown ADC filter '{method}', expected one of {sorted(FILTERS)}")
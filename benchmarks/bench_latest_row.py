@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark the dashboard's latest-row lookup against data file size.
+
+Generates synthetic river_data.csv files from 1k to 10M rows and times:
+- full: the old approach, csv.reader over the whole file
+- tail: datastore.read_last_row, seeking back from the end
+- cached: datastore.LatestRowCache.get with the file unchanged
+
+Usage:
+    python3 benchmarks/bench_latest_row.py
+    python3 benchmarks/bench_latest_row.py --sizes 1000 100000 --repeat 50
+"""
+
+import os
+import sys
+import csv
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from datastore import read_last_row, LatestRowCache
+
+HEADER = 'Timestamp,Temperature (°C),pH,Turbidity (NTU),GPS Location,Notes\n'
+ROW = '2024-06-01 12:{:02d}:00,14.25,7.12,35.5,"51.899812,-2.078441",Auto reading\n'
+
+
+def write_data_file(path, rows):
+    """Write a synthetic data file with the given number of rows."""
+    chunk = ''.join(ROW.format(i % 60) for i in range(min(rows, 100000)))
+    chunk_rows = min(rows, 100000)
+    with open(path, 'w', newline='') as f:
+        f.write(HEADER)
+        written = 0
+        while written + chunk_rows <= rows:
+            f.write(chunk)
+            written += chunk_rows
+        f.write(''.join(ROW.format(i % 60) for i in range(rows - written)))
+
+
+def read_full(path):
+    """The original dashapp implementation."""
+    with open(path, 'r') as file:
+        reader = list(csv.reader(file))
+        if len(reader) > 1:
+            return reader[-1]
+    return None
+
+
+def time_call(func, repeat):
+    """Median wall time of func() in microseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000, 10000000],
+                        help="Row counts to benchmark")
+    parser.add_argument('--repeat', type=int, default=20, help="Timed calls per measurement")
+    parser.add_argument('--full-max-rows', type=int, default=1000000,
+                        help="Skip the full-scan baseline above this many rows")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'size MB':>9} {'full us':>12} {'tail us':>10} {'cached us':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.sizes:
+            path = os.path.join(tmp, f"river_data_{rows}.csv")
+            write_data_file(path, rows)
+            size_mb = os.path.getsize(path) / 1e6
+
+            if rows <= args.full_max_rows:
+                full = f"{time_call(lambda: read_full(path), min(args.repeat, 5)):12.1f}"
+            else:
+                full = f"{'-':>12}"
+            tail = time_call(lambda: read_last_row(path), args.repeat)
+            cache = LatestRowCache(path)
+            cache.get()
+            cached = time_call(cache.get, args.repeat)
+
+            print(f"{rows:>10} {size_mb:>9.1f} {full} {tail:>10.1f} {cached:>10.1f}")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
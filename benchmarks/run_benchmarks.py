@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse performance benchmark suite.
+
+Runs against the simulated hardware backend and synthetic data files, and
+writes machine-readable JSON so results can be compared between versions:
+
+- acquisition: end-to-end log_reading() cycle latency and per-sensor read time
+- storage: rows/s appended to data files of 1k to 10M rows, for the old
+  open-append-close per row approach and the batched DataWriter
+- dashboard: /data and /history latency (p50/p99) under concurrent clients
+
+Usage:
+    python3 benchmarks/run_benchmarks.py --output results.json
+    python3 benchmarks/run_benchmarks.py --quick
+    python3 benchmarks/run_benchmarks.py --compare old.json --output new.json
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import datetime
+import threading
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import numpy as np
+
+from bench_latest_row import write_data_file, ROW
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000, 10000000]
+QUICK_SIZES = [1000, 10000, 100000]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    ms = np.asarray(samples) * 1000.0
+    return {
+        'count': int(len(ms)),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def timed(func, repeat):
+    """Durations in seconds of repeat calls to func()."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_acquisition(tmp, cycles, seed):
+    """log_reading() cycle and per-sensor timings with simulated sensors."""
+    import PAPScript
+    from drivers import SimulatedHardware
+
+    config = PAPScript.CONFIG
+    # Keep every file and the shared memory ring away from a running logger;
+    # the rollups and positions files are named after the data file
+    config['DATA_FILE'] = os.path.join(tmp, 'acquisition.csv')
+    config['BINARY_DATA_FILE'] = os.path.join(tmp, 'acquisition.bin')
+    config['CALIBRATION_FILE'] = os.path.join(tmp, 'calibration.json')
+    config['METRICS_FILE'] = os.path.join(tmp, 'metrics.json')
+    config['UPLOAD_CURSOR_FILE'] = os.path.join(tmp, 'upload_cursor.json')
+    config['CAPTURE_DIR'] = os.path.join(tmp, 'captures')
+    config['PARTITION_DIR'] = None
+    config['LIVE_RING_NAME'] = f"piaquapulse-bench-{os.getpid()}"
+    # Continuous mode settings: no success blink, cached GPS fix only
+    config['CONTINUOUS_MODE'] = True
+    PAPScript.hardware = SimulatedHardware(config, seed=seed)
+    PAPScript.get_gps_data(timeout=3)  # Wait for the first simulated fix
+
+    results = {
+        'cycle': summarize(timed(PAPScript.log_reading, cycles)),
+        'sensors': {
+            'temperature': summarize(timed(PAPScript.read_temperature_probes, cycles)),
+            'analog': summarize(timed(PAPScript.read_analog_sensors, cycles)),
+            'gps': summarize(timed(lambda: PAPScript.get_gps_data(timeout=0), cycles)),
+        },
+        'settings': {
+            'adc_burst_samples': config['ADC_BURST_SAMPLES'],
+            'temp_conversion_time_s': PAPScript.hardware.temp_conversion_time,
+        },
+    }
+    PAPScript.cleanup()
+    return results
+
+
+def bench_storage(tmp, sizes, rows):
+    """Append throughput as the data file grows."""
+    from datastore import DataWriter, encode_csv_rows, recover_csv_file
+    header = ['Timestamp', 'Temperature (°C)', 'pH', 'Turbidity (NTU)', 'GPS Location', 'Notes']
+    row = next(csv.reader([ROW.format(0)]))
+    results = {}
+    for size in sizes:
+        path = os.path.join(tmp, f'storage_{size}.csv')
+        entry = {}
+
+        write_data_file(path, size)
+        start = time.perf_counter()
+        for _ in range(rows):
+            # The original per-reading write path
+            if os.path.isfile(path):
+                with open(path, 'a', newline='') as f:
+                    csv.writer(f).writerow(row)
+        entry['open_per_row_rows_s'] = rows / (time.perf_counter() - start)
+
+        for batch_size, durability in [(1, 'flush'), (100, 'flush'), (100, 'fsync')]:
+            write_data_file(path, size)
+            writer = DataWriter(path, encode_csv_rows, lambda f: recover_csv_file(f, header),
+                                batch_size=batch_size, flush_interval=60, durability=durability)
+            start = time.perf_counter()
+            for _ in range(rows):
+                writer.write(row)
+            writer.flush()
+            entry[f'writer_batch{batch_size}_{durability}_rows_s'] = rows / (time.perf_counter() - start)
+            writer.close()
+
+        entry['file_mb'] = os.path.getsize(path) / 1e6
+        results[str(size)] = entry
+        os.remove(path)
+    return results
+
+
+def bench_dashboard(tmp, sizes, clients, requests_per_client):
+    """Endpoint latency under concurrent clients."""
+    from werkzeug.serving import make_server
+    import dashapp
+    from partitions import PartitionSet
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, dashapp.app, threaded=True)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = {}
+    try:
+        for size in sizes:
+            path = os.path.join(tmp, f'dashboard_{size}.csv')
+            write_data_file(path, size)
+            dashapp.data_files = PartitionSet(path)
+            # The synthetic rows all fall within one hour, so the range query
+            # downsamples the whole file
+            end = time.mktime(datetime.datetime(2024, 6, 1, 13, 0).timetuple())
+            endpoints = {
+                'data': '/data',
+                'history': f'/history?start={end - 3600}&end={end}&max_points=500',
+            }
+            entry = {}
+            for name, url in endpoints.items():
+                urllib.request.urlopen(f'http://127.0.0.1:{port}{url}').read()  # Warm up
+                samples = []
+                lock = threading.Lock()
+
+                def client():
+                    local = []
+                    for _ in range(requests_per_client):
+                        start = time.perf_counter()
+                        urllib.request.urlopen(f'http://127.0.0.1:{port}{url}').read()
+                        local.append(time.perf_counter() - start)
+                    with lock:
+                        samples.extend(local)
+
+                threads = [threading.Thread(target=client) for _ in range(clients)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+                entry[name] = dict(summarize(samples), requests_s=len(samples) / elapsed)
+            results[str(size)] = entry
+            os.remove(path)
+    finally:
+        server.shutdown()
+    return results
+
+
+def compare(previous, current, threshold):
+    """Report latencies and throughputs that got worse by more than threshold."""
+    regressions = []
+
+    def walk(old, new, path):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            if isinstance(value, dict):
+                walk(old[key], value, path + [key])
+            elif key.endswith('_ms') and old[key] > 0 and value > old[key] * (1 + threshold):
+                regressions.append(('.'.join(path + [key]), old[key], value))
+            elif key.endswith('_rows_s') and value < old[key] / (1 + threshold):
+                regressions.append(('.'.join(path + [key]), old[key], value))
+
+    walk(previous.get('results', {}), current['results'], [])
+    for name, old, new in regressions:
+        print(f"REGRESSION {name}: {old:.3f} -> {new:.3f}", file=sys.stderr)
+    if not regressions:
+        print("No regressions above threshold", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PiAquaPulse benchmark suite")
+    parser.add_argument('--output', help="Write JSON results to this file (default: stdout)")
+    parser.add_argument('--quick', action='store_true', help="Small sizes for a fast run")
+    parser.add_argument('--sizes', type=int, nargs='+', help="Data file sizes in rows")
+    parser.add_argument('--only', nargs='+', choices=['acquisition', 'storage', 'dashboard'],
+                        help="Run only these benchmarks")
+    parser.add_argument('--cycles', type=int, default=20, help="Acquisition cycles")
+    parser.add_argument('--append-rows', type=int, default=2000, help="Rows appended per size")
+    parser.add_argument('--clients', type=int, default=8, help="Concurrent dashboard clients")
+    parser.add_argument('--requests', type=int, default=25, help="Requests per dashboard client")
+    parser.add_argument('--seed', type=int, default=1, help="Simulated sensor seed")
+    parser.add_argument('--compare', help="Previous results JSON to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    selected = args.only or ['acquisition', 'storage', 'dashboard']
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'sizes': sizes,
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        if 'acquisition' in selected:
+            print("Running acquisition benchmark...", file=sys.stderr)
+            report['results']['acquisition'] = bench_acquisition(tmp, args.cycles, args.seed)
+        if 'storage' in selected:
+            print("Running storage benchmark...", file=sys.stderr)
+            report['results']['storage'] = bench_storage(tmp, sizes, args.append_rows)
+        if 'dashboard' in selected:
+            print("Running dashboard benchmark...", file=sys.stderr)
+            report['results']['dashboard'] = bench_dashboard(tmp, sizes, args.clients, args.requests)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare(previous, report, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Binary reading store
+
+A compact, append-only alternative to river_data.csv. Each reading is a
+fixed-width 32 byte little-endian record:
+
+    time         float64  epoch seconds
+    temperature  float32  degrees C, NaN if the sensor failed
+    ph           float32  pH, NaN if the sensor failed
+    turbidity    float32  NTU, NaN if the sensor failed
+    latitude     int32    degrees * 1e7, NO_FIX if there was no GPS fix
+    longitude    int32    degrees * 1e7, NO_FIX if there was no GPS fix
+    flags        uint32   FLAG_* bits, replacing the Notes column
+
+after a 16 byte file header. Readers memory-map the file straight into a
+NumPy structured array without parsing anything.
+
+Existing CSV files can be converted in either direction:
+
+    python3 binstore.py import river_data.csv river_data.bin
+    python3 binstore.py export river_data.bin river_data.csv
+
+The values of the CSV_HEADER columns round-trip exactly at the precision
+PAPScript.py writes them (2 decimals for sensor values, 6 for coordinates).
+The record has no room for the further columns PAPScript.py can write
+(probe temperatures, standard errors, raw values, calibration versions), so
+a file with any of them is only imported with --drop-columns.
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import os
+import csv
+import math
+import struct
+import logging
+import argparse
+import threading
+import numpy as np
+
+from datastore import parse_timestamp, format_timestamp, parse_number
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PAQPBIN\x00'
+VERSION = 1
+
+RECORD_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('temperature', '<f4'),
+    ('ph', '<f4'),
+    ('turbidity', '<f4'),
+    ('latitude', '<i4'),
+    ('longitude', '<i4'),
+    ('flags', '<u4'),
+])
+
+# magic, version, record size, reserved
+HEADER = struct.Struct('<8sHH4x')
+HEADER_SIZE = HEADER.size
+
+# Fixed-point scale of the coordinate columns
+COORDINATE_SCALE = 10 ** 7
+# Coordinate value stored when there was no GPS fix
+NO_FIX = -2 ** 31
+
+# Flag bits
+FLAG_MANUAL = 1 << 0
+FLAG_TEMP_ERROR = 1 << 1
+FLAG_PH_ERROR = 1 << 2
+FLAG_TURBIDITY_ERROR = 1 << 3
+FLAG_NO_FIX = 1 << 4
+
+# Notes text written by PAPScript.py for each error flag, in order
+FLAG_NOTES = [
+    (FLAG_TEMP_ERROR, "Temp sensor error"),
+    (FLAG_PH_ERROR, "pH sensor error"),
+    (FLAG_TURBIDITY_ERROR, "Turbidity sensor error"),
+    (FLAG_NO_FIX, "No GPS fix"),
+]
+
+CSV_HEADER = [
+    'Timestamp',
+    'Temperature (°C)',
+    'pH',
+    'Turbidity (NTU)',
+    'GPS Location',
+    'Notes'
+]
+
+# Further CSV columns whose values the record holds anyway (spatial.POSITION_COLUMNS,
+# the GPS Location split into numbers)
+DERIVED_COLUMNS = ('Latitude', 'Longitude')
+
+
+def make_record(time, temperature, ph, turbidity, gps, manual=False):
+    """
+    Build one record from reading values.
+
+    Args:
+        time: Epoch seconds
+        temperature, ph, turbidity: Sensor values, or None if the sensor failed
+        gps: "lat,lon" string, or None if there was no fix
+        manual: Whether the reading was triggered manually
+
+    Returns:
+        numpy.void: Record of RECORD_DTYPE
+    """
+    flags = FLAG_MANUAL if manual else 0
+    if temperature is None:
+        flags |= FLAG_TEMP_ERROR
+    if ph is None:
+        flags |= FLAG_PH_ERROR
+    if turbidity is None:
+        flags |= FLAG_TURBIDITY_ERROR
+    if gps is None:
+        flags |= FLAG_NO_FIX
+        latitude = longitude = NO_FIX
+    else:
+        lat, lon = (float(value) for value in gps.split(','))
+        latitude = round(lat * COORDINATE_SCALE)
+        longitude = round(lon * COORDINATE_SCALE)
+
+    def value(v):
+        return math.nan if v is None else v
+
+    return np.array((time, value(temperature), value(ph), value(turbidity),
+                     latitude, longitude, flags), dtype=RECORD_DTYPE)[()]
+
+
+def notes_from_flags(flags):
+    """Rebuild the CSV Notes text from a record's flags."""
+    notes = "Manual reading" if flags & FLAG_MANUAL else "Auto reading"
+    for flag, text in FLAG_NOTES:
+        if flags & flag:
+            notes += ", " + text
+    return notes
+
+
+def check_header(f, path):
+    """Read and validate the file header; raises ValueError if invalid."""
+    header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError(f"{path}: truncated binary store header")
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != MAGIC or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path}: not a PiAquaPulse binary store")
+    if version != VERSION:
+        raise ValueError(f"{path}: unsupported binary store version {version}")
+
+
+def encode_records(records):
+    """Encode one record or a sequence of records as store bytes."""
+    return np.asarray(records, dtype=RECORD_DTYPE).tobytes()
+
+
+def recover_binary_file(f):
+    """
+    Prepare a binary store for appending.
+
+    Writes the header to an empty file and drops a partial last record left
+    by an interrupted write, so that records stay aligned.
+
+    Args:
+        f: File opened in 'a+b' mode
+
+    Returns:
+        int: Number of bytes dropped
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size < HEADER_SIZE:
+        f.truncate(0)
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize))
+        return size
+    f.seek(0)
+    check_header(f, f.name)
+    torn = (size - HEADER_SIZE) % RECORD_DTYPE.itemsize
+    if torn:
+        f.truncate(size - torn)
+        logger.warning(f"Dropped {torn} bytes of a torn last record from {f.name}")
+    return torn
+
+
+class BinaryStore:
+    """Append-only writer for a binary reading store."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, records):
+        """Append one record or an array of records, creating the file if needed."""
+        with self.lock, open(self.path, 'a+b') as f:
+            recover_binary_file(f)
+            f.write(encode_records(records))
+
+
+def open_records(path):
+    """
+    Memory-map a binary store as a read-only NumPy structured array.
+
+    Returns:
+        numpy.ndarray: Records of RECORD_DTYPE (empty if the store has none)
+    """
+    with open(path, 'rb') as f:
+        check_header(f, path)
+    count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def format_number(value):
+    """Format a float32 sensor value the way PAPScript.py writes it."""
+    if math.isnan(value):
+        return "ERROR"
+    return str(round(float(value), 2))
+
+
+def record_to_row(record):
+    """Convert one record to a CSV row."""
+    flags = int(record['flags'])
+    if flags & FLAG_NO_FIX:
+        gps = "NO FIX"
+    else:
+        gps = (f"{int(record['latitude']) / COORDINATE_SCALE:.6f},"
+               f"{int(record['longitude']) / COORDINATE_SCALE:.6f}")
+    return [
+        format_timestamp(float(record['time'])),
+        format_number(record['temperature']),
+        format_number(record['ph']),
+        format_number(record['turbidity']),
+        gps,
+        notes_from_flags(flags),
+    ]
+
+
+def row_to_record(row):
+    """
+    Convert one CSV row to a record.
+
+    Returns:
+        tuple: (record, bool) where the bool is False if the Notes column
+        carried text that the flags cannot represent
+
+    Raises:
+        ValueError: If the row is too short or its timestamp is invalid
+    """
+    if len(row) < len(CSV_HEADER):
+        raise ValueError(f"Row has {len(row)} fields, expected at least {len(CSV_HEADER)}")
+    timestamp, temperature, ph, turbidity, gps, notes = row[:len(CSV_HEADER)]
+
+    def value(v):
+        number = parse_number(v)
+        return None if math.isnan(number) else number
+
+    record = make_record(
+        parse_timestamp(timestamp),
+        value(temperature),
+        value(ph),
+        value(turbidity),
+        None if gps == "NO FIX" else gps,
+        manual=notes.startswith("Manual reading")
+    )
+    return record, notes_from_flags(int(record['flags'])) == notes
+
+
+def csv_to_binary(csv_path, bin_path, chunk_size=10000, drop_columns=False):
+    """
+    Convert a CSV data file to a binary store.
+
+    Rows too short or with an invalid timestamp (e.g. torn by a power cut)
+    are skipped.
+
+    Args:
+        drop_columns: Import a file with columns the record cannot hold,
+            dropping their values and counting their rows as lossy
+
+    Returns:
+        tuple: (rows converted, rows with Notes text that was not
+        representable or values in dropped columns, rows skipped)
+
+    Raises:
+        ValueError: If the file has columns the record cannot hold and
+            drop_columns is False; nothing is written then
+    """
+    with open(csv_path, 'r', newline='') as f:
+        header = next(csv.reader(f), None) or []
+    unsupported = unsupported_columns(header)
+    if unsupported and not drop_columns:
+        raise ValueError(f"{csv_path} has columns the binary format cannot store: "
+                         f"{', '.join(unsupported)}")
+    dropped = {column for column, name in enumerate(header) if name in unsupported}
+
+    store = BinaryStore(bin_path)
+    rows = lossy = skipped = 0
+    chunk = np.empty(chunk_size, dtype=RECORD_DTYPE)
+    filled = 0
+    with open(csv_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Header
+        for row in reader:
+            if not row:
+                continue
+            try:
+                chunk[filled], exact = row_to_record(row)
+            except ValueError:
+                skipped += 1
+                continue
+            if any(row[column] for column in dropped if column < len(row)):
+                exact = False
+            filled += 1
+            rows += 1
+            lossy += not exact
+            if filled == chunk_size:
+                store.append(chunk)
+                filled = 0
+    if filled or rows == 0:
+        store.append(chunk[:filled])
+    return rows, lossy, skipped
+
+
+def unsupported_columns(header):
+    """Columns of a CSV data file header that the record cannot hold."""
+    return [name for name in header[len(CSV_HEADER):] if name not in DERIVED_COLUMNS]
+
+
+def binary_to_csv(bin_path, csv_path):
+    """
+    Convert a binary store to a CSV data file.
+
+    Returns:
+        int: Rows written
+    """
+    records = open_records(bin_path)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for record in records:
+            writer.writerow(record_to_row(record))
+    return len(records)
+
+
+def main():
+    """Command line CSV <-> binary conversion."""
+    parser = argparse.ArgumentParser(description="Convert PiAquaPulse data files")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="Convert CSV to binary")
+    import_parser.add_argument('csv_file')
+    import_parser.add_argument('bin_file')
+    import_parser.add_argument('--drop-columns', action='store_true',
+                               help="Import even if columns the binary format cannot store are lost")
+    export_parser = subparsers.add_parser('export', help="Convert binary to CSV")
+    export_parser.add_argument('bin_file')
+    export_parser.add_argument('csv_file')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        if os.path.exists(args.bin_file):
+            parser.error(f"{args.bin_file} already exists")
+        try:
+            rows, lossy, skipped = csv_to_binary(args.csv_file, args.bin_file,
+                                                 drop_columns=args.drop_columns)
+        except ValueError as e:
+            parser.error(f"{e}; use --drop-columns to import without them")
+        print(f"Imported {rows} rows into {args.bin_file}")
+        if lossy:
+            print(f"Warning: {lossy} rows had custom Notes text or values in dropped columns "
+                  f"that were not preserved")
+        if skipped:
+            print(f"Warning: skipped {skipped} malformed rows")
+    else:
+        rows = binary_to_csv(args.bin_file, args.csv_file)
+        print(f"Exported {rows} rows to {args.csv_file}")
+
+
+if __name__ == "__main__":
+    main()
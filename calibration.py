@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Sensor calibration versions and bulk recalibration
+
+The curves that turn pH and turbidity sensor voltages into values are kept
+as numbered versions in calibration.json. PAPScript.py converts readings
+with the current version and, alongside each converted value, logs the raw
+ADC counts, the voltage and the calibration version in extra data file
+columns. After a field recalibration the history can then be converted
+again with the new curves:
+
+    python3 calibration.py add --ph4 3.05 --ph7 2.58
+    python3 calibration.py add --turbidity -1120.4 5742.3 -4352.9 --clear-voltage 4.2
+    python3 calibration.py add --turbidity-points 2.5:3000 3.2:1500 3.9:400 4.2:0
+    python3 calibration.py recalibrate river_data.csv
+
+A version gives the pH sensor voltages at pH 4 and pH 7 (a straight line
+through both points) and the turbidity curve as polynomial coefficients in
+volts, highest power first, with 0 NTU above a clear-water voltage. The
+first version is created from PH_4_VOLTAGE / PH_7_VOLTAGE and the linear
+turbidity approximation PAPScript.py has always used.
+
+recalibrate streams the data file in chunks of lines, converts each
+chunk's voltage columns with NumPy and writes a new file that replaces the
+old one, so memory use does not depend on the size of the history. Rows
+logged before raw values were stored are copied unchanged. Stop the logger
+and uploader first, as rewriting the file moves the rows, and rebuild the
+rollups afterwards (python3 rollups.py rebuild).
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+import numpy as np
+
+from datastore import parse_numbers, write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# Raw value columns of each analog sensor: filtered ADC counts and volts
+RAW_COLUMNS = {
+    'ph': ('pH Raw (counts)', 'pH Voltage (V)'),
+    'turbidity': ('Turbidity Raw (counts)', 'Turbidity Voltage (V)'),
+}
+# Calibration version a row was converted with
+VERSION_COLUMN = 'Calibration'
+
+# Linear approximation of the SEN0189 curve: 3000 NTU at 0 V, 0 NTU at 2.5 V
+DEFAULT_TURBIDITY = {'coefficients': [-1200.0, 3000.0], 'clear_voltage': 2.5}
+
+# Valid range of each sensor's values; others are logged as errors
+PH_RANGE = (0.0, 14.0)
+TURBIDITY_RANGE = (0.0, 3000.0)
+
+# Lines converted at a time by recalibrate
+CHUNK_LINES = 20000
+
+
+class Calibration:
+    """One calibration version; converts scalars or NumPy arrays of volts."""
+    def __init__(self, version, ph, turbidity, created=None, note=''):
+        self.version = version
+        self.ph_points = dict(ph)
+        self.turbidity_curve = dict(turbidity)
+        self.created = created
+        self.note = note
+        self.ph_slope = (7.0 - 4.0) / (ph['ph7_voltage'] - ph['ph4_voltage'])
+        self.coefficients = np.asarray(turbidity['coefficients'], dtype=np.float64)
+
+    def ph(self, voltage):
+        """pH for sensor voltages, unrounded and unchecked."""
+        return 7.0 + self.ph_slope * (self.ph_points['ph7_voltage'] - np.asarray(voltage))
+
+    def turbidity(self, voltage):
+        """Turbidity in NTU for sensor voltages, unrounded and unchecked."""
+        voltage = np.asarray(voltage, dtype=np.float64)
+        ntu = np.polyval(self.coefficients, voltage)
+        return np.where(voltage > self.turbidity_curve['clear_voltage'], 0.0, ntu)
+
+    def to_json(self):
+        return {
+            'version': self.version,
+            'created': self.created,
+            'note': self.note,
+            'ph': self.ph_points,
+            'turbidity': self.turbidity_curve,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['version'], data['ph'], data['turbidity'],
+                   created=data.get('created'), note=data.get('note', ''))
+
+
+class CalibrationFile:
+    """All calibration versions in calibration.json; the newest is current."""
+    def __init__(self, path):
+        self.path = path
+        self.versions = {}
+
+    def load(self):
+        """
+        Read the versions from the file.
+
+        Returns:
+            bool: False if the file does not exist yet
+        """
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.versions = {entry['version']: Calibration.from_json(entry) for entry in data['versions']}
+        return True
+
+    def save(self):
+        write_json_atomic({'versions': [cal.to_json() for _, cal in sorted(self.versions.items())]},
+                          self.path, fsync=True)
+
+    @property
+    def current(self):
+        return self.versions[max(self.versions)] if self.versions else None
+
+    def add(self, ph=None, turbidity=None, note=''):
+        """
+        Add a new current version, taking unspecified curves from the current one.
+
+        Returns:
+            Calibration: The new version
+        """
+        current = self.current
+        calibration = Calibration(
+            max(self.versions, default=0) + 1,
+            ph if ph is not None else current.ph_points,
+            turbidity if turbidity is not None else current.turbidity_curve,
+            created=time.strftime('%Y-%m-%d %H:%M:%S'),
+            note=note
+        )
+        self.versions[calibration.version] = calibration
+        return calibration
+
+
+def load_calibration(path, ph4_voltage, ph7_voltage):
+    """
+    Current calibration, creating the file with a first version if needed.
+
+    Args:
+        path: calibration.json
+        ph4_voltage, ph7_voltage: pH calibration of the first version
+
+    Returns:
+        Calibration: The current version
+    """
+    calibrations = CalibrationFile(path)
+    if not calibrations.load() or not calibrations.versions:
+        calibrations.versions = {}
+        calibrations.versions[1] = Calibration(
+            1, {'ph4_voltage': ph4_voltage, 'ph7_voltage': ph7_voltage}, DEFAULT_TURBIDITY,
+            created=time.strftime('%Y-%m-%d %H:%M:%S'), note="Initial calibration")
+        calibrations.save()
+        logger.info(f"Created {path} with calibration version 1")
+    return calibrations.current
+
+
+def checked(values, valid_range):
+    """Format converted values as PAPScript.py does, with ERROR outside the valid range."""
+    low, high = valid_range
+    ok = ((values >= low) & (values <= high)).tolist()
+    return [str(value) if valid else 'ERROR'
+            for value, valid in zip(np.round(values, 2).tolist(), ok)]
+
+
+def fit_turbidity(points, degree=2):
+    """
+    Fit the turbidity polynomial to calibration standards.
+
+    Args:
+        points: (volts, NTU) pairs measured in standards
+        degree: Degree of the polynomial
+
+    Returns:
+        list: Coefficients, highest power first
+    """
+    voltages, ntu = zip(*points)
+    if len(points) <= degree:
+        raise ValueError(f"A degree {degree} fit needs at least {degree + 1} points")
+    return np.polyfit(voltages, ntu, degree).tolist()
+
+
+def recalibrate_lines(lines, columns, calibration):
+    """
+    Convert the pH and turbidity of a chunk of data rows again.
+
+    Only the pH, Turbidity and Calibration fields change, and only for
+    sensors with a stored voltage. Timestamp and temperature never contain
+    commas, and neither do the numeric columns after Notes, so the fields
+    are found by splitting at commas from the start and the end of a row
+    without parsing the quoted GPS and Notes fields.
+
+    Args:
+        lines: Data rows as bytes, without line endings
+        columns: Header of the data file, with the RAW_COLUMNS and
+            VERSION_COLUMN after Notes
+        calibration: Calibration to apply
+
+    Returns:
+        tuple: (rows as bytes, number of rows converted)
+    """
+    notes = columns.index('Notes')
+    tail = len(columns) - notes - 1
+    version_at = columns.index(VERSION_COLUMN) - notes - 1
+    voltage_at = {sensor: columns.index(names[1]) - notes - 1 for sensor, names in RAW_COLUMNS.items()}
+
+    rows = []  # (line number, head fields, tail fields)
+    for i, line in enumerate(lines):
+        head = line.split(b',', 4)
+        if len(head) == 5:
+            parts = head[4].rsplit(b',', tail)
+            if len(parts) == tail + 1:
+                rows.append((i, head, parts))
+    if not rows:
+        return lines, 0
+
+    converted = {}
+    for sensor, at in voltage_at.items():
+        voltages = parse_numbers([parts[at + 1] or b'nan' for _, _, parts in rows])
+        if sensor == 'ph':
+            values = checked(calibration.ph(voltages), PH_RANGE)
+        else:
+            values = checked(calibration.turbidity(voltages), TURBIDITY_RANGE)
+        converted[sensor] = (~np.isnan(voltages), values)
+
+    version = str(calibration.version).encode('ascii')
+    out = list(lines)
+    count = 0
+    for j, (i, head, parts) in enumerate(rows):
+        changed = False
+        for sensor, field in (('ph', 2), ('turbidity', 3)):
+            has_voltage, values = converted[sensor]
+            if has_voltage[j]:
+                head[field] = values[j].encode('ascii')
+                changed = True
+        if changed:
+            parts[version_at + 1] = version
+            head[4] = b','.join(parts)
+            out[i] = b','.join(head)
+            count += 1
+    return out, count
+
+
+def recalibrate_file(path, calibration, output=None, chunk_lines=CHUNK_LINES):
+    """
+    Convert the pH and turbidity history of a data file again.
+
+    The file is streamed chunk_lines rows at a time into a new file, which
+    then replaces it (or is written to output). Partitions compressed with
+    one of partitions.COMPRESSIONS (gzip, zstd) are decompressed on the fly
+    and recompressed the same way.
+
+    Returns:
+        tuple: (rows read, rows converted)
+    """
+    from partitions import COMPRESSIONS, open_partition, compress_file
+    compression = next((name for name, suffix in COMPRESSIONS.items() if path.endswith(suffix)), None)
+    plain = path[:-len(COMPRESSIONS[compression])] if compression else path
+    target = output or path
+    partial = plain + '.recalibrating'
+    rows = converted = 0
+    with open_partition(path) as source:
+        header = source.readline()
+        columns = next(csv.reader([header.decode('utf-8')]), [])
+        missing = [name for name in [VERSION_COLUMN] + [n for names in RAW_COLUMNS.values() for n in names]
+                   if name not in columns]
+        if missing or 'Notes' not in columns:
+            logger.warning(f"{path} has no raw value columns, left unchanged")
+            return 0, 0
+        with open(partial, 'wb') as f:
+            f.write(header)
+            pending = b''
+            while True:
+                lines = source.readlines(chunk_lines * 96)
+                if not lines:
+                    break
+                lines[0] = pending + lines[0]
+                pending = b''
+                if not lines[-1].endswith(b'\n'):
+                    pending = lines.pop()  # Partial last row, only at the end of the file
+                    if not lines:
+                        continue
+                stripped = [line.rstrip(b'\r\n') for line in lines]
+                out, count = recalibrate_lines(stripped, columns, calibration)
+                f.write(b'\n'.join(out) + b'\n')
+                rows += len(out)
+                converted += count
+            f.write(pending)
+    if compression:
+        partial = compress_file(partial, compression)
+    os.replace(partial, target)
+    return rows, converted
+
+
+def main():
+    """Manage calibration versions and recalibrate history."""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description="PiAquaPulse sensor calibration")
+    parser.add_argument('--file', default='calibration.json', help="Calibration versions file")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('show', help="List calibration versions")
+    add_parser = subparsers.add_parser('add', help="Add a calibration version and make it current")
+    add_parser.add_argument('--ph4', type=float, help="pH sensor voltage in pH 4 buffer")
+    add_parser.add_argument('--ph7', type=float, help="pH sensor voltage in pH 7 buffer")
+    add_parser.add_argument('--turbidity', type=float, nargs='+', metavar='COEFFICIENT',
+                            help="Turbidity polynomial in volts, highest power first")
+    add_parser.add_argument('--turbidity-points', nargs='+', metavar='VOLTS:NTU',
+                            help="Fit the turbidity polynomial to readings in standards")
+    add_parser.add_argument('--degree', type=int, default=2, help="Degree of the fitted polynomial")
+    add_parser.add_argument('--clear-voltage', type=float,
+                            help="Voltage above which the water reads 0 NTU")
+    add_parser.add_argument('--note', default='')
+    recalibrate_parser = subparsers.add_parser('recalibrate', help="Convert data files again")
+    recalibrate_parser.add_argument('data_files', nargs='+', help="CSV data files or partitions")
+    recalibrate_parser.add_argument('--version', type=int, help="Calibration version (default: current)")
+    recalibrate_parser.add_argument('--output', help="Write here instead of replacing a single data file")
+    recalibrate_parser.add_argument('--chunk-lines', type=int, default=CHUNK_LINES)
+    args = parser.parse_args()
+
+    calibrations = CalibrationFile(args.file)
+    if not calibrations.load() and args.command != 'show':
+        parser.error(f"{args.file} does not exist; it is created when PAPScript.py first runs")
+
+    if args.command == 'show':
+        for version, cal in sorted(calibrations.versions.items()):
+            print(f"{version}: {cal.created}  pH 4 at {cal.ph_points['ph4_voltage']} V, "
+                  f"pH 7 at {cal.ph_points['ph7_voltage']} V; turbidity {cal.turbidity_curve['coefficients']} "
+                  f"(0 NTU above {cal.turbidity_curve['clear_voltage']} V)  {cal.note}")
+    elif args.command == 'add':
+        current = calibrations.current
+        ph = dict(current.ph_points)
+        if args.ph4 is not None:
+            ph['ph4_voltage'] = args.ph4
+        if args.ph7 is not None:
+            ph['ph7_voltage'] = args.ph7
+        turbidity = dict(current.turbidity_curve)
+        if args.turbidity:
+            turbidity['coefficients'] = args.turbidity
+        elif args.turbidity_points:
+            try:
+                points = [tuple(float(v) for v in point.split(':')) for point in args.turbidity_points]
+                turbidity['coefficients'] = fit_turbidity(points, args.degree)
+            except ValueError as e:
+                parser.error(f"Invalid turbidity points: {e}")
+            print(f"Fitted turbidity polynomial: {turbidity['coefficients']}")
+        if args.clear_voltage is not None:
+            turbidity['clear_voltage'] = args.clear_voltage
+        if ph['ph4_voltage'] == ph['ph7_voltage']:
+            parser.error("The pH 4 and pH 7 voltages must differ")
+        calibration = calibrations.add(ph, turbidity, args.note)
+        calibrations.save()
+        print(f"Added calibration version {calibration.version}; restart PAPScript.py to use it")
+    else:
+        if args.output and len(args.data_files) > 1:
+            parser.error("--output needs a single data file")
+        version = args.version or max(calibrations.versions)
+        if version not in calibrations.versions:
+            parser.error(f"No calibration version {version}")
+        calibration = calibrations.versions[version]
+        for path in args.data_files:
+            started = time.perf_counter()
+            rows, converted = recalibrate_file(path, calibration, args.output, args.chunk_lines)
+            print(f"{path}: {converted} of {rows} rows converted with calibration version "
+                  f"{version} in {time.perf_counter() - started:.1f} s")
+        print("Rebuild the rollups with: python3 rollups.py rebuild <data file>")
+
+
+if __name__ == "__main__":
+    main()
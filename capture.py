@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - High-rate waveform capture
+
+A logged pH or turbidity value is a filtered average of a short ADC burst,
+which hides events lasting less than a reading interval: sediment pulses,
+bubbles passing the turbidity sensor, the pH probe settling. A waveform
+capture instead streams one or more MCP3008 channels, interleaved, as fast
+as the ADC can be read for a fixed time and keeps every sample.
+
+Samples go into a small pool of buffers allocated once up front. When a
+buffer is full the sampling loop hands it to a writer thread and carries
+on in the next free one, so file I/O never stalls sampling. The writer
+copies each buffer into its own memory-mapped .npy segment:
+
+    captures/20240601-141503/
+        capture.json        channels, start time, rate, segments, summary
+        samples-0000.npy    uint16 ADC counts, one row per round, one column per channel
+        times-0000.npy      monotonic time at the start of each block of rounds
+        ...
+
+Block times show the achieved rate and any gap, e.g. if every buffer was
+still waiting to be written. A summary of each channel (spectral power in
+frequency bands, largest excursion from the median and the time the
+signal took to settle) is computed from the segments once the capture
+ends, stored in capture.json and appended as rows to captures/captures.csv.
+PAPScript.py logs the capture as an ordinary reading whose Notes name the
+capture, so the data file links to it.
+
+Summaries can be recomputed, e.g. with other frequency bands:
+
+    python3 capture.py summarize captures/20240601-141503 --bands 0:1 1:10 10:100
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import os
+import csv
+import json
+import time
+import queue
+import logging
+import argparse
+import datetime
+import threading
+import numpy as np
+
+from datastore import write_json_atomic
+from adc_sampling import MAD_TO_SIGMA
+
+logger = logging.getLogger(__name__)
+
+# Index of all captures and their summaries, in the capture directory
+INDEX_FILE = 'captures.csv'
+
+# Rounds between block timestamps
+BLOCK_ROUNDS = 256
+
+# Default frequency bands of the summary in Hz, (low, high]
+BANDS = ((0.0, 1.0), (1.0, 10.0), (10.0, 100.0), (100.0, 1000.0))
+
+# Fraction of the samples at the end of a capture taken as its final level
+SETTLED_FRACTION = 0.1
+
+# MCP3008 counts to volts (10 bits over a 3.3 V reference)
+VOLTS_PER_COUNT = 3.3 / 1023.0
+
+
+def capture_id(when):
+    """Name of a capture started at epoch seconds when (local time)."""
+    return datetime.datetime.fromtimestamp(when).strftime('%Y%m%d-%H%M%S')
+
+
+class WaveformRecorder:
+    """
+    Record interleaved ADC samples into memory-mapped .npy segments.
+
+    The buffers are allocated once and reused by every capture; the
+    sampling loop only stores samples and a timestamp per block of rounds.
+    """
+    def __init__(self, adc, channels, segment_rounds=65536, buffers=3, lock=None):
+        """
+        Args:
+            adc: Object with a read_adc(channel) method (e.g. Adafruit_MCP3008.MCP3008)
+            channels: Sequence of channel numbers to sample
+            segment_rounds: Sampling rounds per buffer and segment file
+                (rounded up to whole blocks)
+            buffers: Buffers in the pool; more absorb slower writes
+            lock: Lock guarding the ADC bus, held for the whole capture
+        """
+        self.adc = adc
+        self.channels = list(channels)
+        self.blocks = -(-segment_rounds // BLOCK_ROUNDS)
+        self.segment_rounds = self.blocks * BLOCK_ROUNDS
+        self.lock = lock or threading.Lock()
+        self.samples = [np.empty((self.segment_rounds, len(self.channels)), dtype=np.uint16)
+                        for _ in range(buffers)]
+        self.times = [np.empty(self.blocks + 1, dtype=np.float64) for _ in range(buffers)]
+
+    def record(self, duration, directory):
+        """
+        Capture all channels for duration seconds.
+
+        Args:
+            duration: Seconds to sample for
+            directory: New directory for the segment files
+
+        Returns:
+            dict: Capture metadata, as saved in capture.json
+        """
+        os.makedirs(directory, exist_ok=True)
+        free = queue.Queue()
+        for i in range(len(self.samples)):
+            free.put(i)
+        full = queue.Queue()
+        segments = []
+        writer = threading.Thread(target=self._write_segments, args=(directory, full, free, segments),
+                                  name="capture-writer", daemon=True)
+        writer.start()
+
+        read_adc = self.adc.read_adc
+        channels = self.channels
+        stalls = rounds = 0
+        started = time.time()
+        try:
+            with self.lock:
+                begin = time.monotonic()
+                deadline = begin + duration
+                now = begin
+                while now < deadline:
+                    try:
+                        index = free.get_nowait()
+                    except queue.Empty:
+                        stalls += 1  # Every buffer is waiting to be written
+                        index = free.get()
+                    # Flat view: one store per sample, no row views
+                    flat = self.samples[index].reshape(-1)
+                    times = self.times[index]
+                    position = block = 0
+                    while block < self.blocks and now < deadline:
+                        times[block] = now
+                        end = position + BLOCK_ROUNDS * len(channels)
+                        while position < end:
+                            for channel in channels:
+                                flat[position] = read_adc(channel)
+                                position += 1
+                        block += 1
+                        now = time.monotonic()
+                    times[block] = now
+                    full.put((index, block))
+                    rounds += block * BLOCK_ROUNDS
+        finally:
+            full.put(None)
+            writer.join()
+
+        elapsed = now - begin
+        metadata = {
+            'id': os.path.basename(os.path.normpath(directory)),
+            'start': started,
+            'channels': self.channels,
+            'duration': elapsed,
+            'rounds': rounds,
+            'rate': rounds / elapsed if elapsed > 0 else 0.0,
+            'block_rounds': BLOCK_ROUNDS,
+            'stalls': stalls,
+            'segments': segments,
+        }
+        if stalls:
+            logger.warning(f"Capture {metadata['id']} waited {stalls} times for a buffer to be written")
+        write_json_atomic(metadata, os.path.join(directory, 'capture.json'))
+        return metadata
+
+    def _write_segments(self, directory, full, free, segments):
+        while True:
+            item = full.get()
+            if item is None:
+                return
+            index, blocks = item
+            number = len(segments)
+            name = f'samples-{number:04d}.npy'
+            try:
+                rounds = blocks * BLOCK_ROUNDS
+                segment = np.lib.format.open_memmap(os.path.join(directory, name), mode='w+',
+                                                    dtype=np.uint16, shape=(rounds, len(self.channels)))
+                segment[:] = self.samples[index][:rounds]
+                segment.flush()
+                del segment
+                np.save(os.path.join(directory, f'times-{number:04d}.npy'), self.times[index][:blocks + 1])
+                segments.append(name)
+            except Exception as e:
+                logger.error(f"Error writing capture segment {name}: {e}")
+            finally:
+                free.put(index)
+
+
+def load_capture(directory):
+    """
+    Open a capture's samples without reading them into memory.
+
+    Returns:
+        tuple: (metadata, list of (samples memmap, block times) per segment)
+    """
+    with open(os.path.join(directory, 'capture.json'), 'r') as f:
+        metadata = json.load(f)
+    segments = []
+    for name in metadata['segments']:
+        samples = np.load(os.path.join(directory, name), mmap_mode='r')
+        times = np.load(os.path.join(directory, name.replace('samples-', 'times-')))
+        segments.append((samples, times))
+    return metadata, segments
+
+
+def sample_times(segments, block_rounds, start):
+    """Seconds since start of every round, interpolated within each block."""
+    times = []
+    for samples, block_times in segments:
+        rounds = np.arange(len(samples) + 1)[::block_rounds]
+        times.append(np.interp(np.arange(len(samples)), rounds, block_times) - start)
+    return np.concatenate(times) if times else np.empty(0)
+
+
+def band_powers(volts, rate, bands):
+    """
+    Power of a signal in each frequency band, in V², by Welch's method.
+
+    The signal is first averaged down to about four times the highest
+    band edge. It is then cut into frames long enough to resolve the
+    narrowest band (or as long as the capture allows), which are
+    detrended, Hann-windowed and transformed together. A band's power is
+    the averaged one-sided power spectral density summed over the band.
+
+    Returns:
+        list: Power per band, None for bands above the Nyquist frequency
+    """
+    factor = max(int(rate / (4 * max(high for _, high in bands))), 1)
+    count = len(volts) // factor
+    if count < 2:
+        return [None] * len(bands)
+    volts = volts[:count * factor].reshape(count, factor).mean(axis=1)
+    rate = rate / factor
+    resolution = min(high - low for low, high in bands) / 4
+    size = min(2 ** int(np.ceil(np.log2(rate / resolution))), 2 ** int(np.log2(count)))
+    frames = volts[:count // size * size].reshape(-1, size)
+    frames = frames - frames.mean(axis=1, keepdims=True)
+    window = np.hanning(size)
+    spectrum = (np.abs(np.fft.rfft(frames * window, axis=1)) ** 2).mean(axis=0)
+    density = spectrum * 2.0 / (rate * np.sum(window ** 2))
+    frequencies = np.fft.rfftfreq(size, 1.0 / rate)
+    return [float(density[(frequencies > low) & (frequencies <= high)].sum() * rate / size)
+            if low < rate / 2 else None for low, high in bands]
+
+
+def settle_time(volts, times, block_rounds, tolerance):
+    """
+    Seconds until a signal stays near its final level.
+
+    The test runs on means of blocks of rounds, so single noisy samples do
+    not count, and the tolerance is widened to four robust standard
+    deviations of the final level's block means for noisy signals.
+
+    Returns:
+        float: Start time of the first block from which every block is
+        within tolerance, or None if the last block is not
+    """
+    blocks = len(volts) // block_rounds
+    if not blocks:
+        return None
+    means = volts[:blocks * block_rounds].reshape(blocks, block_rounds).mean(axis=1)
+    tail = means[-max(int(blocks * SETTLED_FRACTION), 1):]
+    final = np.median(tail)
+    noise = MAD_TO_SIGMA * np.median(np.abs(tail - final))
+    outside = np.flatnonzero(np.abs(means - final) > max(tolerance, 4 * noise))
+    if not len(outside):
+        return 0.0
+    if outside[-1] == blocks - 1:
+        return None  # Still moving at the end
+    return float(times[(outside[-1] + 1) * block_rounds])
+
+
+def summarize(directory, bands=BANDS, settle_tolerance=0.01):
+    """
+    Summarize each channel of a capture and save the summary in capture.json.
+
+    Args:
+        directory: Capture directory
+        bands: (low, high] frequency bands in Hz for the band powers
+        settle_tolerance: Volts from the final level within which the
+            signal counts as settled (at least)
+
+    Returns:
+        dict: Capture metadata with a 'summary' entry per channel: mean,
+        median and peak in volts, time of the peak, settle time in seconds
+        (None if the signal had not settled by the end) and band powers
+    """
+    metadata, segments = load_capture(directory)
+    rate = metadata['rate']
+    begin = segments[0][1][0] if segments else 0.0
+    times = sample_times(segments, metadata['block_rounds'], begin)
+    summary = {}
+    for column, channel in enumerate(metadata['channels']):
+        if not segments:
+            continue
+        volts = np.concatenate([samples[:, column] for samples, _ in segments]) * VOLTS_PER_COUNT
+        median = float(np.median(volts))
+        peak = int(np.argmax(np.abs(volts - median)))
+        summary[str(channel)] = {
+            'mean': float(volts.mean()),
+            'median': median,
+            'peak': float(volts[peak]),
+            'peak_time': float(times[peak]),
+            'settle_time': settle_time(volts, times, metadata['block_rounds'], settle_tolerance),
+            'band_power': {f'{low:g}-{high:g}': power for (low, high), power
+                           in zip(bands, band_powers(volts, rate, bands))},
+        }
+    metadata['summary'] = summary
+    write_json_atomic(metadata, os.path.join(directory, 'capture.json'))
+    return metadata
+
+
+def append_index(capture_dir, metadata, reading_timestamp=None):
+    """
+    Add a capture's summary to captures.csv, one row per channel.
+
+    Args:
+        capture_dir: Directory holding the captures and the index
+        metadata: Summarized capture metadata
+        reading_timestamp: Timestamp of the data file row logged with the capture
+    """
+    path = os.path.join(capture_dir, INDEX_FILE)
+    bands = []
+    for channel_summary in metadata['summary'].values():
+        bands = list(channel_summary['band_power'])
+        break
+    header = (['Capture', 'Timestamp', 'Channel', 'Rounds', 'Rate (Hz)', 'Stalls', 'Mean (V)',
+               'Peak (V)', 'Peak Time (s)', 'Settle Time (s)']
+              + [f'Power {band} Hz (V²)' for band in bands])
+
+    def number(value, digits):
+        return "" if value is None else round(value, digits)
+
+    new = not os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(header)
+        for channel, s in metadata['summary'].items():
+            writer.writerow([metadata['id'], reading_timestamp or capture_id(metadata['start']),
+                             channel, metadata['rounds'], round(metadata['rate'], 1),
+                             metadata['stalls'], number(s['mean'], 4), number(s['peak'], 4),
+                             number(s['peak_time'], 4), number(s['settle_time'], 4)]
+                            + [number(s['band_power'][band], 9) for band in bands])
+
+
+def main():
+    """Recompute the summary of a capture."""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description="PiAquaPulse waveform captures")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summarize_parser = subparsers.add_parser('summarize', help="Summarize a capture again")
+    summarize_parser.add_argument('directory', help="Capture directory")
+    summarize_parser.add_argument('--bands', nargs='+', metavar='LOW:HIGH',
+                                  help="Frequency bands in Hz")
+    summarize_parser.add_argument('--settle-tolerance', type=float, default=0.01,
+                                  help="Volts from the final level counted as settled")
+    args = parser.parse_args()
+
+    bands = BANDS
+    if args.bands:
+        try:
+            bands = [tuple(float(v) for v in band.split(':')) for band in args.bands]
+        except ValueError:
+            parser.error("Bands must be given as LOW:HIGH")
+    metadata = summarize(args.directory, bands, args.settle_tolerance)
+    print(f"{metadata['id']}: {metadata['rounds']} rounds at {metadata['rate']:.0f} Hz, "
+          f"{metadata['stalls']} buffer stalls")
+    for channel, s in metadata['summary'].items():
+        settle = "not settled" if s['settle_time'] is None else f"settled after {s['settle_time']:.3f} s"
+        powers = ", ".join(f"{band} Hz {'n/a' if power is None else f'{power:.3g}'} V²"
+                           for band, power in s['band_power'].items())
+        print(f"  channel {channel}: mean {s['mean']:.4f} V, peak {s['peak']:.4f} V "
+              f"at {s['peak_time']:.3f} s, {settle}; {powers}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Fleet collector store
+
+Readings uploaded by many stations (see uploader.py) are kept in one SQLite
+database, indexed by station and time. dashapp.py serves it in collector
+mode:
+
+    python3 dashapp.py --collector fleet.db
+
+Uploaded batches are queued and inserted by a single writer thread, which
+commits everything queued so far in one transaction with executemany(), so
+the cost of a commit is shared by all the batches that arrived while the
+previous one was being written. A request is only answered once its batch
+is committed, and batches are remembered by their idempotency key, so a
+retried upload is never stored twice.
+
+Simulated stations can generate load against a running collector:
+
+    python3 collector.py simulate --url http://127.0.0.1:5000/ingest --stations 50
+
+Timestamps are uploaded as the station's local time and are interpreted in
+the collector's local time zone.
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import json
+import time
+import queue
+import random
+import sqlite3
+import logging
+import argparse
+import threading
+import http.client
+import urllib.parse
+import numpy as np
+
+from datastore import parse_timestamps, parse_numbers, format_timestamp, NUMERIC_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+    station TEXT NOT NULL,
+    time REAL NOT NULL,
+    temperature REAL,
+    ph REAL,
+    turbidity REAL,
+    latitude REAL,
+    longitude REAL,
+    notes TEXT
+);
+CREATE INDEX IF NOT EXISTS readings_station_time ON readings (station, time);
+CREATE TABLE IF NOT EXISTS stations (
+    station TEXT PRIMARY KEY,
+    time REAL,
+    temperature REAL,
+    ph REAL,
+    turbidity REAL,
+    latitude REAL,
+    longitude REAL,
+    readings INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS batches (
+    key TEXT PRIMARY KEY,
+    station TEXT NOT NULL,
+    received REAL NOT NULL,
+    rows INTEGER NOT NULL
+);
+"""
+
+# Data file column names of the uploaded fields
+COLUMN_NAMES = {
+    'time': 'Timestamp',
+    'temperature': 'Temperature (°C)',
+    'ph': 'pH',
+    'turbidity': 'Turbidity (NTU)',
+    'gps': 'GPS Location',
+    'notes': 'Notes',
+}
+
+
+class BatchError(ValueError):
+    """An uploaded batch that cannot be stored."""
+
+
+def parse_batch(batch):
+    """
+    Convert an uploaded batch to insert parameters.
+
+    Args:
+        batch: Decoded request body: {'station', 'columns', 'rows'}
+
+    Returns:
+        tuple: (station, list of readings rows as tuples in table column order)
+
+    Raises:
+        BatchError: If the batch is malformed
+    """
+    try:
+        station = str(batch['station'])
+        columns = list(batch['columns'])
+        rows = batch['rows']
+    except (KeyError, TypeError) as e:
+        raise BatchError(f"Missing field {e}")
+    if not station:
+        raise BatchError("Empty station ID")
+    if not all(isinstance(column, str) for column in columns):
+        raise BatchError("Columns must be strings")
+    if not isinstance(rows, list) or not all(
+            isinstance(row, list) and all(isinstance(field, str) for field in row) for row in rows):
+        raise BatchError("Rows must be lists of strings")
+    try:
+        positions = {name: columns.index(column) for name, column in COLUMN_NAMES.items()
+                     if column in columns}
+    except ValueError as e:
+        raise BatchError(str(e))
+    if 'time' not in positions:
+        raise BatchError("Batch has no Timestamp column")
+    if not rows:
+        return station, []
+
+    def column(name):
+        index = positions.get(name)
+        if index is None:
+            return [b''] * len(rows)
+        return [row[index].encode('utf-8') if index < len(row) else b'' for row in rows]
+
+    try:
+        times = parse_timestamps(column('time'))
+    except ValueError as e:
+        raise BatchError(f"Invalid timestamp: {e}")
+    values = {name: parse_numbers(column(name)) for name in NUMERIC_COLUMNS}
+    latitudes = np.full(len(rows), np.nan)
+    longitudes = np.full(len(rows), np.nan)
+    for i, gps in enumerate(column('gps')):
+        lat, _, lon = gps.partition(b',')
+        try:
+            latitudes[i], longitudes[i] = float(lat), float(lon)
+        except ValueError:
+            pass  # NO FIX
+    notes = [value.decode('utf-8') for value in column('notes')]
+
+    def nullable(array):
+        return [None if np.isnan(v) else v for v in array.tolist()]
+
+    params = list(zip([station] * len(rows), times.tolist(),
+                      nullable(values['temperature']), nullable(values['ph']),
+                      nullable(values['turbidity']), nullable(latitudes), nullable(longitudes),
+                      notes))
+    return station, params
+
+
+class _Pending:
+    """A batch waiting for the writer thread."""
+    def __init__(self, key, station, params):
+        self.key = key
+        self.station = station
+        self.params = params
+        self.done = threading.Event()
+        self.stored = False
+        self.error = None
+
+
+class FleetStore:
+    """
+    Readings of many stations in one SQLite database.
+
+    Writes go through one writer thread with group commit; reads use a
+    connection per thread and run concurrently with writes (WAL mode).
+    """
+    def __init__(self, path, max_batches_per_commit=256):
+        self.path = path
+        self.max_batches_per_commit = max_batches_per_commit
+        self.local = threading.local()
+        self.queue = queue.Queue()
+        self.commits = 0
+        self.rows_stored = 0
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+        self.thread = threading.Thread(target=self._run, name="fleet-writer", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _reader(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = self._connect()
+        return db
+
+    def ingest(self, key, station, params, timeout=30.0):
+        """
+        Store one uploaded batch and wait until it is committed.
+
+        Args:
+            key: Idempotency key, or None
+            station: Station ID
+            params: Reading rows from parse_batch()
+
+        Returns:
+            bool: True if stored, False if a batch with this key was already stored
+
+        Raises:
+            TimeoutError: If the writer did not commit in time
+        """
+        pending = _Pending(key, station, params)
+        self.queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise TimeoutError("Batch was not committed in time")
+        if pending.error:
+            raise pending.error
+        return pending.stored
+
+    def _run(self):
+        db = self._connect()
+        while True:
+            group = [self.queue.get()]
+            # Everything that queued up while the last commit ran goes in this one
+            while len(group) < self.max_batches_per_commit:
+                try:
+                    group.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(db, group)
+                for pending in group:
+                    pending.done.set()
+            except Exception as e:
+                logger.error(f"Error storing {len(group)} batches: {e}")
+                for pending in group:
+                    pending.error = e
+                    pending.done.set()
+
+    def _commit(self, db, group):
+        now = time.time()
+        rows = []
+        stations = {}
+        seen = set()
+        with db:
+            for pending in group:
+                if pending.key is not None:
+                    if pending.key in seen:
+                        continue
+                    cursor = db.execute(
+                        "INSERT OR IGNORE INTO batches (key, station, received, rows) VALUES (?, ?, ?, ?)",
+                        (pending.key, pending.station, now, len(pending.params)))
+                    if cursor.rowcount == 0:
+                        continue  # Already stored
+                    seen.add(pending.key)
+                pending.stored = True
+                rows.extend(pending.params)
+                if pending.params:
+                    summary = stations.setdefault(pending.station, [0, None])
+                    summary[0] += len(pending.params)
+                    latest = max(pending.params, key=lambda row: row[1])
+                    if summary[1] is None or latest[1] >= summary[1][1]:
+                        summary[1] = latest
+            db.executemany("INSERT INTO readings VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            for station, (count, latest) in stations.items():
+                db.execute("""
+                    INSERT INTO stations (station, time, temperature, ph, turbidity,
+                                          latitude, longitude, readings)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (station) DO UPDATE SET
+                        readings = readings + excluded.readings,
+                        time = CASE WHEN excluded.time >= IFNULL(time, excluded.time)
+                                    THEN excluded.time ELSE time END,
+                        temperature = CASE WHEN excluded.time >= IFNULL(time, excluded.time)
+                                           THEN excluded.temperature ELSE temperature END,
+                        ph = CASE WHEN excluded.time >= IFNULL(time, excluded.time)
+                                  THEN excluded.ph ELSE ph END,
+                        turbidity = CASE WHEN excluded.time >= IFNULL(time, excluded.time)
+                                         THEN excluded.turbidity ELSE turbidity END,
+                        latitude = CASE WHEN excluded.time >= IFNULL(time, excluded.time)
+                                             AND excluded.latitude IS NOT NULL
+                                        THEN excluded.latitude ELSE latitude END,
+                        longitude = CASE WHEN excluded.time >= IFNULL(time, excluded.time)
+                                              AND excluded.longitude IS NOT NULL
+                                         THEN excluded.longitude ELSE longitude END
+                """, latest[:7] + (count,))
+        self.commits += 1
+        self.rows_stored += len(rows)
+
+    def stations(self):
+        """
+        Latest reading and last known position of every station.
+
+        Returns:
+            list: Dicts sorted by station ID
+        """
+        cursor = self._reader().execute(
+            "SELECT station, time, temperature, ph, turbidity, latitude, longitude, readings "
+            "FROM stations ORDER BY station")
+        return [station_dict(row) for row in cursor]
+
+    def latest(self, station):
+        """Latest reading of one station, or None if it is unknown."""
+        row = self._reader().execute(
+            "SELECT station, time, temperature, ph, turbidity, latitude, longitude, readings "
+            "FROM stations WHERE station = ?", (station,)).fetchone()
+        return station_dict(row) if row else None
+
+    def history(self, station, start=None, end=None):
+        """
+        Readings of one station between start and end.
+
+        Returns:
+            dict: 'time' and NUMERIC_COLUMNS numpy arrays, NaN for sensor errors
+        """
+        cursor = self._reader().execute(
+            "SELECT time, temperature, ph, turbidity FROM readings "
+            "WHERE station = ? AND time >= ? AND time <= ? ORDER BY time",
+            (station, -np.inf if start is None else start, np.inf if end is None else end))
+        data = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 4)
+        result = {'time': data[:, 0]}
+        for i, name in enumerate(NUMERIC_COLUMNS, start=1):
+            result[name] = data[:, i]
+        return result
+
+    def close(self):
+        """Close this thread's read connection."""
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+def station_dict(row):
+    """Row of the stations table as served to the browser."""
+    station, time_, temperature, ph, turbidity, latitude, longitude, readings = row
+    return {
+        'station': station,
+        'timestamp': format_timestamp(time_) if time_ is not None else None,
+        'time': time_,
+        'temperature': temperature,
+        'pH': ph,
+        'turbidity': turbidity,
+        'latitude': latitude,
+        'longitude': longitude,
+        'readings': readings,
+    }
+
+
+def simulate(url, stations, rate, batch_size, duration, seed=None):
+    """
+    Post readings from simulated stations to a collector.
+
+    Each station runs on its own thread with a kept-alive connection and
+    uploads batches of batch_size readings, rate readings per second in
+    total across all stations.
+
+    Returns:
+        dict: Readings and batches sent, failures and achieved readings/s
+    """
+    from uploader import encode_batch
+    parts = urllib.parse.urlsplit(url)
+    columns = list(COLUMN_NAMES.values())
+    interval = batch_size * stations / rate if rate else 0
+    stats = {'readings': 0, 'batches': 0, 'failures': 0}
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+    rng = random.Random(seed)
+
+    def station(name, seed):
+        rng = random.Random(seed)
+        latitude = 51.9 + rng.uniform(-0.5, 0.5)
+        longitude = -2.08 + rng.uniform(-0.5, 0.5)
+        temperature, ph, turbidity = rng.uniform(8, 18), rng.uniform(6.5, 8), rng.uniform(5, 300)
+        clock = time.time() - 86400
+        connection = http.client.HTTPConnection(parts.netloc, timeout=30)
+        next_time = time.monotonic()
+        while time.monotonic() < stop:
+            rows = []
+            for _ in range(batch_size):
+                clock += 1
+                temperature += rng.gauss(0, 0.02)
+                ph += rng.gauss(0, 0.005)
+                turbidity = max(turbidity + rng.gauss(0, 1), 0)
+                rows.append([format_timestamp(clock), f"{temperature:.2f}", f"{ph:.2f}",
+                             f"{turbidity:.2f}", f"{latitude:.6f},{longitude:.6f}", "Auto reading"])
+            body = encode_batch(name, columns, rows)
+            headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip',
+                       'Idempotency-Key': f"{name}-{clock:.0f}"}
+            try:
+                connection.request('POST', parts.path or '/', body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                ok = 200 <= response.status < 300
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                ok = False
+            with lock:
+                if ok:
+                    stats['readings'] += len(rows)
+                    stats['batches'] += 1
+                else:
+                    stats['failures'] += 1
+            if interval:
+                next_time += interval
+                time.sleep(max(next_time - time.monotonic(), 0))
+        connection.close()
+
+    threads = [threading.Thread(target=station, args=(f"sim-{i:03d}", rng.random()), daemon=True)
+               for i in range(stations)]
+    began = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - began
+    stats['seconds'] = elapsed
+    stats['readings_per_second'] = stats['readings'] / elapsed
+    return stats
+
+
+def main():
+    """Generate load from simulated stations."""
+    parser = argparse.ArgumentParser(description="PiAquaPulse fleet collector tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    simulate_parser = subparsers.add_parser('simulate', help="Upload readings from simulated stations")
+    simulate_parser.add_argument('--url', default='http://127.0.0.1:5000/ingest')
+    simulate_parser.add_argument('--stations', type=int, default=20)
+    simulate_parser.add_argument('--rate', type=float, default=0,
+                                 help="Total readings per second (0 = as fast as possible)")
+    simulate_parser.add_argument('--batch-size', type=int, default=100)
+    simulate_parser.add_argument('--duration', type=float, default=10.0, help="Seconds to run")
+    simulate_parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    stats = simulate(args.url, args.stations, args.rate, args.batch_size, args.duration, args.seed)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
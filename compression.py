@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Reading compression
+
+On a stable river most readings differ from the previous ones by no more
+than sensor noise. With compression enabled (CONFIG['COMPRESSION']),
+PAPScript.py passes each reading through a ReadingCompressor, which only
+lets through the readings needed to reconstruct every channel within its
+tolerance:
+
+    deadband       A reading is stored when a channel moved more than its
+                   tolerance from the last stored reading. Readings in
+                   between are reconstructed by holding the last stored value.
+
+    swinging_door  A reading is stored when no straight line from the last
+                   stored reading can pass within tolerance of all readings
+                   since. Readings in between are reconstructed by linear
+                   interpolation between the stored readings.
+
+Rows are stored whole, so a reading is stored when any channel needs it.
+Readings that differ in their notes (manual readings, sensor errors, a lost
+GPS fix) are always stored, and a reading is stored at least every
+max_silence seconds. reconstruct() rebuilds the series at any times from the
+stored readings.
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import math
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+METHODS = ('deadband', 'swinging_door')
+
+
+class _Door:
+    """Range of slopes from the last stored value that pass within tolerance
+    of every value taken since."""
+    def __init__(self):
+        self.low = -math.inf
+        self.high = math.inf
+
+    def narrow(self, dt, change, tolerance):
+        self.low = max(self.low, (change - tolerance) / dt)
+        self.high = min(self.high, (change + tolerance) / dt)
+
+    def admits(self, slope):
+        return self.low <= slope <= self.high
+
+
+class ReadingCompressor:
+    """
+    Decide which readings to store.
+
+    add() returns the readings to store now, in time order. The latest
+    reading is held back until it is known whether it must be stored, so
+    flush() must be called on shutdown to store it.
+    """
+    def __init__(self, method, tolerances, max_silence=None, default_tolerance=None):
+        """
+        Args:
+            method: 'deadband' or 'swinging_door'
+            tolerances: Dict mapping channel name to its tolerance
+            max_silence: Longest time in seconds between stored readings (None = no limit)
+            default_tolerance: Tolerance of channels missing from tolerances
+                (None = store every change of them)
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown compression method '{method}', expected one of {METHODS}")
+        self.method = method
+        self.tolerances = dict(tolerances)
+        self.max_silence = max_silence
+        self.default_tolerance = default_tolerance
+        self.stored = None  # (time, values, notes) of the last stored reading
+        self.held = None  # Latest reading not stored yet
+        self.held_values = None
+        self.doors = {}
+        self.dropped = 0  # Readings that will never be stored
+
+    def tolerance(self, channel):
+        tolerance = self.tolerances.get(channel, self.default_tolerance)
+        return 0.0 if tolerance is None else tolerance
+
+    def add(self, time_, values, notes, reading):
+        """
+        Pass one reading through the compressor.
+
+        Args:
+            time_: Epoch seconds of the reading
+            values: Dict mapping channel name to its value, or None for a sensor error
+            notes: Text that must match for readings to be merged
+            reading: The reading as it would be stored
+
+        Returns:
+            list: Readings to store now (zero, one or two)
+        """
+        out = []
+        if self.stored is None or self._must_store(time_, values, notes):
+            out.extend(self._store_held())
+            out.append(self._store(time_, values, notes, reading))
+            return out
+
+        stored_time, stored_values, _ = self.stored
+        dt = time_ - stored_time
+        if self.max_silence is not None and dt > self.max_silence:
+            out.extend(self._store_held())
+            stored_time, stored_values, _ = self.stored
+            dt = time_ - stored_time
+            if dt > self.max_silence:
+                out.append(self._store(time_, values, notes, reading))
+                return out
+        if self._fits(dt, values, stored_values):
+            self._drop_held()
+            self.held, self.held_values = reading, (time_, values)
+        elif self.method == 'deadband':
+            # Readings held back stay within the band of the stored one
+            self._drop_held()
+            out.append(self._store(time_, values, notes, reading))
+        else:
+            # The held reading is the last one that can end a segment
+            out.extend(self._store_held())
+            self.held, self.held_values = reading, (time_, values)
+        return out
+
+    def _must_store(self, time_, values, notes):
+        _, stored_values, stored_notes = self.stored
+        if notes != stored_notes or values.keys() != stored_values.keys():
+            return True
+        return any(value is None or stored_values[channel] is None
+                   for channel, value in values.items())
+
+    def _fits(self, dt, values, stored_values):
+        if self.method == 'deadband':
+            return all(abs(value - stored_values[channel]) <= self.tolerance(channel)
+                       for channel, value in values.items())
+        if self.held is None:
+            return True  # A segment of two readings always fits
+        if dt <= 0:
+            return False
+        held_time, held_values = self.held_values
+        fits = True
+        for channel, value in values.items():
+            door = self.doors.setdefault(channel, _Door())
+            # The held reading becomes a point the segment has to pass by
+            held_dt = held_time - self.stored[0]
+            if held_dt > 0:
+                door.narrow(held_dt, held_values[channel] - stored_values[channel],
+                            self.tolerance(channel))
+            if not door.admits((value - stored_values[channel]) / dt):
+                fits = False
+        return fits
+
+    def _store(self, time_, values, notes, reading):
+        self.stored = (time_, values, notes)
+        self.held = self.held_values = None
+        self.doors = {}
+        return reading
+
+    def _store_held(self):
+        if self.held is None:
+            return []
+        time_, values = self.held_values
+        return [self._store(time_, values, self.stored[2], self.held)]
+
+    def _drop_held(self):
+        if self.held is not None:
+            self.dropped += 1
+            self.held = self.held_values = None
+
+    def flush(self):
+        """
+        Readings still held back, to be stored on shutdown.
+
+        Returns:
+            list: Zero or one reading
+        """
+        return self._store_held()
+
+
+def reconstruct(data, times, method):
+    """
+    Rebuild channel values at arbitrary times from stored readings.
+
+    Within the compressor's tolerances for any time at which a reading was
+    taken. Times before the first or after the last stored reading, and
+    times next to a stored sensor error, get NaN.
+
+    Args:
+        data: Dict with a sorted 'time' array and a NaN-for-error array per
+            channel, as returned by datastore.read_range()
+        times: Array of epoch seconds
+        method: Compression method the readings were stored with
+
+    Returns:
+        dict: 'time' and an array per channel at the given times
+    """
+    times = np.asarray(times, dtype=np.float64)
+    stored = data['time']
+    result = {'time': times}
+    if len(stored) == 0:
+        for name in data:
+            if name != 'time':
+                result[name] = np.full(len(times), np.nan)
+        return result
+    inside = (times >= stored[0]) & (times <= stored[-1])
+    # Segment containing each time: stored[i] <= time < stored[i + 1]
+    segment = np.clip(np.searchsorted(stored, times, side='right') - 1, 0, len(stored) - 1)
+    exact = inside & (stored[segment] == times)
+    for name, values in data.items():
+        if name == 'time':
+            continue
+        if method == 'deadband':
+            rebuilt = values[segment]
+        else:
+            rebuilt = np.interp(times, stored, values)
+        rebuilt = np.where(inside, rebuilt, np.nan)
+        # np.interp spreads NaN to both neighbouring segments; stored points are exact
+        result[name] = np.where(exact, values[segment], rebuilt)
+    return result
@@ -1,18 +1,248 @@
-from flask import Flask, render_template, jsonify
-import csv
+from flask import Flask, render_template, jsonify, request, Response
+import os
+import gzip
+import json
+import time
+import threading
+from collections import deque
+import numpy as np
+from datastore import DOWNSAMPLERS, NUMERIC_COLUMNS, parse_timestamp, parse_row, read_last_rows
+from binstore import record_to_row, open_records, RECORD_DTYPE, HEADER_SIZE as BINARY_HEADER_SIZE
+from livering import RingReader
+from partitions import PartitionSet
+from metrics import read_snapshot, render_prometheus
+from rollups import RollupCache, RESOLUTIONS, rollup_path
+from collector import FleetStore, parse_batch
+from compression import METHODS as COMPRESSION_METHODS, reconstruct
+from spatial import SpatialIndex, aggregate, positions_path
+from binstore import COORDINATE_SCALE
 
 app = Flask(__name__)
 
-# Function to read the latest data from CSV
+# Storage backend PAPScript.py writes with (CONFIG['STORAGE_BACKEND'], both
+# read from PIAQUAPULSE_STORAGE_BACKEND) and its data file (CONFIG['DATA_FILE']
+# or CONFIG['BINARY_DATA_FILE'])
+STORAGE_BACKEND = os.environ.get("PIAQUAPULSE_STORAGE_BACKEND", "csv")
+DATA_FILE = "river_data.bin" if STORAGE_BACKEND == "binary" else "river_data.csv"
+# Directory of the daily/monthly partitions, if PAPScript.py writes them
+# (CONFIG['PARTITION_DIR']; None = next to DATA_FILE)
+PARTITION_DIR = None
+
+# The data file and its partitions. Keeps the last row of the newest one,
+# re-read only when it changes, and the timestamp -> byte offset indexes
+# used by /history, extended as the files grow.
+data_files = PartitionSet(DATA_FILE, PARTITION_DIR)
+
+# Compression PAPScript.py stores readings with (CONFIG['COMPRESSION'], both
+# read from PIAQUAPULSE_COMPRESSION), used by /history?step= to reconstruct the series
+COMPRESSION = os.environ.get("PIAQUAPULSE_COMPRESSION") or None
+
+# Hourly/daily rollups maintained by PAPScript.py, served by /summary
+rollup_cache = RollupCache(rollup_path(DATA_FILE))
+
+# Grid index over the positions of GPS-tagged readings, served by /spatial
+spatial_index = SpatialIndex(positions_path(DATA_FILE))
+
+# Recent readings published by PAPScript.py in shared memory
+# (CONFIG['LIVE_RING_NAME']); the data file is read when it is not running
+LIVE_RING_NAME = "piaquapulse"
+live_ring = RingReader(LIVE_RING_NAME)
+live_ring_lock = threading.Lock()
+
+# Metrics snapshot written by PAPScript.py, served by /metrics
+METRICS_FILE = "metrics.json"
+
+# Collector mode: SQLite database of readings uploaded by stations, served by
+# /ingest and /stations (None = collector mode off, set by --collector)
+COLLECTOR_DB = os.environ.get("PIAQUAPULSE_COLLECTOR_DB")
+# Bearer token stations must send to /ingest (CONFIG['UPLOAD_TOKEN']; None = any)
+COLLECTOR_TOKEN = os.environ.get("PIAQUAPULSE_COLLECTOR_TOKEN")
+fleet = None
+fleet_lock = threading.Lock()
+
+# Upper limit on readings returned by /recent
+MAX_RECENT_READINGS = 1000
+
+# Upper limit on points returned per series by /history
+MAX_HISTORY_POINTS = 10000
+
+# Upper limit on readings or grid cells returned by /spatial
+MAX_SPATIAL_POINTS = 10000
+
+# How often the stream watcher checks the data file for new rows (seconds)
+STREAM_POLL_INTERVAL = 0.25
+# Seconds between keep-alive comments on idle streams
+STREAM_KEEPALIVE = 15
+# Recent events kept for clients that reconnect with Last-Event-ID
+STREAM_BACKLOG = 100
+
+# Latest rows from the logger's shared memory ring, or None if it is not running
+def read_live_rows(count):
+    with live_ring_lock:
+        records = live_ring.latest(count)
+    if records is None:
+        return None
+    return [record_to_row(record) for record in records]
+
+# Function to read the latest data, from shared memory or else the CSV
 def read_latest_data():
+    rows = read_live_rows(1)
+    if rows:
+        return rows[-1]
+    return data_files.latest_row()
+
+# Last count rows, from shared memory or else the newest CSV partition
+def read_recent_data(count):
+    rows = read_live_rows(count)
+    if rows is not None:
+        return rows
+    path = data_files.latest_path()
     try:
-        with open("river_data.csv", "r") as file:
-            reader = list(csv.reader(file))
-            if len(reader) > 1:
-                return reader[-1]  # Last row (latest data)
+        if data_files.binary and path.endswith(".bin"):
+            return [record_to_row(record) for record in open_records(path)[-count:]]
+        if not path.endswith(".csv"):
+            return []  # Compressed
+        return read_last_rows(path, count)
     except FileNotFoundError:
-        return None
-    return None
+        return []
+
+# Convert a data file row to the JSON reading served to the browser
+def reading_from_row(row):
+    return {
+        "timestamp": row[0],
+        "time": parse_timestamp(row[0]),
+        "temperature": row[1],
+        "pH": row[2],
+        "turbidity": row[3],
+        "gps": row[4]
+    }
+
+class ReadingBroadcaster:
+    """
+    Shared in-memory broadcast of new readings for the /stream endpoint.
+
+    A single watcher thread picks up each new reading once, from the
+    logger's shared memory ring or, when that is not available, by
+    following the data file (CSV or binary); every connected client then
+    waits on the same condition, so the cost of new data does not grow with
+    the number of viewers. path may be a function returning the file to
+    follow, which then can change, e.g. when a new partition starts.
+    """
+    def __init__(self, path, poll_interval=STREAM_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=STREAM_BACKLOG)  # (id, json) pairs
+        self.last_id = 0
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="stream-watcher", daemon=True)
+                self.thread.start()
+
+    def publish(self, reading):
+        with self.condition:
+            self.last_id += 1
+            self.events.append((self.last_id, json.dumps(reading)))
+            self.condition.notify_all()
+
+    def _run(self):
+        seen = None  # Readings of the ring already published
+        follower = None
+        while True:
+            try:
+                with live_ring_lock:
+                    result = live_ring.read_since(seen or 0)
+                if result is not None:
+                    records, published = result
+                    if seen is not None:  # Else start from the latest reading
+                        for record in records:
+                            self.publish(reading_from_row(record_to_row(record)))
+                    seen = published
+                    follower = None  # Follow the file from its end if the ring goes away
+                else:
+                    seen = None  # A restarted logger starts a new ring
+                    if follower is None:
+                        follower = DataFileFollower(self.path)
+                    for row in follower.new_rows():
+                        try:
+                            self.publish(reading_from_row(row))
+                        except (ValueError, IndexError):
+                            continue  # Header or malformed row
+            except Exception as e:
+                app.logger.error(f"Error following new readings: {e}")
+            time.sleep(self.poll_interval)
+
+    def listen(self, last_id=None):
+        """Yield (id, json) for each reading published after last_id."""
+        self.start()
+        with self.condition:
+            if last_id is None:
+                last_id = self.last_id
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.last_id > last_id, STREAM_KEEPALIVE)
+                events = [event for event in self.events if event[0] > last_id]
+            if not events:
+                yield None  # Keep-alive
+            for event in events:
+                last_id = event[0]
+                yield event
+
+class DataFileFollower:
+    """
+    Rows appended to a CSV or binary data file since the last call,
+    starting from its end. path may be a function as for ReadingBroadcaster.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.current = None
+        self.offset = None
+        self.inode = None
+        self.pending = b""
+
+    def new_rows(self):
+        current = self.path() if callable(self.path) else self.path
+        try:
+            st = os.stat(current)
+        except FileNotFoundError:
+            # Follow it from its start once it is created
+            self.offset, self.inode, self.pending = 0, None, b""
+            return []
+        binary = current.endswith(".bin")
+        if self.current is not None and current != self.current:
+            # A new partition: follow it from its start
+            self.offset, self.inode, self.pending = 0, st.st_ino, b""
+        self.current = current
+        if self.inode is None and self.offset == 0:
+            self.inode = st.st_ino
+        if self.offset is None or st.st_ino != self.inode or st.st_size < self.offset:
+            # Start following from the current end of the file
+            self.offset, self.inode, self.pending = st.st_size, st.st_ino, b""
+            if binary and st.st_size > BINARY_HEADER_SIZE:
+                self.offset -= (st.st_size - BINARY_HEADER_SIZE) % RECORD_DTYPE.itemsize
+            return []
+        if binary:
+            self.offset = max(self.offset, BINARY_HEADER_SIZE)
+        if st.st_size <= self.offset:
+            return []
+        with open(current, "rb") as f:
+            f.seek(self.offset)
+            data = self.pending + f.read(st.st_size - self.offset)
+        self.offset = st.st_size
+        if binary:
+            whole = len(data) - len(data) % RECORD_DTYPE.itemsize
+            self.pending = data[whole:]  # Record still being written
+            return [record_to_row(record)
+                    for record in np.frombuffer(data[:whole], dtype=RECORD_DTYPE)]
+        lines = data.split(b"\n")
+        self.pending = lines.pop()  # Incomplete last line, if any
+        return [parse_row(line.rstrip(b"\r")) for line in lines]
+
+broadcaster = ReadingBroadcaster(data_files.latest_path)
 
 @app.route("/")
 def index():
@@ -22,14 +252,304 @@ def index():
 def data():
     latest_data = read_latest_data()
     if latest_data:
-        return jsonify({
-            "timestamp": latest_data[0],
-            "temperature": latest_data[1],
-            "pH": latest_data[2],
-            "turbidity": latest_data[3],
-            "gps": latest_data[4]
-        })
+        return jsonify(reading_from_row(latest_data))
     return jsonify({"error": "No data available"})
 
+@app.route("/recent")
+def recent():
+    try:
+        count = min(int(request.args.get("n", 100)), MAX_RECENT_READINGS)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    readings = []
+    for row in read_recent_data(count):
+        try:
+            readings.append(reading_from_row(row))
+        except (ValueError, IndexError):
+            continue  # Header or malformed row
+    return jsonify(readings)
+
+# Server-Sent Events: push each new reading to the browser as it is written
+@app.route("/stream")
+def stream():
+    last_id = request.headers.get("Last-Event-ID", type=int)
+
+    def events():
+        for event in broadcaster.listen(last_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"id: {event[0]}\ndata: {event[1]}\n\n"
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Prometheus text format; the logger's snapshot plus its age
+@app.route("/metrics")
+def metrics():
+    try:
+        snapshot = read_snapshot(METRICS_FILE)
+    except ValueError as e:
+        return Response(f"Invalid metrics snapshot: {e}\n", status=503, mimetype="text/plain")
+    if snapshot is None:
+        return Response("No metrics snapshot yet\n", status=503, mimetype="text/plain")
+    snapshot["families"].append({
+        "name": "piaquapulse_metrics_snapshot_age_seconds",
+        "type": "gauge",
+        "help": "Seconds since the logger wrote the metrics snapshot",
+        "samples": [{"labels": {}, "value": time.time() - snapshot["time"]}]
+    })
+    return Response(render_prometheus(snapshot), mimetype="text/plain; version=0.0.4")
+
+# Accept epoch seconds or a "YYYY-MM-DD HH:MM:SS" / "YYYY-MM-DD" local time
+def parse_time_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if len(value) == 10:
+        value += " 00:00:00"
+    return parse_timestamp(value.replace("T", " "))
+
+@app.route("/history")
+def history():
+    try:
+        start = parse_time_arg("start")
+        end = parse_time_arg("end")
+        max_points = min(int(request.args.get("max_points", 2000)), MAX_HISTORY_POINTS)
+        step = float(request.args.get("step", 0))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    method = request.args.get("method", "lttb")
+    if method not in DOWNSAMPLERS:
+        return jsonify({"error": f"Unknown method '{method}'"}), 400
+
+    data = data_files.read_range(start, end)
+    if step > 0:
+        return reconstructed_history(data, start, end, step, max_points)
+    series = {}
+    for name in NUMERIC_COLUMNS:
+        # Downsample each series on its valid points only
+        valid = ~np.isnan(data[name])
+        times = data["time"][valid]
+        values = data[name][valid]
+        keep = DOWNSAMPLERS[method](times, values, max_points)
+        series[name] = {"t": times[keep].tolist(), "v": values[keep].tolist()}
+    return jsonify({
+        "start": start,
+        "end": end,
+        "rows": len(data["time"]),
+        "method": method,
+        "series": series
+    })
+
+# Values every step seconds, rebuilt from the stored readings: interpolated
+# between them, or held for deadband compression. The step is widened when
+# the range would need more than max_points, and the one used is returned.
+def reconstructed_history(data, start, end, step, max_points):
+    times = data["time"]
+    requested_step = step
+    first = start if start is not None else (times[0] if len(times) else 0)
+    last = end if end is not None else (times[-1] if len(times) else 0)
+    span = max(last - first, 0)
+    if span // step + 1 > max_points and max_points > 1:
+        step = span / (max_points - 1)
+    # Sized before it is built, so a tiny step over a long range stays cheap
+    count = max(min(int(span // step) + 1, max_points), 0) if last >= first else 0
+    grid = first + step * np.arange(count)
+    rebuilt = reconstruct(data, grid, COMPRESSION if COMPRESSION in COMPRESSION_METHODS else "swinging_door")
+    series = {}
+    for name in NUMERIC_COLUMNS:
+        valid = ~np.isnan(rebuilt[name])
+        series[name] = {"t": grid[valid].tolist(), "v": rebuilt[name][valid].tolist()}
+    return jsonify({
+        "start": start,
+        "end": end,
+        "rows": len(times),
+        "step": step,
+        "requested_step": requested_step,
+        "compression": COMPRESSION,
+        "series": series
+    })
+
+# Precomputed hourly or daily statistics, without touching the raw data
+@app.route("/summary")
+def summary():
+    resolution = request.args.get("resolution", "daily")
+    if resolution not in RESOLUTIONS:
+        return jsonify({"error": f"Unknown resolution '{resolution}'"}), 400
+    try:
+        start = parse_time_arg("start")
+        end = parse_time_arg("end")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    rollups = rollup_cache.get()
+    return jsonify({
+        "resolution": resolution,
+        "through": rollups.through,
+        "buckets": rollups.summary(resolution, start, end)
+    })
+
+# GPS-tagged readings in a bounding box (min lon,min lat,max lon,max lat) and
+# time range as GeoJSON; summarized on a grid when there are more than max_points
+@app.route("/spatial")
+def spatial():
+    try:
+        start = parse_time_arg("start")
+        end = parse_time_arg("end")
+        max_points = min(int(request.args.get("max_points", 2000)), MAX_SPATIAL_POINTS)
+        bbox = request.args.get("bbox")
+        if bbox:
+            bbox = [float(v) for v in bbox.split(",")]
+            if len(bbox) != 4:
+                raise ValueError("bbox needs min lon,min lat,max lon,max lat")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+
+    records = spatial_index.query(bbox or None, start, end)
+    features = []
+    cell_size = None
+    if len(records) > max_points:
+        cell_size, cells = aggregate(records, max_points, bbox or None)
+        for cell in cells:
+            coordinates = [cell.pop("longitude"), cell.pop("latitude")]
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": coordinates},
+                "properties": cell
+            })
+    else:
+        # Converted a column at a time; NaN (sensor error) becomes null
+        longitudes = np.round(records["longitude"] / COORDINATE_SCALE, 6).tolist()
+        latitudes = np.round(records["latitude"] / COORDINATE_SCALE, 6).tolist()
+        values = {name: [None if v != v else v for v in np.round(records[name].astype(np.float64), 2).tolist()]
+                  for name in NUMERIC_COLUMNS}
+        for i, t in enumerate(records["time"].tolist()):
+            properties = {"time": t}
+            properties.update((name, column[i]) for name, column in values.items())
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [longitudes[i], latitudes[i]]},
+                "properties": properties
+            })
+    return jsonify({
+        "type": "FeatureCollection",
+        "matched": len(records),
+        "aggregated": cell_size is not None,
+        "cell_size": cell_size,
+        "features": features
+    })
+
+# Open the fleet store on first use, or None if collector mode is off
+def get_fleet():
+    global fleet
+    if fleet is None and COLLECTOR_DB:
+        with fleet_lock:
+            if fleet is None:
+                fleet = FleetStore(COLLECTOR_DB)
+    return fleet
+
+def collector_off():
+    return jsonify({"error": "Collector mode is off"}), 404
+
+# Batch of readings uploaded by a station (uploader.py)
+@app.route("/ingest", methods=["POST"])
+def ingest():
+    store = get_fleet()
+    if store is None:
+        return collector_off()
+    if COLLECTOR_TOKEN and request.headers.get("Authorization") != f"Bearer {COLLECTOR_TOKEN}":
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        body = request.get_data()
+        if request.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        station, rows = parse_batch(json.loads(body))
+    except (OSError, ValueError) as e:
+        return jsonify({"error": f"Invalid batch: {e}"}), 400
+    try:
+        stored = store.ingest(request.headers.get("Idempotency-Key"), station, rows)
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 503
+    if not stored:
+        return jsonify({"status": "duplicate", "rows": 0}), 409
+    return jsonify({"status": "stored", "rows": len(rows)})
+
+# Latest reading and position of every station
+@app.route("/stations")
+def stations():
+    store = get_fleet()
+    if store is None:
+        return collector_off()
+    return jsonify(store.stations())
+
+@app.route("/stations/<station>/latest")
+def station_latest(station):
+    store = get_fleet()
+    if store is None:
+        return collector_off()
+    latest = store.latest(station)
+    if latest is None:
+        return jsonify({"error": f"Unknown station '{station}'"}), 404
+    return jsonify(latest)
+
+@app.route("/stations/<station>/history")
+def station_history(station):
+    store = get_fleet()
+    if store is None:
+        return collector_off()
+    try:
+        start = parse_time_arg("start")
+        end = parse_time_arg("end")
+        max_points = min(int(request.args.get("max_points", 2000)), MAX_HISTORY_POINTS)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    method = request.args.get("method", "lttb")
+    if method not in DOWNSAMPLERS:
+        return jsonify({"error": f"Unknown method '{method}'"}), 400
+
+    data = store.history(station, start, end)
+    series = {}
+    for name in NUMERIC_COLUMNS:
+        valid = ~np.isnan(data[name])
+        times = data["time"][valid]
+        values = data[name][valid]
+        keep = DOWNSAMPLERS[method](times, values, max_points)
+        series[name] = {"t": times[keep].tolist(), "v": values[keep].tolist()}
+    return jsonify({
+        "station": station,
+        "start": start,
+        "end": end,
+        "rows": len(data["time"]),
+        "method": method,
+        "series": series
+    })
+
+# Stations with a known position as GeoJSON, for a map layer
+@app.route("/map")
+def station_map():
+    store = get_fleet()
+    if store is None:
+        return collector_off()
+    features = []
+    for station in store.stations():
+        if station["latitude"] is None or station["longitude"] is None:
+            continue
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [station["longitude"], station["latitude"]]},
+            "properties": {k: v for k, v in station.items() if k not in ("latitude", "longitude")}
+        })
+    return jsonify({"type": "FeatureCollection", "features": features})
+
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0')
+    import argparse
+    parser = argparse.ArgumentParser(description="PiAquaPulse dashboard")
+    parser.add_argument("--collector", metavar="DB", default=COLLECTOR_DB,
+                        help="Collect readings uploaded by stations into this SQLite database")
+    args = parser.parse_args()
+    COLLECTOR_DB = args.collector
+    app.run(debug=True, host='0.0.0.0', threaded=True)
@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Data file access helpers
+
+Readers for the river_data.csv data file that do not need to scan the whole
+file, shared by the dashboard and the command line tools, and the batched
+writer the logger uses to append to it.
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import io
+import os
+import csv
+import json
+import time
+import queue
+import bisect
+import logging
+import datetime
+import tempfile
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bytes read per step when scanning backwards from the end of a file
+TAIL_BLOCK_SIZE = 4096
+
+# Format of the Timestamp column written by PAPScript.py (local time)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Numeric columns of the data file, by position
+NUMERIC_COLUMNS = {
+    'temperature': 1,
+    'ph': 2,
+    'turbidity': 3,
+}
+
+
+def parse_row(line):
+    """Parse one CSV line (bytes or str) into a list of fields."""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+    return next(csv.reader([line]), [])
+
+
+def read_last_row(path):
+    """
+    Read the last complete data row of a CSV file by seeking back from the end.
+
+    A trailing line without a newline is treated as a row still being written
+    and skipped. Rows never contain embedded newlines, so the cost depends on
+    the length of the last rows, not the size of the file.
+
+    Args:
+        path: Path to the CSV data file
+
+    Returns:
+        list: Fields of the last data row, or None if the file has no data rows
+    """
+    rows = read_last_rows(path, 1)
+    return rows[-1] if rows else None
+
+
+def read_last_rows(path, count):
+    """
+    Read the last count complete data rows of a CSV file, as read_last_row().
+
+    Returns:
+        list: Rows (lists of fields), oldest first; fewer if the file is shorter
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        tail = b''
+        position = end
+        while position > 0:
+            step = min(TAIL_BLOCK_SIZE, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            # Drop a partial last line, then look for the start of the first wanted one
+            complete = tail[:tail.rfind(b'\n') + 1]
+            if complete.count(b'\n') > count or (position == 0 and complete):
+                break
+
+    complete = tail[:tail.rfind(b'\n') + 1]
+    lines = complete.splitlines()
+    # When the scan reached the start of the file the first line is the header
+    if position == 0:
+        lines = lines[1:]
+    return [parse_row(line) for line in lines[-count:]] if count > 0 else []
+
+
+class LatestRowCache:
+    """
+    Memoize the last row of a data file on its size and modification time.
+
+    Between writes a lookup costs a single stat() call.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.key = None
+        self.row = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the last complete row of the file.
+
+        Returns:
+            list: Fields of the last row, or None if the file is missing or empty
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        key = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if key != self.key:
+                self.row = read_last_row(self.path)
+                self.key = key
+            return self.row
+
+
+def write_json_atomic(obj, path, fsync=False):
+    """
+    Write obj as JSON so that readers never see a partial file.
+
+    Args:
+        obj: JSON-serializable object
+        path: File to replace
+        fsync: Also force the file and the rename to disk, so the new
+            contents survive a power loss
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '-', dir=directory)
+    try:
+        os.fchmod(fd, 0o644)  # mkstemp creates the file private to the owner
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if fsync:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def parse_timestamp(value):
+    """Convert a Timestamp column value (local time) to epoch seconds."""
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    return datetime.datetime.strptime(value, TIMESTAMP_FORMAT).timestamp()
+
+
+def parse_number(value):
+    """Convert a numeric column value to float, with NaN for ERROR or blanks."""
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+class SparseIndex:
+    """
+    Sparse timestamp -> byte offset index over an append-only data file.
+
+    Every stride-th row's timestamp and byte offset is recorded. The index is
+    extended incrementally by scanning only the bytes appended since the last
+    refresh, so a range query can seek close to its start instead of
+    scanning from the top of the file. Rows are assumed to be written in
+    timestamp order.
+    """
+    def __init__(self, path, stride=1000):
+        self.path = path
+        self.stride = stride
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.timestamps = []
+        self.offsets = []
+        self.rows = 0
+        self.indexed_offset = None  # End of the last indexed complete row
+        self.file_key = None
+
+    def refresh(self):
+        """
+        Index rows appended since the last refresh.
+
+        Returns:
+            bool: False if the data file does not exist
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            with self.lock:
+                self._reset()
+            return False
+
+        with self.lock:
+            # A smaller or different file means it was replaced; start over
+            if (self.file_key and (st.st_ino != self.file_key[0]
+                                   or st.st_size < self.indexed_offset)):
+                self._reset()
+            if self.indexed_offset == st.st_size:
+                return True
+
+            with open(self.path, 'rb') as f:
+                if self.indexed_offset is None:
+                    f.readline()  # Header
+                    self.indexed_offset = f.tell()
+                f.seek(self.indexed_offset)
+                offset = self.indexed_offset
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Row still being written
+                    if self.rows % self.stride == 0:
+                        try:
+                            timestamp = parse_timestamp(line[:line.index(b',')])
+                        except ValueError:
+                            timestamp = None
+                        if timestamp is not None:
+                            self.timestamps.append(timestamp)
+                            self.offsets.append(offset)
+                    self.rows += 1
+                    offset += len(line)
+                self.indexed_offset = offset
+            self.file_key = (st.st_ino, st.st_size)
+            return True
+
+    def seek_offset(self, start):
+        """
+        Byte offset from which to scan for rows at or after start.
+
+        Args:
+            start: Epoch seconds, or None for the beginning of the data
+
+        Returns:
+            int: Offset of an indexed row at or before the first matching row
+        """
+        with self.lock:
+            if not self.offsets:
+                return self.indexed_offset or 0
+            if start is None:
+                return self.offsets[0]
+            position = bisect.bisect_left(self.timestamps, start) - 1
+            return self.offsets[max(position, 0)]
+
+
+def format_timestamp(epoch):
+    """Convert epoch seconds to a Timestamp column value (local time)."""
+    return datetime.datetime.fromtimestamp(epoch).strftime(TIMESTAMP_FORMAT)
+
+
+def parse_timestamps(values):
+    """
+    Vectorized parse_timestamp for a sequence of Timestamp column values.
+
+    The wall-clock times are parsed by NumPy as if they were UTC and then
+    shifted by the local UTC offset, which is looked up once per distinct hour.
+
+    Returns:
+        numpy.ndarray: Epoch seconds (float64)
+    """
+    naive = np.array(values, dtype=bytes).astype('datetime64[s]').astype(np.int64)
+    hours, inverse = np.unique(naive // 3600, return_inverse=True)
+    epoch = datetime.datetime(1970, 1, 1)
+    offsets = np.array([
+        (epoch + datetime.timedelta(hours=int(hour))).timestamp() - int(hour) * 3600
+        for hour in hours
+    ])
+    return naive + offsets[inverse.reshape(-1)]
+
+
+def parse_numbers(values):
+    """Vectorized parse_number for a sequence of numeric column values."""
+    array = np.array(values, dtype=bytes)
+    array[array == b'ERROR'] = b'nan'
+    try:
+        return array.astype(np.float64)
+    except ValueError:
+        return np.array([parse_number(value) for value in values], dtype=np.float64)
+
+
+def read_range(index, start=None, end=None):
+    """
+    Read the numeric columns of the rows between start and end.
+
+    Args:
+        index: SparseIndex over the data file
+        start: Epoch seconds (inclusive), or None for no lower bound
+        end: Epoch seconds (inclusive), or None for no upper bound
+
+    Returns:
+        dict: 'time' and each NUMERIC_COLUMNS name -> numpy float64 array,
+        with NaN where a sensor reported an error
+    """
+    index.refresh()
+    try:
+        with open(index.path, 'rb') as f:
+            f.seek(index.seek_offset(start))
+            return read_range_lines(f, start, end)
+    except FileNotFoundError:
+        return read_range_lines([], start, end)
+
+
+def read_range_lines(lines, start=None, end=None):
+    """
+    Read the numeric columns of the rows between start and end from an
+    iterable of data file lines (bytes) in timestamp order, e.g. a file
+    positioned by SparseIndex or a decompressed partition.
+
+    Returns:
+        dict: As read_range()
+    """
+    # Timestamps sort as strings, so rows are filtered without parsing them
+    start_key = format_timestamp(start).encode() if start is not None else None
+    end_key = format_timestamp(end).encode() if end is not None else None
+    timestamps = []
+    columns = sorted(NUMERIC_COLUMNS.values())
+    fields_by_column = {column: [] for column in columns}
+    split_count = columns[-1] + 1
+    for line in lines:
+        if not line.endswith(b'\n'):
+            break
+        # Leading columns never contain commas, so a plain split is enough
+        fields = line.split(b',', split_count)
+        if len(fields) <= split_count or not fields[0][:1].isdigit():
+            continue  # Header or malformed row; 'Timestamp' sorts after every key
+        if start_key is not None and fields[0] < start_key:
+            continue
+        if end_key is not None and fields[0] > end_key:
+            break
+        timestamps.append(fields[0])
+        for column in columns:
+            fields_by_column[column].append(fields[column])
+
+    if not timestamps:
+        return empty_range()
+    result = {'time': parse_timestamps(timestamps)}
+    for name, column in NUMERIC_COLUMNS.items():
+        result[name] = parse_numbers(fields_by_column[column])
+    return result
+
+
+def empty_range():
+    """Result of a range read that matched no rows."""
+    empty = np.empty(0, dtype=np.float64)
+    return dict({'time': empty}, **{name: empty for name in NUMERIC_COLUMNS})
+
+
+def concat_ranges(ranges):
+    """Join range read results in order."""
+    ranges = [r for r in ranges if len(r['time'])]
+    if not ranges:
+        return empty_range()
+    if len(ranges) == 1:
+        return ranges[0]
+    return {name: np.concatenate([r[name] for r in ranges]) for name in ranges[0]}
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-triangle-three-buckets downsampling.
+
+    Keeps the first and last points and, from each of threshold - 2 equal
+    buckets in between, the point forming the largest triangle with the
+    previously kept point and the average of the next bucket.
+
+    Args:
+        x: Sorted x values (numpy array)
+        y: y values (numpy array, no NaN)
+        threshold: Maximum number of points to keep
+
+    Returns:
+        numpy.ndarray: Indices of the kept points, in order
+    """
+    n = len(x)
+    if threshold >= n:
+        return np.arange(n)
+    if threshold < 3:
+        return np.array([0, n - 1][:max(threshold, 0)], dtype=np.int64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket (the last point for the final bucket)
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        areas = np.abs((x[previous] - avg_x) * (y[lo:hi] - y[previous])
+                       - (x[previous] - x[lo:hi]) * (avg_y - y[previous]))
+        previous = lo + int(np.argmax(areas))
+        kept[i + 1] = previous
+    return kept
+
+
+def minmax_downsample(x, y, threshold):
+    """
+    Min/max downsampling: keep the lowest and highest point of each bucket.
+
+    Args:
+        x: Sorted x values (numpy array)
+        y: y values (numpy array, no NaN)
+        threshold: Maximum number of points to keep
+
+    Returns:
+        numpy.ndarray: Indices of the kept points, in order
+    """
+    n = len(x)
+    buckets = threshold // 2
+    if n <= threshold or buckets < 1:
+        return np.arange(min(n, max(threshold, 0)))
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    starts = edges[:-1]
+    mins = np.minimum.reduceat(y, starts)
+    maxs = np.maximum.reduceat(y, starts)
+    bucket_of = np.repeat(np.arange(buckets), np.diff(edges))
+    # First index in each bucket holding its min and its max
+    is_min = y == mins[bucket_of]
+    is_max = y == maxs[bucket_of]
+    min_idx = np.full(buckets, n, dtype=np.int64)
+    max_idx = np.full(buckets, n, dtype=np.int64)
+    positions = np.arange(n)
+    np.minimum.at(min_idx, bucket_of[is_min], positions[is_min])
+    np.minimum.at(max_idx, bucket_of[is_max], positions[is_max])
+    return np.unique(np.concatenate([min_idx, max_idx]))
+
+
+DOWNSAMPLERS = {
+    'lttb': lttb,
+    'minmax': minmax_downsample,
+}
+
+
+# Durability applied after each batch written by DataWriter:
+# 'none' leaves rows in the file buffer until it fills or the writer closes,
+# 'flush' hands them to the OS (visible to readers, survives a crash of the
+# logger), 'fsync' also forces them to the SD card (survives power loss).
+DURABILITY_MODES = ('none', 'flush', 'fsync')
+
+# Seconds DataWriter waits before retrying a batch it failed to write
+WRITE_RETRY_INTERVAL = 5.0
+# Most items DataWriter keeps while writes fail; the oldest are dropped beyond
+WRITE_MAX_RETAINED = 10000
+
+
+def encode_csv_rows(rows):
+    """Encode rows as CSV lines, the same way csv.writer writes the data file."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def recover_csv_file(f, header):
+    """
+    Prepare a CSV data file for appending.
+
+    Writes the header to an empty file and truncates a torn last line left
+    by an interrupted write.
+
+    Args:
+        f: File opened in 'a+b' mode
+        header: List of column names
+
+    Returns:
+        int: Number of bytes dropped
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size:
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return 0
+    # Find the end of the last complete line
+    position = size
+    keep = 0
+    while position > 0:
+        step = min(TAIL_BLOCK_SIZE, position)
+        position -= step
+        f.seek(position)
+        newline = f.read(step).rfind(b'\n')
+        if newline != -1:
+            keep = position + newline + 1
+            break
+    f.truncate(keep)
+    if keep == 0:
+        f.write(encode_csv_rows([header]))
+    if size:
+        logger.warning(f"Dropped {size - keep} bytes of a torn last line from {f.name}")
+    return size - keep
+
+
+class DataWriter:
+    """
+    Single owner of an append-only data file.
+
+    Items are queued from any thread with write() and appended by a
+    background thread in batches, flushed once batch_size items are pending
+    or flush_interval seconds after the first pending item, whichever comes
+    first. The durability mode is applied once per batch. A batch that
+    fails to write is kept and retried, after reopening the file, with the
+    next flush.
+    """
+    class _Control:
+        """Flush or close request passed through the queue."""
+        def __init__(self, close=False):
+            self.close = close
+            self.done = threading.Event()
+
+    def __init__(self, path, encode, recover, batch_size=1, flush_interval=0.0,
+                 durability='flush'):
+        """
+        Args:
+            path: Data file path
+            encode: Function converting a list of items to bytes
+            recover: Function preparing the file opened in 'a+b' mode for
+                appending (header, torn tail)
+            batch_size: Items per batch
+            flush_interval: Maximum seconds an item waits for its batch
+            durability: One of DURABILITY_MODES
+        """
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability '{durability}', expected one of {DURABILITY_MODES}")
+        self.path = path
+        self.encode = encode
+        self.recover = recover
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.queue = queue.Queue()
+        self.items_written = 0
+        self.batches_written = 0
+        self.errors = 0
+        self.dropped = 0  # Items given up on after writes kept failing
+        self.file = None
+        self.thread = threading.Thread(target=self._run, name="data-writer", daemon=True)
+        self.thread.start()
+
+    @property
+    def queue_depth(self):
+        """Approximate number of items waiting to be written."""
+        return self.queue.qsize()
+
+    def write(self, item):
+        """Queue an item to be appended. Returns immediately."""
+        self.queue.put(item)
+
+    def flush(self, timeout=None):
+        """
+        Write all queued items now and wait until they are written.
+
+        Returns:
+            bool: True if the flush completed within timeout
+        """
+        control = self._Control()
+        self.queue.put(control)
+        return control.done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        """
+        Write all queued items, sync them to disk and stop the writer.
+
+        Returns:
+            bool: True if the writer thread finished within timeout
+        """
+        self.queue.put(self._Control(close=True))
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self.path, 'a+b')
+            self.recover(self.file)
+        return self.file
+
+    def _write_batch(self, batch, durability):
+        """
+        Append a batch, clearing it once written.
+
+        Returns:
+            bool: False if the batch could not be written and is kept for a retry
+        """
+        if not batch:
+            return True
+        offset = None
+        try:
+            f = self._open()
+            offset = f.seek(0, os.SEEK_END)
+            f.write(self.encode(batch))
+            if durability != 'none':
+                f.flush()
+            if durability == 'fsync':
+                os.fsync(f.fileno())
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error writing {len(batch)} items to {self.path}, will retry: {e}")
+            self._close_file()
+            if offset is not None:
+                # Drop whatever part of the batch made it, so the retry doesn't duplicate it
+                try:
+                    os.truncate(self.path, offset)
+                except OSError:
+                    pass  # Reopening repairs a torn tail
+            return False
+        self.items_written += len(batch)
+        self.batches_written += 1
+        batch.clear()
+        return True
+
+    def _close_file(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except Exception as e:
+                logger.error(f"Error closing {self.path}: {e}")
+            self.file = None
+
+    def _retain(self, batch):
+        """Drop the oldest items of a batch that keeps failing beyond WRITE_MAX_RETAINED."""
+        excess = len(batch) - WRITE_MAX_RETAINED
+        if excess > 0:
+            del batch[:excess]
+            self.dropped += excess
+            logger.error(f"Dropped {excess} items that could not be written to {self.path} "
+                         f"({self.dropped} so far)")
+
+    def _run(self):
+        batch = []
+        deadline = None
+        retrying = False  # The batch failed to write; wait for deadline
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, self._Control):
+                # Everything queued before the request is in the batch by now
+                if item.close:
+                    if not self._write_batch(batch, 'fsync'):
+                        self.dropped += len(batch)
+                        logger.error(f"Lost {len(batch)} items that could not be written to {self.path}")
+                    self._close_file()
+                    item.done.set()
+                    return
+                written = self._write_batch(batch, 'fsync' if self.durability == 'fsync' else 'flush')
+                retrying = not written
+                deadline = None if written else time.monotonic() + WRITE_RETRY_INTERVAL
+                item.done.set()
+                continue
+
+            if item is not None:
+                batch.append(item)
+                if retrying:
+                    self._retain(batch)
+                elif deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            due = deadline is not None and time.monotonic() >= deadline
+            if due or (len(batch) >= self.batch_size and not retrying):
+                written = self._write_batch(batch, self.durability)
+                retrying = not written
+                deadline = None if written else time.monotonic() + WRITE_RETRY_INTERVAL
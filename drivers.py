@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Hardware driver backends
+
+PAPScript.py talks to the hardware through one of these backends:
+
+- PiHardware: the real GPIO, MCP3008, 1-Wire bus and NEO-6M serial port.
+  Nothing is imported or configured until a device is first used.
+- SimulatedHardware: software stand-ins with configurable latency and
+  noise, so the acquisition path can run, be tested and be profiled on an
+  ordinary Linux machine.
+
+Select a backend with the HARDWARE_BACKEND setting, the PIAQUAPULSE_HARDWARE
+environment variable ('pi' or 'sim') or `python3 PAPScript.py --simulate`.
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import time
+import random
+import logging
+import datetime
+import threading
+import subprocess
+
+from ds18b20 import DS18B20Bus
+from gps_service import GPSService
+
+logger = logging.getLogger(__name__)
+
+
+class PiHardware:
+    """Raspberry Pi hardware, initialized on first use."""
+    name = 'pi'
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self._gpio = None
+        self._adc = None
+        self._w1_loaded = False
+
+    @property
+    def gpio(self):
+        """RPi.GPIO, with the button and LED pins configured."""
+        with self.lock:
+            if self._gpio is None:
+                import RPi.GPIO as GPIO
+                GPIO.setmode(GPIO.BCM)
+                GPIO.setup(self.config['BUTTON_PIN'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
+                GPIO.setup(self.config['LED_PIN'], GPIO.OUT)
+                self._gpio = GPIO
+            return self._gpio
+
+    @property
+    def adc(self):
+        """MCP3008 ADC for the analog sensors."""
+        with self.lock:
+            if self._adc is None:
+                import Adafruit_MCP3008
+                self._adc = Adafruit_MCP3008.MCP3008(
+                    clk=self.config['CLK_PIN'],
+                    cs=self.config['CS_PIN'],
+                    miso=self.config['MISO_PIN'],
+                    mosi=self.config['MOSI_PIN']
+                )
+            return self._adc
+
+    def create_temp_bus(self, **kwargs):
+        """DS18B20 bus on the 1-Wire interface, loading its kernel modules once."""
+        with self.lock:
+            if not self._w1_loaded:
+                for module in ('w1-gpio', 'w1-therm'):
+                    result = subprocess.run(['modprobe', module], capture_output=True, text=True)
+                    if result.returncode != 0:
+                        logger.warning(f"modprobe {module} failed: {result.stderr.strip()}")
+                self._w1_loaded = True
+        return DS18B20Bus('/sys/bus/w1/devices/', **kwargs)
+
+    def create_gps_service(self):
+        """GPS service reading the NEO-6M serial port."""
+        return GPSService(self.config['GPS_PORT'], baudrate=self.config['GPS_BAUD'])
+
+    def cleanup(self):
+        """Release the GPIO pins if they were used."""
+        if self._gpio is not None:
+            self._gpio.cleanup()
+
+
+class SimulatedGPIO:
+    """In-memory stand-in for RPi.GPIO."""
+    BCM = 'BCM'
+    IN = 'IN'
+    OUT = 'OUT'
+    PUD_UP = 'PUD_UP'
+    HIGH = 1
+    LOW = 0
+    FALLING = 'FALLING'
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        # Inputs with a pull-up idle high
+        self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def press(self, pin, duration=0.3):
+        """Simulate a button press: pull the pin low and fire its callback."""
+        self.levels[pin] = self.LOW
+        callback = self.callbacks.get(pin)
+        if callback:
+            threading.Thread(target=callback, args=(pin,), daemon=True).start()
+        threading.Timer(duration, self.levels.__setitem__, (pin, self.HIGH)).start()
+
+    def cleanup(self):
+        self.levels.clear()
+        self.callbacks.clear()
+
+
+class SimulatedADC:
+    """MCP3008 stand-in returning a noisy level per channel."""
+    def __init__(self, levels, noise=2.0, latency=0.0, rng=None):
+        """
+        Args:
+            levels: Dict mapping channel to its mean raw reading (0-1023)
+            noise: Standard deviation of the reading noise in counts
+            latency: Seconds per read_adc() call
+            rng: random.Random instance
+        """
+        self.levels = dict(levels)
+        self.noise = noise
+        self.latency = latency
+        self.rng = rng or random.Random()
+
+    def read_adc(self, channel):
+        if self.latency:
+            time.sleep(self.latency)
+        value = self.rng.gauss(self.levels.get(channel, 0), self.noise)
+        return min(max(int(round(value)), 0), 1023)
+
+
+class SimulatedDS18B20Bus(DS18B20Bus):
+    """DS18B20 probes with a conversion delay, noise and occasional CRC errors."""
+    def __init__(self, temperatures, noise=0.05, conversion_time=0.75,
+                 crc_error_rate=0.0, rng=None, **kwargs):
+        """
+        Args:
+            temperatures: Dict mapping ROM ID to its mean temperature in Celsius
+            noise: Standard deviation of the temperature noise
+            conversion_time: Seconds per temperature conversion
+            crc_error_rate: Probability that a read fails its CRC check
+            rng: random.Random instance
+        """
+        super().__init__(base_dir='', **kwargs)
+        self.temperatures = dict(temperatures)
+        self.noise = noise
+        self.conversion_time = conversion_time
+        self.crc_error_rate = crc_error_rate
+        self.rng = rng or random.Random()
+        self.converted = False
+
+    def discover(self):
+        self.probes = {rom_id: rom_id for rom_id in sorted(self.temperatures)}
+        return self.probes
+
+    def trigger_bulk_conversion(self):
+        if not self.use_bulk_read:
+            return False
+        time.sleep(self.conversion_time)
+        self.converted = True
+        return True
+
+    def read_w1_slave(self, rom_id):
+        if not self.converted:
+            time.sleep(self.conversion_time)
+        crc = 'NO' if self.rng.random() < self.crc_error_rate else 'YES'
+        millidegrees = int(round(self.rng.gauss(self.temperatures[rom_id], self.noise) * 1000))
+        return [f"72 01 4b 46 7f ff 0e 10 57 : crc=57 {crc}\n",
+                f"72 01 4b 46 7f ff 0e 10 57 t={millidegrees}\n"]
+
+    def read_all(self):
+        self.converted = False
+        try:
+            return super().read_all()
+        finally:
+            self.converted = False
+
+
+def nmea_coordinate(value, positive, negative, degree_digits):
+    """Format decimal degrees as an NMEA ddmm.mmmm field and hemisphere."""
+    hemisphere = positive if value >= 0 else negative
+    value = abs(value)
+    degrees = int(value)
+    minutes = (value - degrees) * 60
+    return f"{degrees:0{degree_digits}d}{minutes:07.4f}", hemisphere
+
+
+def nmea_sentence(body):
+    """Wrap a sentence body with $ and its checksum."""
+    checksum = 0
+    for char in body:
+        checksum ^= ord(char)
+    return f"${body}*{checksum:02X}\r\n".encode('ascii')
+
+
+class SimulatedNMEAStream:
+    """
+    NEO-6M stand-in: readline() returns RMC and GGA sentences for a position
+    that wanders slightly, paced at the receiver's update interval.
+    """
+    def __init__(self, latitude, longitude, interval=1.0, jitter=0.00002, hdop=0.9,
+                 num_sats=8, rng=None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.interval = interval
+        self.jitter = jitter
+        self.hdop = hdop
+        self.num_sats = num_sats
+        self.rng = rng or random.Random()
+        self.pending = []
+        self.next_time = time.monotonic()
+
+    def readline(self):
+        if not self.pending:
+            delay = self.next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_time = max(self.next_time, time.monotonic()) + self.interval
+            self.pending = self.sentences()
+        return self.pending.pop(0)
+
+    def sentences(self):
+        """One update: an RMC and a GGA sentence."""
+        self.latitude += self.rng.gauss(0, self.jitter)
+        self.longitude += self.rng.gauss(0, self.jitter)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        hhmmss = now.strftime("%H%M%S")
+        lat, ns = nmea_coordinate(self.latitude, 'N', 'S', 2)
+        lon, ew = nmea_coordinate(self.longitude, 'E', 'W', 3)
+        return [
+            nmea_sentence(f"GPRMC,{hhmmss},A,{lat},{ns},{lon},{ew},0.0,0.0,{now:%d%m%y},,"),
+            nmea_sentence(f"GPGGA,{hhmmss},{lat},{ns},{lon},{ew},1,{self.num_sats:02d},"
+                          f"{self.hdop},10.0,M,0.0,M,,"),
+        ]
+
+
+class SimulatedHardware:
+    """
+    Simulated sensors and I/O with configurable latency and noise.
+
+    The defaults give readings around 14 °C, pH 7 and 240 NTU with noise
+    comparable to the real sensors. ADC latency is per read_adc() call.
+    """
+    name = 'sim'
+
+    def __init__(self, config, seed=None, adc_latency=0.0, adc_noise=2.0,
+                 ph_voltage=2.6, turbidity_voltage=2.3, temperatures=None, temp_noise=0.05,
+                 temp_conversion_time=0.75, crc_error_rate=0.0, position=(51.8998, -2.0784),
+                 gps_interval=1.0):
+        self.config = config
+        self.rng = random.Random(seed)
+        self.adc_latency = adc_latency
+        self.adc_noise = adc_noise
+        self.ph_voltage = ph_voltage
+        self.turbidity_voltage = turbidity_voltage
+        self.temperatures = temperatures or {'28-00000000sim1': 14.0}
+        self.temp_noise = temp_noise
+        self.temp_conversion_time = temp_conversion_time
+        self.crc_error_rate = crc_error_rate
+        self.position = position
+        self.gps_interval = gps_interval
+        self.lock = threading.Lock()
+        self._gpio = None
+        self._adc = None
+
+    @property
+    def gpio(self):
+        with self.lock:
+            if self._gpio is None:
+                self._gpio = SimulatedGPIO()
+                self._gpio.setup(self.config['BUTTON_PIN'], SimulatedGPIO.IN,
+                                 pull_up_down=SimulatedGPIO.PUD_UP)
+                self._gpio.setup(self.config['LED_PIN'], SimulatedGPIO.OUT)
+            return self._gpio
+
+    @property
+    def adc(self):
+        with self.lock:
+            if self._adc is None:
+                counts = lambda volts: volts * 1023.0 / 3.3
+                self._adc = SimulatedADC({
+                    self.config['PH_CHANNEL']: counts(self.ph_voltage),
+                    self.config['TURBIDITY_CHANNEL']: counts(self.turbidity_voltage),
+                }, noise=self.adc_noise, latency=self.adc_latency,
+                    rng=random.Random(self.rng.random()))
+            return self._adc
+
+    def create_temp_bus(self, **kwargs):
+        return SimulatedDS18B20Bus(self.temperatures, noise=self.temp_noise,
+                                   conversion_time=self.temp_conversion_time,
+                                   crc_error_rate=self.crc_error_rate,
+                                   rng=random.Random(self.rng.random()), **kwargs)
+
+    def create_gps_service(self):
+        stream = SimulatedNMEAStream(*self.position, interval=self.gps_interval,
+                                     rng=random.Random(self.rng.random()))
+        return GPSService(stream=stream)
+
+    def cleanup(self):
+        if self._gpio is not None:
+            self._gpio.cleanup()
+
+
+BACKENDS = {
+    'pi': PiHardware,
+    'sim': SimulatedHardware,
+}
+
+
+def create_hardware(name, config, **kwargs):
+    """
+    Create a hardware backend by name.
+
+    Raises:
+        ValueError: If name is not one of BACKENDS
+    """
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown hardware backend '{name}', expected one of {sorted(BACKENDS)}")
+    return backend(config, **kwargs)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - DS18B20 1-Wire temperature probes
+
+Discovers every DS18B20 probe on the 1-Wire bus and reads them together,
+keyed by ROM ID (e.g. 28-0316a2795aff). Where the kernel's w1 driver offers
+therm_bulk_read, one conversion is triggered on all probes at once;
+otherwise each probe's ~750 ms conversion runs on its own thread.
+
+All paths are relative to a base directory, so a fake sysfs tree can stand
+in for /sys/bus/w1/devices:
+
+    python3 ds18b20.py --base-dir /tmp/fake_w1
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import os
+import glob
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# DS18B20 family code prefix of the device folders
+FAMILY_PREFIX = '28-'
+
+# DS18B20 operating range in degrees C
+MIN_TEMPERATURE = -55.0
+MAX_TEMPERATURE = 125.0
+
+
+class DS18B20Bus:
+    """All DS18B20 probes under a 1-Wire sysfs devices directory."""
+    def __init__(self, base_dir='/sys/bus/w1/devices/', max_retries=3, retry_delay=0.2,
+                 use_bulk_read=True, bulk_timeout=2.0):
+        """
+        Args:
+            base_dir: 1-Wire sysfs devices directory
+            max_retries: Extra attempts per probe after a CRC failure
+            retry_delay: Seconds between attempts
+            use_bulk_read: Use therm_bulk_read when the driver provides it
+            bulk_timeout: Seconds to wait for a bulk conversion to finish
+        """
+        self.base_dir = base_dir
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.use_bulk_read = use_bulk_read
+        self.bulk_timeout = bulk_timeout
+        self.probes = {}
+        self.crc_retries = 0
+        self.executor = None
+
+    def discover(self):
+        """
+        Find all DS18B20 probes.
+
+        Returns:
+            dict: ROM ID -> device folder, sorted by ROM ID
+        """
+        folders = sorted(glob.glob(os.path.join(self.base_dir, FAMILY_PREFIX + '*')))
+        self.probes = {os.path.basename(folder): folder for folder in folders}
+        if self.probes:
+            logger.info(f"DS18B20 probes found: {', '.join(self.probes)}")
+        else:
+            logger.error("DS18B20 sensor not found. Check connections.")
+        return self.probes
+
+    def bulk_read_files(self):
+        """therm_bulk_read attribute of each bus master that provides one."""
+        return glob.glob(os.path.join(self.base_dir, 'w1_bus_master*', 'therm_bulk_read'))
+
+    def trigger_bulk_conversion(self):
+        """
+        Start a conversion on every probe at once and wait for it to finish.
+
+        Returns:
+            bool: True if a bulk conversion was done
+        """
+        files = self.bulk_read_files() if self.use_bulk_read else []
+        if not files:
+            return False
+        try:
+            for path in files:
+                with open(path, 'w') as f:
+                    f.write('trigger\n')
+            # -1 means conversions are still in progress
+            deadline = time.monotonic() + self.bulk_timeout
+            for path in files:
+                while True:
+                    with open(path, 'r') as f:
+                        status = f.read().strip()
+                    if status != '-1' or time.monotonic() >= deadline:
+                        break
+                    time.sleep(0.05)
+            return True
+        except OSError as e:
+            logger.warning(f"DS18B20 bulk conversion failed, reading probes individually: {e}")
+            return False
+
+    def read_w1_slave(self, rom_id):
+        """Lines of a probe's w1_slave file (CRC line, then temperature line)."""
+        folder = self.probes.get(rom_id) or os.path.join(self.base_dir, rom_id)
+        with open(os.path.join(folder, 'w1_slave'), 'r') as f:
+            return f.readlines()
+
+    def read_probe(self, rom_id):
+        """
+        Read one probe, retrying CRC failures up to max_retries times.
+
+        Returns:
+            float: Temperature in Celsius, or None if error
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.crc_retries += 1
+                time.sleep(self.retry_delay)
+            try:
+                lines = self.read_w1_slave(rom_id)
+            except OSError as e:
+                logger.error(f"Error reading DS18B20 {rom_id}: {e}")
+                return None
+
+            # Check if CRC is valid (YES at the end of first line)
+            if len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+                logger.warning(f"DS18B20 {rom_id} CRC check failed (attempt {attempt + 1})")
+                continue
+
+            # Extract temperature from second line
+            equals_pos = lines[1].find('t=')
+            if equals_pos == -1:
+                logger.warning(f"DS18B20 {rom_id} returned no temperature")
+                return None
+            try:
+                temp_c = float(lines[1][equals_pos + 2:]) / 1000.0
+            except ValueError:
+                logger.warning(f"DS18B20 {rom_id} returned a garbled temperature: {lines[1].strip()!r}")
+                return None
+            if MIN_TEMPERATURE <= temp_c <= MAX_TEMPERATURE:
+                return round(temp_c, 2)
+            logger.warning(f"DS18B20 {rom_id} reading out of range: {temp_c}°C")
+            return None
+
+        logger.error(f"DS18B20 {rom_id} CRC check failed after {self.max_retries + 1} attempts")
+        return None
+
+    def read_all(self):
+        """
+        Read every discovered probe.
+
+        Returns:
+            dict: ROM ID -> temperature in Celsius (None for failed probes)
+        """
+        if not self.probes and not self.discover():
+            return {}
+        rom_ids = list(self.probes)
+        if self.trigger_bulk_conversion():
+            # Values are already converted; each read just fetches the scratchpad
+            return {rom_id: self.read_probe(rom_id) for rom_id in rom_ids}
+        if len(rom_ids) == 1:
+            return {rom_ids[0]: self.read_probe(rom_ids[0])}
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ds18b20")
+        return dict(zip(rom_ids, self.executor.map(self.read_probe, rom_ids)))
+
+
+def main():
+    """Print the temperature of every probe."""
+    parser = argparse.ArgumentParser(description="Read all DS18B20 probes")
+    parser.add_argument('--base-dir', default='/sys/bus/w1/devices/',
+                        help="1-Wire sysfs devices directory")
+    parser.add_argument('--no-bulk', action='store_true', help="Do not use therm_bulk_read")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    bus = DS18B20Bus(args.base_dir, use_bulk_read=not args.no_bulk)
+    start = time.monotonic()
+    readings = bus.read_all()
+    elapsed = time.monotonic() - start
+    for rom_id, temp_c in readings.items():
+        print(f"{rom_id}: {temp_c}")
+    print(f"Read {len(readings)} probes in {elapsed:.3f}s ({bus.crc_retries} CRC retries)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Background GPS service
+
+Keeps the NEO-6M serial port open and parses the NMEA stream continuously
+in a background thread, so the latest fix is always available without
+touching the serial port.
+
+The service reads from any object with a readline() method, so a pty or a
+file of recorded NMEA sentences can stand in for the real module:
+
+    python3 gps_service.py --replay recorded.nmea
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import time
+import logging
+import threading
+import argparse
+import serial
+import pynmea2
+
+logger = logging.getLogger(__name__)
+
+
+class GPSFix:
+    """A position fix with the receiver's quality indicators."""
+    def __init__(self, latitude, longitude, hdop=None, num_sats=None, received=None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.hdop = hdop
+        self.num_sats = num_sats
+        # Monotonic time the fix was received, used to compute its age
+        self.received = time.monotonic() if received is None else received
+
+    @property
+    def age(self):
+        """Seconds since the fix was received."""
+        return time.monotonic() - self.received
+
+    def __str__(self):
+        return f"{self.latitude:.6f},{self.longitude:.6f}"
+
+    def __repr__(self):
+        return (f"GPSFix({self.latitude:.6f}, {self.longitude:.6f}, hdop={self.hdop}, "
+                f"num_sats={self.num_sats}, age={self.age:.1f}s)")
+
+
+class GPSService:
+    """
+    Long-lived NMEA reader that caches the latest GPS fix.
+
+    RMC sentences provide the position and validity, GGA sentences provide
+    the position, HDOP and satellite count. Readers call latest_fix() or
+    wait_for_fix(), which never do serial I/O.
+    """
+    def __init__(self, port=None, baudrate=9600, stream=None, reconnect_delay=5.0):
+        """
+        Args:
+            port: Serial device path (e.g. /dev/ttyS0 or a pty)
+            baudrate: Serial baud rate
+            stream: Object with readline() to read NMEA from instead of a port.
+                Reading stops when it returns an empty line (end of replay).
+            reconnect_delay: Seconds to wait before reopening a failed port
+        """
+        if port is None and stream is None:
+            raise ValueError("Either a serial port or a stream is required")
+        self.port = port
+        self.baudrate = baudrate
+        self.stream = stream
+        self.reconnect_delay = reconnect_delay
+        self.fix = None
+        self.hdop = None
+        self.num_sats = None
+        self.sentences = 0
+        self.parse_errors = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start reading NMEA sentences in a background thread."""
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="gps-reader", daemon=True)
+        self.thread.start()
+        logger.info(f"GPS service started on {self.port or type(self.stream).__name__}")
+
+    def stop(self, timeout=2.0):
+        """Stop the reader thread."""
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout)
+        logger.info("GPS service stopped")
+
+    def latest_fix(self, max_age=None):
+        """
+        Get the cached fix.
+
+        Args:
+            max_age: Ignore a fix older than this many seconds
+
+        Returns:
+            GPSFix: Latest fix, or None if there is no (fresh enough) fix
+        """
+        fix = self.fix
+        if fix is None or (max_age is not None and fix.age > max_age):
+            return None
+        return fix
+
+    def wait_for_fix(self, timeout, max_age=None):
+        """
+        Get the cached fix, waiting up to timeout seconds for one to arrive.
+
+        Returns immediately when a fresh enough fix is already cached.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                fix = self.latest_fix(max_age)
+                remaining = deadline - time.monotonic()
+                if fix is not None or remaining <= 0 or not self.running:
+                    return fix
+                self.condition.wait(remaining)
+
+    def process_sentence(self, line):
+        """Parse one NMEA sentence and update the cached fix."""
+        if isinstance(line, bytes):
+            line = line.decode('ascii', errors='replace')
+        line = line.strip()
+        if not line.startswith('$'):
+            return
+        self.sentences += 1
+        try:
+            msg = pynmea2.parse(line)
+        except pynmea2.ParseError as e:
+            self.parse_errors += 1
+            logger.debug(f"Error parsing NMEA sentence: {e}")
+            return
+
+        if isinstance(msg, pynmea2.types.talker.GGA):
+            self.hdop = float(msg.horizontal_dil) if msg.horizontal_dil else None
+            self.num_sats = int(msg.num_sats) if msg.num_sats else 0
+            if msg.gps_qual:  # 0 = no fix
+                self._update_fix(msg.latitude, msg.longitude)
+        elif isinstance(msg, pynmea2.types.talker.RMC):
+            if msg.status == 'A':  # A=Active (valid), V=Void (invalid)
+                self._update_fix(msg.latitude, msg.longitude)
+
+    def _update_fix(self, latitude, longitude):
+        fix = GPSFix(float(latitude), float(longitude), self.hdop, self.num_sats)
+        with self.condition:
+            self.fix = fix
+            self.condition.notify_all()
+        logger.debug(f"GPS fix updated: {fix!r}")
+
+    def _run(self):
+        """Reader loop; reopens the serial port after errors."""
+        while self.running:
+            try:
+                if self.stream is not None:
+                    self._read_lines(self.stream)
+                    break
+                with serial.Serial(self.port, baudrate=self.baudrate, timeout=1) as ser:
+                    self._read_lines(ser)
+            except Exception as e:
+                logger.error(f"Error reading GPS module: {e}")
+                time.sleep(self.reconnect_delay)
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+
+    def _read_lines(self, source):
+        while self.running:
+            line = source.readline()
+            if not line:
+                if self.stream is not None:
+                    logger.info("End of GPS replay stream")
+                    return
+                continue  # Serial read timeout
+            self.process_sentence(line)
+
+
+def main():
+    """Print fixes from a serial port or a recorded NMEA file."""
+    parser = argparse.ArgumentParser(description="PiAquaPulse GPS service")
+    parser.add_argument('--port', default='/dev/ttyS0', help="Serial port to read")
+    parser.add_argument('--baud', type=int, default=9600, help="Serial baud rate")
+    parser.add_argument('--replay', help="Read NMEA sentences from this file instead")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.replay:
+        service = GPSService(stream=open(args.replay, 'rb'))
+    else:
+        service = GPSService(args.port, args.baud)
+    service.start()
+    try:
+        while service.running:
+            fix = service.wait_for_fix(timeout=1.0, max_age=1.0)
+            if fix:
+                print(repr(fix))
+            time.sleep(1.0)
+        if service.fix:
+            print(f"Last fix: {service.fix!r}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
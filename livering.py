@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Shared-memory ring of recent readings
+
+PAPScript.py publishes every reading into a fixed-size ring of binstore
+records in a named multiprocessing.shared_memory segment, and dashapp.py
+reads the latest readings straight out of it, without any file I/O. When
+the logger is not running the dashboard falls back to the data file.
+
+Segment layout (little-endian):
+
+    0   magic       8 bytes
+    8   version     uint16
+    10  record size uint16
+    12  capacity    uint32
+    16  writer pid  uint32
+    24  sequence    uint64
+    32  capacity records of binstore.RECORD_DTYPE
+
+The sequence is a seqlock: the writer makes it odd before changing a
+record and even again afterwards, so sequence // 2 is the number of
+readings published so far and an odd value marks the slot after them as
+being written. A reader copies the records it wants and reads the
+sequence again; the copy is only discarded if the writer has meanwhile
+reached one of the copied slots. Readers never see a half-written record,
+never block the writer and, as they read at most capacity - 1 records,
+only retry when the writer laps them.
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import os
+import sys
+import struct
+import logging
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+from binstore import RECORD_DTYPE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PAQPRING'
+VERSION = 1
+
+# magic, version, record size, capacity, writer pid
+HEADER = struct.Struct('<8sHHII4x')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = HEADER.size
+RECORDS_OFFSET = SEQUENCE_OFFSET + SEQUENCE.size
+
+# Attempts at a consistent read before giving up on a busy writer
+READ_RETRIES = 100
+
+
+def process_alive(pid):
+    """Whether a process with this PID exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, owned by another user
+    return True
+
+
+def attach_segment(name):
+    """
+    Attach to an existing segment without taking ownership of it.
+
+    Before Python 3.13 attaching registers the segment with this process's
+    resource tracker, which would unlink it when the process exits and pull
+    it out from under the logger.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    segment = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+class RingWriter:
+    """
+    Publish readings into a new shared-memory ring.
+
+    Only one process may write to a ring. A segment left behind by a logger
+    that did not shut down cleanly is replaced.
+    """
+    def __init__(self, name, capacity=1024):
+        self.name = name
+        self.capacity = capacity
+        size = RECORDS_OFFSET + capacity * RECORD_DTYPE.itemsize
+        try:
+            self.segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.buffer = self.segment.buf
+        self.records = np.ndarray(capacity, dtype=RECORD_DTYPE, buffer=self.buffer,
+                                  offset=RECORDS_OFFSET)
+        self.sequence = 0
+        SEQUENCE.pack_into(self.buffer, SEQUENCE_OFFSET, 0)
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, RECORD_DTYPE.itemsize, capacity, os.getpid())
+
+    @property
+    def count(self):
+        """Number of readings published so far."""
+        return self.sequence // 2
+
+    def publish(self, record):
+        """
+        Add one record, overwriting the oldest once the ring is full.
+
+        Args:
+            record: Record of binstore.RECORD_DTYPE
+        """
+        slot = self.count % self.capacity
+        self.sequence += 1
+        SEQUENCE.pack_into(self.buffer, SEQUENCE_OFFSET, self.sequence)
+        self.records[slot] = record
+        self.sequence += 1
+        SEQUENCE.pack_into(self.buffer, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        """Remove the ring; readers fall back to the data file."""
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, RECORD_DTYPE.itemsize, self.capacity, 0)
+        # Views into the segment must be released before it can be closed
+        del self.records
+        self.buffer = None
+        self.segment.close()
+        try:
+            self.segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class RingReader:
+    """
+    Read the latest readings from a ring published by another process.
+
+    Attaches on first use and re-attaches when a restarted logger has
+    replaced the ring.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.segment = None
+        self.records = None
+
+    def _attach(self):
+        try:
+            segment = attach_segment(self.name)
+        except FileNotFoundError:
+            return False
+        magic, version, record_size, capacity, _ = HEADER.unpack_from(segment.buf, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+            logger.warning(f"Shared memory segment {self.name} is not a reading ring")
+            segment.close()
+            return False
+        self.segment = segment
+        self.capacity = capacity
+        self.records = np.ndarray(capacity, dtype=RECORD_DTYPE, buffer=segment.buf,
+                                  offset=RECORDS_OFFSET)
+        return True
+
+    def _detach(self):
+        self.records = None
+        self.segment.close()
+        self.segment = None
+
+    def available(self):
+        """Whether a running logger is publishing to the ring."""
+        if self.segment is None and not self._attach():
+            return False
+        pid = HEADER.unpack_from(self.segment.buf, 0)[4]
+        if not pid or not process_alive(pid):
+            # The logger exited or crashed; its successor creates a new segment
+            self._detach()
+            return False
+        return True
+
+    def latest(self, count):
+        """
+        Get the latest readings.
+
+        Args:
+            count: Maximum number of readings
+
+        Returns:
+            numpy.ndarray: Up to count records of binstore.RECORD_DTYPE, oldest
+            first, or None if no logger is publishing
+        """
+        result = self._read(count)
+        return None if result is None else result[0]
+
+    def read_since(self, seen):
+        """
+        Get the readings published after the first seen ones, as far as the
+        ring still holds them.
+
+        Args:
+            seen: Number of readings already read
+
+        Returns:
+            tuple: (records, number of readings published so far), or None if
+            no logger is publishing
+        """
+        if not self.available():
+            return None
+        published = SEQUENCE.unpack_from(self.segment.buf, SEQUENCE_OFFSET)[0] // 2
+        if published <= seen:
+            return self.records[:0].copy(), published
+        return self._read(published - seen, published)
+
+    def _read(self, count, published=None):
+        """Up to count records and the number published after the last of
+        them; the records end at published if given, else at the latest."""
+        if not self.available():
+            return None
+        buffer = self.segment.buf
+        for _ in range(READ_RETRIES):
+            before, = SEQUENCE.unpack_from(buffer, SEQUENCE_OFFSET)
+            end = before // 2 if published is None else published
+            wanted = max(min(count, end, self.capacity - 1), 0)
+            slots = np.arange(end - wanted, end) % self.capacity
+            result = self.records[slots]  # Copy, checked below
+            after, = SEQUENCE.unpack_from(buffer, SEQUENCE_OFFSET)
+            # Slots written since, including one still being written
+            written = (after + 1) // 2 - end
+            if written <= self.capacity - wanted:
+                return result, end
+        logger.warning(f"No consistent read of {self.name} after {READ_RETRIES} attempts")
+        return None
+
+    def close(self):
+        if self.segment is not None:
+            self._detach()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Runtime metrics
+
+Counters, gauges and histograms recorded by PAPScript.py, for example how
+long each stage of a reading took, how many CRC retries the DS18B20 probes
+needed and how deep the data writer's queue is.
+
+Recording a value only updates a few numbers in memory. The logger writes a
+JSON snapshot of all metrics at most every METRICS_INTERVAL seconds, and
+dashapp.py serves the latest snapshot in Prometheus text format at /metrics:
+
+    scrape_configs:
+      - job_name: piaquapulse
+        static_configs:
+          - targets: ['raspberrypi.local:5000']
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import json
+import math
+import time
+import bisect
+import logging
+import threading
+
+from datastore import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds, from ADC bursts to GPS waits
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """Monotonically increasing count."""
+    type = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def sample(self):
+        return {'value': self.value}
+
+
+class Gauge:
+    """
+    Value that can go up and down.
+
+    A gauge can be given a function instead of being set, in which case the
+    function is only called when a snapshot is taken.
+    """
+    type = 'gauge'
+
+    def __init__(self, func=None):
+        self.value = math.nan
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        value = self.value
+        if self.func is not None:
+            try:
+                value = self.func()
+            except Exception as e:
+                logger.debug(f"Gauge function failed: {e}")
+                value = None
+        return {'value': math.nan if value is None else value}
+
+
+class CounterFunc(Gauge):
+    """Counter whose value is read from a function, e.g. a driver's own count."""
+    type = 'counter'
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets."""
+    type = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # Last is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager observing the duration of its block."""
+        return _Timer(self)
+
+    def sample(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = []
+        running = 0
+        for n in counts:
+            running += n
+            cumulative.append(running)
+        return {'buckets': list(self.buckets), 'counts': cumulative,
+                'sum': total, 'count': count}
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Registry:
+    """
+    Named metric families, each holding one metric per label set.
+
+    Asking for the same name and labels again returns the same metric, so
+    callers can look metrics up where they use them.
+    """
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = {'type': cls.type, 'help': help, 'metrics': {}}
+            elif family['type'] != cls.type:
+                raise ValueError(f"Metric {name} is already registered as a {family['type']}")
+            metric = family['metrics'].get(key)
+            if metric is None:
+                metric = family['metrics'][key] = cls(**kwargs)
+            return metric
+
+    def counter(self, name, help, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def counter_func(self, name, help, func, **labels):
+        metric = self._get(CounterFunc, name, help, labels)
+        metric.func = func
+        return metric
+
+    def gauge(self, name, help, func=None, **labels):
+        metric = self._get(Gauge, name, help, labels)
+        if func is not None:
+            metric.func = func
+        return metric
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def snapshot(self):
+        """
+        Current value of every metric.
+
+        Returns:
+            dict: JSON-serializable snapshot, as read by render_prometheus()
+        """
+        with self.lock:
+            families = {name: (family['type'], family['help'], list(family['metrics'].items()))
+                        for name, family in self.families.items()}
+        return {
+            'time': time.time(),
+            'families': [
+                {
+                    'name': name,
+                    'type': type_,
+                    'help': help,
+                    'samples': [dict(metric.sample(), labels=dict(key)) for key, metric in metrics],
+                }
+                for name, (type_, help, metrics) in sorted(families.items())
+            ],
+        }
+
+
+class SnapshotWriter:
+    """
+    Write a registry's snapshot to a JSON file, at most once per interval.
+
+    start() writes it every interval from a background thread, so the file
+    stays current even while no readings are taken.
+    """
+    def __init__(self, registry, path, interval=15.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.last_write = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start writing a snapshot every interval in a background thread."""
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        self.maybe_write()
+        while not self.stop_event.wait(self.interval):
+            self.maybe_write()
+
+    def maybe_write(self):
+        """Write a snapshot if the last one is older than the interval."""
+        now = time.monotonic()
+        if self.last_write is not None and now - self.last_write < self.interval:
+            return False
+        if not self.lock.acquire(blocking=False):
+            return False  # Another thread is writing one
+        try:
+            self.last_write = now
+            self.write()
+            return True
+        finally:
+            self.lock.release()
+
+    def write(self):
+        """Atomically replace the snapshot file."""
+        try:
+            write_snapshot(self.registry.snapshot(), self.path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics snapshot {self.path}: {e}")
+
+
+def write_snapshot(snapshot, path):
+    """Write a snapshot so that readers never see a partial file."""
+    write_json_atomic(snapshot, path)
+
+
+def read_snapshot(path):
+    """Read a snapshot file, or None if there is none."""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def format_value(value):
+    """Format a sample value the way Prometheus expects."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NaN'
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def render_prometheus(snapshot):
+    """
+    Render a snapshot in the Prometheus text exposition format.
+
+    Returns:
+        str: Exposition text ending in a newline
+    """
+    lines = []
+    for family in snapshot['families']:
+        name = family['name']
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample in family['samples']:
+            labels = sample['labels']
+            if family['type'] == 'histogram':
+                bounds = [format_value(b) for b in sample['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, sample['counts']):
+                    lines.append(f"{name}_bucket{format_labels(dict(labels, le=bound))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(sample['sum'])}")
+                lines.append(f"{name}_count{format_labels(labels)} {sample['count']}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {format_value(sample['value'])}")
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+registry = Registry()
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Time-partitioned data files
+
+With PARTITIONING set to 'daily' or 'monthly', PAPScript.py writes each
+period's readings to its own file next to the data file (or in
+PARTITION_DIR), named after the period it covers:
+
+    river_data-2024-06-01.csv      daily
+    river_data-2024-06.csv         monthly
+
+Once the logger moves on to a new partition, the previous one is closed and
+compressed in the background (river_data-2024-06-01.csv.gz, or .zst with
+the optional zstandard package). Old partitions can then simply be deleted
+or moved off the SD card.
+
+PartitionSet is the reader side: it lists the partitions, skips those
+outside a query's time range, and streams the rest, decompressing as it
+goes. A legacy single data file, if present, is read as a partition with no
+time bounds, so existing deployments keep working unchanged.
+
+Compress closed partitions by hand (e.g. after copying them off a Pi):
+
+    python3 partitions.py compress river_data.csv --compression gzip
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import io
+import os
+import re
+import gzip
+import queue
+import shutil
+import logging
+import argparse
+import datetime
+import threading
+import numpy as np
+
+from datastore import (DataWriter, LatestRowCache, SparseIndex, NUMERIC_COLUMNS,
+                       read_range, read_range_lines, concat_ranges, empty_range, parse_row)
+
+logger = logging.getLogger(__name__)
+
+# Partition label format (local time) for each partitioning
+PARTITIONINGS = {
+    'daily': '%Y-%m-%d',
+    'monthly': '%Y-%m',
+}
+
+# File suffix of each compression method
+COMPRESSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Suffix of a compressed file still being written
+PARTIAL_SUFFIX = '.partial'
+
+
+def partition_label(when, partitioning):
+    """Label of the partition holding a reading taken at epoch seconds when."""
+    return datetime.datetime.fromtimestamp(when).strftime(PARTITIONINGS[partitioning])
+
+
+def label_span(label):
+    """
+    Time range covered by a partition label.
+
+    Returns:
+        tuple: (start, end) epoch seconds, end exclusive
+    """
+    if len(label) == 10:
+        start = datetime.datetime.strptime(label, PARTITIONINGS['daily'])
+        end = start + datetime.timedelta(days=1)
+    else:
+        start = datetime.datetime.strptime(label, PARTITIONINGS['monthly'])
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return start.timestamp(), end.timestamp()
+
+
+def zstd_module():
+    """The optional zstandard package."""
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd compression needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def compress_file(path, compression='gzip'):
+    """
+    Compress a closed partition and remove the original.
+
+    The compressed file is written under a temporary name and renamed into
+    place before the original is removed, so a partition is never missing.
+
+    Returns:
+        str: Path of the compressed file
+    """
+    target = path + COMPRESSIONS[compression]
+    partial = target + PARTIAL_SUFFIX
+    with open(path, 'rb') as source:
+        if compression == 'zstd':
+            compressor = zstd_module().ZstdCompressor(level=10)
+            with open(partial, 'wb') as f:
+                compressor.copy_stream(source, f)
+        else:
+            with gzip.open(partial, 'wb', compresslevel=6) as f:
+                shutil.copyfileobj(source, f, 1024 * 1024)
+    os.replace(partial, target)
+    os.remove(path)
+    return target
+
+
+def open_partition(path):
+    """Open a partition for reading as a binary stream, decompressing if needed."""
+    if path.endswith(COMPRESSIONS['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(COMPRESSIONS['zstd']):
+        f = open(path, 'rb')
+        return io.BufferedReader(zstd_module().ZstdDecompressor().stream_reader(f, closefd=True))
+    return open(path, 'rb')
+
+
+def partition_compressed(path):
+    """Whether a partition path is of a compressed file."""
+    return path.endswith(tuple(COMPRESSIONS.values()))
+
+
+def read_binary_range(path, start=None, end=None):
+    """
+    Read the rows of a binary store (plain or compressed) between start and end.
+
+    Returns:
+        dict: As datastore.read_range()
+    """
+    from binstore import open_records, check_header, RECORD_DTYPE
+    if partition_compressed(path):
+        with open_partition(path) as f:
+            check_header(f, path)
+            data = f.read()
+        usable = len(data) - len(data) % RECORD_DTYPE.itemsize
+        records = np.frombuffer(data[:usable], dtype=RECORD_DTYPE)
+    else:
+        try:
+            records = open_records(path)
+        except FileNotFoundError:
+            return empty_range()
+    first = np.searchsorted(records['time'], start) if start is not None else 0
+    last = np.searchsorted(records['time'], end, side='right') if end is not None else len(records)
+    records = records[first:last]
+    result = {'time': np.array(records['time'], dtype=np.float64)}
+    for name in NUMERIC_COLUMNS:
+        # float32 -> float64 at the 2 decimals the logger records
+        result[name] = np.round(np.array(records[name], dtype=np.float64), 2)
+    return result
+
+
+class Partition:
+    """One partition file and the time range it covers."""
+    def __init__(self, path, label=None):
+        self.path = path
+        self.label = label
+        if label is None:
+            self.start, self.end = None, None  # Legacy single file
+        else:
+            self.start, self.end = label_span(label)
+        self.compressed = path.endswith(tuple(COMPRESSIONS.values()))
+
+    def overlaps(self, start, end):
+        if self.label is None:
+            return True
+        return (start is None or self.end > start) and (end is None or self.start <= end)
+
+    def __repr__(self):
+        return f"Partition({self.path!r})"
+
+
+class PartitionSet:
+    """
+    The partitions of one data file, for readers.
+
+    The directory listing is cached on the directory's modification time,
+    and a SparseIndex and LatestRowCache are kept for each uncompressed
+    partition, so repeated queries only pay for data appended since the
+    last one.
+    """
+    def __init__(self, data_file, directory=None):
+        """
+        Args:
+            data_file: Configured data file, e.g. river_data.csv; partitions
+                are named after it and a legacy file of this name is included
+            directory: Partition directory (default: that of data_file)
+        """
+        self.data_file = data_file
+        self.directory = directory or os.path.dirname(data_file) or '.'
+        self.stem, self.ext = os.path.splitext(os.path.basename(data_file))
+        self.binary = self.ext == '.bin'
+        self.pattern = re.compile(
+            re.escape(self.stem) + r'-(\d{4}-\d{2}(?:-\d{2})?)' + re.escape(self.ext)
+            + r'(' + '|'.join(re.escape(s) for s in COMPRESSIONS.values()) + r')?$')
+        self.lock = threading.Lock()
+        self.key = None
+        self.listing = []
+        self.indexes = {}
+        self.latest_caches = {}
+        self.compressed_latest = (None, None)
+
+    def partitions(self):
+        """
+        All partitions in time order, the legacy data file (if any) first.
+
+        Returns:
+            list: Partition objects
+        """
+        try:
+            st = os.stat(self.directory)
+            key = (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            key = None
+        with self.lock:
+            if key != self.key or key is None:
+                self.listing = self._scan()
+                self.key = key
+                paths = {p.path for p in self.listing}
+                self.indexes = {path: index for path, index in self.indexes.items() if path in paths}
+                self.latest_caches = {path: cache for path, cache in self.latest_caches.items()
+                                      if path in paths}
+            listing = list(self.listing)
+        if os.path.isfile(self.data_file):
+            listing.insert(0, Partition(self.data_file))
+        return listing
+
+    def _scan(self):
+        by_label = {}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            match = self.pattern.match(name)
+            if not match:
+                continue
+            label = match.group(1)
+            path = os.path.join(self.directory, name)
+            # While a partition is being compressed both files exist for a
+            # moment; the uncompressed one is complete, so prefer it
+            if label not in by_label or not match.group(2):
+                by_label[label] = path
+        return [Partition(path, label) for label, path in sorted(by_label.items())]
+
+    def covering(self, start=None, end=None):
+        """Partitions that may hold readings between start and end."""
+        return [p for p in self.partitions() if p.overlaps(start, end)]
+
+    def latest_path(self):
+        """Path of the partition being written (the newest), or the data file."""
+        partitions = self.partitions()
+        return partitions[-1].path if partitions else self.data_file
+
+    def index(self, path):
+        with self.lock:
+            index = self.indexes.get(path)
+            if index is None:
+                index = self.indexes[path] = SparseIndex(path)
+            return index
+
+    def read_range(self, start=None, end=None):
+        """
+        Read the numeric columns of all readings between start and end.
+
+        Returns:
+            dict: As datastore.read_range()
+        """
+        ranges = []
+        for partition in self.covering(start, end):
+            try:
+                if self.binary:
+                    ranges.append(read_binary_range(partition.path, start, end))
+                elif partition.compressed:
+                    with open_partition(partition.path) as f:
+                        ranges.append(read_range_lines(f, start, end))
+                else:
+                    ranges.append(read_range(self.index(partition.path), start, end))
+            except FileNotFoundError:
+                continue  # Compressed or removed since the listing
+        return concat_ranges(ranges)
+
+    def latest_row(self):
+        """
+        Last complete row of the newest partition, as CSV fields.
+
+        Returns:
+            list: Fields of the last row, or None if there is no data
+        """
+        for partition in reversed(self.partitions()):
+            if self.binary:
+                row = self._binary_last_row(partition.path)
+            elif partition.compressed:
+                row = self._compressed_last_row(partition.path)
+            else:
+                with self.lock:
+                    cache = self.latest_caches.get(partition.path)
+                    if cache is None:
+                        cache = self.latest_caches[partition.path] = LatestRowCache(partition.path)
+                row = cache.get()
+            if row is not None:
+                return row
+        return None
+
+    def _binary_last_row(self, path):
+        from binstore import open_records, check_header, record_to_row, RECORD_DTYPE
+        try:
+            if not partition_compressed(path):
+                records = open_records(path)
+                return record_to_row(records[-1]) if len(records) else None
+            cached_path, row = self.compressed_latest
+            if cached_path == path:
+                return row
+            with open_partition(path) as f:
+                check_header(f, path)
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        usable = len(data) - len(data) % RECORD_DTYPE.itemsize
+        row = record_to_row(np.frombuffer(data[usable - RECORD_DTYPE.itemsize:usable],
+                                          dtype=RECORD_DTYPE)[0]) if usable else None
+        self.compressed_latest = (path, row)
+        return row
+
+    def _compressed_last_row(self, path):
+        # Only reached once logging has stopped; cached as the file never changes
+        cached_path, row = self.compressed_latest
+        if cached_path == path:
+            return row
+        last = None
+        with open_partition(path) as f:
+            f.readline()  # Header
+            for line in f:
+                if line.endswith(b'\n'):
+                    last = line
+        row = parse_row(last.rstrip(b'\r\n')) if last else None
+        self.compressed_latest = (path, row)
+        return row
+
+
+class PartitionedWriter:
+    """
+    DataWriter that starts a new file for each partition period.
+
+    Readings go to the partition of their timestamp. When a reading belongs
+    to a later partition the current file is closed and queued for
+    background compression. With partitioning None everything goes to the
+    data file itself.
+    """
+    def __init__(self, data_file, encode, recover, partitioning=None, directory=None,
+                 compression=None, **writer_kwargs):
+        """
+        Args:
+            data_file: Configured data file, e.g. river_data.csv
+            encode, recover: As for DataWriter
+            partitioning: None, 'daily' or 'monthly'
+            directory: Partition directory (default: that of data_file)
+            compression: None, 'gzip' or 'zstd' for closed partitions
+            writer_kwargs: batch_size, flush_interval, durability for DataWriter
+        """
+        if partitioning is not None and partitioning not in PARTITIONINGS:
+            raise ValueError(f"Unknown partitioning '{partitioning}', "
+                             f"expected one of {sorted(PARTITIONINGS)}")
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}', "
+                             f"expected one of {sorted(COMPRESSIONS)}")
+        if compression == 'zstd':
+            zstd_module()  # Fail now rather than at the first rotation
+        self.data_file = data_file
+        self.encode = encode
+        self.recover = recover
+        self.partitioning = partitioning
+        self.directory = directory or os.path.dirname(data_file) or '.'
+        self.stem, self.ext = os.path.splitext(os.path.basename(data_file))
+        self.compression = compression
+        self.writer_kwargs = writer_kwargs
+        self.lock = threading.Lock()
+        self.writer = None
+        self.label = None
+        self.path = None
+        self.closed_items = 0
+        self.closed_batches = 0
+        self.closed_errors = 0
+        self.closed_dropped = 0
+        self.compress_queue = queue.Queue()
+        self.compress_thread = None
+        if partitioning is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, when):
+        """
+        Data file path for a reading taken at epoch seconds when.
+
+        Returns:
+            tuple: (partition label or None, path)
+        """
+        if self.partitioning is None:
+            return None, self.data_file
+        label = partition_label(when, self.partitioning)
+        # Never go back to a closed (possibly compressed) partition, e.g.
+        # after the clock is set back
+        if self.label is not None and label < self.label:
+            return self.label, self.path
+        return label, os.path.join(self.directory, f"{self.stem}-{label}{self.ext}")
+
+    def write(self, item, when):
+        """Queue an item for the partition of epoch seconds when."""
+        with self.lock:
+            label, path = self.path_for(when)
+            if path != self.path:
+                self._rotate(label, path)
+            self.writer.write(item)
+
+    def _rotate(self, label, path):
+        previous = self.path
+        closed = True
+        if self.writer is not None:
+            closed = self.writer.close()
+            self.closed_items += self.writer.items_written
+            self.closed_batches += self.writer.batches_written
+            self.closed_errors += self.writer.errors
+            self.closed_dropped += self.writer.dropped
+            if closed:
+                logger.info(f"Closed partition {previous}")
+            else:
+                # Compressing it now would lose the rows still being written
+                logger.warning(f"Partition {previous} is still being written; leaving it "
+                               f"uncompressed until the next start")
+        self.writer = DataWriter(path, self.encode, self.recover, **self.writer_kwargs)
+        self.label, self.path = label, path
+        if self.partitioning is None or not self.compression:
+            return
+        if previous is None:
+            # Partitions left uncompressed by an earlier run
+            for partition in PartitionSet(self.data_file, self.directory).partitions():
+                if partition.label and not partition.compressed and partition.path != path:
+                    self._compress_later(partition.path)
+        elif closed:
+            self._compress_later(previous)
+
+    def _compress_later(self, path):
+        self.compress_queue.put(path)
+        if self.compress_thread is None:
+            self.compress_thread = threading.Thread(target=self._compress_loop,
+                                                    name="partition-compressor", daemon=True)
+            self.compress_thread.start()
+
+    def _compress_loop(self):
+        while True:
+            path = self.compress_queue.get()
+            try:
+                target = compress_file(path, self.compression)
+                logger.info(f"Compressed partition {path} -> {target}")
+            except Exception as e:
+                logger.error(f"Error compressing partition {path}: {e}")
+
+    @property
+    def items_written(self):
+        return self.closed_items + (self.writer.items_written if self.writer else 0)
+
+    @property
+    def batches_written(self):
+        return self.closed_batches + (self.writer.batches_written if self.writer else 0)
+
+    @property
+    def errors(self):
+        return self.closed_errors + (self.writer.errors if self.writer else 0)
+
+    @property
+    def dropped(self):
+        return self.closed_dropped + (self.writer.dropped if self.writer else 0)
+
+    @property
+    def queue_depth(self):
+        return self.writer.queue_depth if self.writer else 0
+
+    def flush(self, timeout=None):
+        """Write all queued items of the current partition now."""
+        with self.lock:
+            writer = self.writer
+        return writer.flush(timeout) if writer else True
+
+    def close(self, timeout=5.0):
+        """
+        Write all queued items and close the current partition.
+
+        Returns:
+            bool: True if the writer finished within timeout
+        """
+        with self.lock:
+            return self.writer.close(timeout) if self.writer is not None else True
+
+
+def main():
+    """Compress closed partitions of a data file."""
+    parser = argparse.ArgumentParser(description="PiAquaPulse data file partitions")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help="List partitions")
+    list_parser.add_argument('data_file')
+    list_parser.add_argument('--partition-dir', help="Partition directory")
+    compress_parser = subparsers.add_parser('compress', help="Compress all but the newest partition")
+    compress_parser.add_argument('data_file')
+    compress_parser.add_argument('--partition-dir', help="Partition directory")
+    compress_parser.add_argument('--compression', choices=sorted(COMPRESSIONS), default='gzip')
+    args = parser.parse_args()
+
+    partitions = [p for p in PartitionSet(args.data_file, args.partition_dir).partitions() if p.label]
+    if args.command == 'list':
+        for partition in partitions:
+            print(f"{partition.label}  {os.path.getsize(partition.path):>12}  {partition.path}")
+    else:
+        for partition in partitions[:-1]:
+            if not partition.compressed:
+                print(f"{partition.path} -> {compress_file(partition.path, args.compression)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Hourly and daily rollups
+
+Running statistics of each sensor per hour and per day (local time), kept in
+a JSON sidecar next to the data file (river_data.rollups.json for
+river_data.csv). For every bucket and sensor the rollup holds the count,
+min, max, mean and Welford M2 (sum of squared deviations, from which the
+variance follows) and the first and last timestamp with a valid value.
+
+Buckets whose hour or day has passed are appended to an archive next to
+the sidecar (river_data.rollups.closed.jsonl, one bucket per line, the
+latest line of a bucket winning), so the sidecar that is rewritten on every
+save only holds the buckets still open and stays small.
+
+PAPScript.py updates the rollups as each reading is stored, so a daily mean
+pH or an hourly maximum turbidity never needs a rescan of the raw data, and
+dashapp.py serves them at /summary. The rollups can be recomputed from the
+raw data in one vectorized pass:
+
+    python3 rollups.py rebuild river_data.csv
+    python3 rollups.py show river_data.csv --resolution daily
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import os
+import math
+import json
+import time
+import logging
+import argparse
+import datetime
+import threading
+import numpy as np
+
+from datastore import NUMERIC_COLUMNS, write_json_atomic
+from partitions import PartitionSet
+
+logger = logging.getLogger(__name__)
+
+VERSION = 2
+
+# Bucket width in local seconds for each resolution
+RESOLUTIONS = {
+    'hourly': 3600,
+    'daily': 86400,
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def rollup_path(data_path):
+    """Sidecar rollup file for a data file."""
+    return os.path.splitext(data_path)[0] + '.rollups.json'
+
+
+def archive_path(path):
+    """Archive of closed buckets for a sidecar rollup file."""
+    return os.path.splitext(path)[0] + '.closed.jsonl'
+
+
+def bucket_key(local_start, resolution):
+    """Key of the bucket starting at local_start (local seconds since 1970)."""
+    start = EPOCH + datetime.timedelta(seconds=int(local_start))
+    return start.strftime("%Y-%m-%d" if resolution == 'daily' else "%Y-%m-%d %H:00")
+
+
+def local_seconds(times):
+    """
+    Convert epoch seconds to local wall-clock seconds since 1970.
+
+    The local UTC offset is looked up once per distinct hour.
+
+    Args:
+        times: numpy array of epoch seconds
+
+    Returns:
+        numpy.ndarray: Local seconds (float64)
+    """
+    hours, inverse = np.unique(np.floor(times / 3600).astype(np.int64), return_inverse=True)
+    offsets = np.array([
+        (datetime.datetime.fromtimestamp(int(hour) * 3600) - EPOCH).total_seconds() - int(hour) * 3600
+        for hour in hours
+    ])
+    return times + offsets[inverse.reshape(-1)]
+
+
+def new_stats(time_, value):
+    """Statistics of a bucket holding a single value."""
+    return {'count': 1, 'mean': value, 'm2': 0.0, 'min': value, 'max': value,
+            'first': time_, 'last': time_}
+
+
+def add_value(stats, time_, value):
+    """Add one value to a bucket's statistics (Welford's update)."""
+    stats['count'] += 1
+    delta = value - stats['mean']
+    stats['mean'] += delta / stats['count']
+    stats['m2'] += delta * (value - stats['mean'])
+    stats['min'] = min(stats['min'], value)
+    stats['max'] = max(stats['max'], value)
+    stats['first'] = min(stats['first'], time_)
+    stats['last'] = max(stats['last'], time_)
+
+
+def merge_stats(a, b):
+    """Combine the statistics of two disjoint sets of values (Chan et al.)."""
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    return {
+        'count': count,
+        'mean': a['mean'] + delta * b['count'] / count,
+        'm2': a['m2'] + b['m2'] + delta * delta * a['count'] * b['count'] / count,
+        'min': min(a['min'], b['min']),
+        'max': max(a['max'], b['max']),
+        'first': min(a['first'], b['first']),
+        'last': max(a['last'], b['last']),
+    }
+
+
+def describe(stats):
+    """Bucket statistics as served to users, with variance and standard deviation."""
+    variance = stats['m2'] / (stats['count'] - 1) if stats['count'] > 1 else 0.0
+    return {
+        'count': stats['count'],
+        'mean': stats['mean'],
+        'min': stats['min'],
+        'max': stats['max'],
+        'variance': variance,
+        'std': math.sqrt(variance),
+        'first': stats['first'],
+        'last': stats['last'],
+    }
+
+
+def aggregate(data, resolution):
+    """
+    Compute the rollup buckets of a block of readings in one vectorized pass.
+
+    Args:
+        data: Dict with 'time' and NUMERIC_COLUMNS arrays, as from read_range()
+        resolution: One of RESOLUTIONS
+
+    Returns:
+        dict: Bucket key -> {'start': epoch seconds, column: statistics}
+    """
+    times = np.asarray(data['time'], dtype=np.float64)
+    buckets = {}
+    if not len(times):
+        return buckets
+    width = RESOLUTIONS[resolution]
+    local_starts = np.floor(local_seconds(times) / width) * width
+    for name in NUMERIC_COLUMNS:
+        values = np.asarray(data[name], dtype=np.float64)
+        valid = ~np.isnan(values)
+        if not valid.any():
+            continue
+        starts, inverse = np.unique(local_starts[valid], return_inverse=True)
+        inverse = inverse.reshape(-1)
+        t = times[valid]
+        v = values[valid]
+        counts = np.bincount(inverse)
+        means = np.bincount(inverse, weights=v) / counts
+        m2 = np.bincount(inverse, weights=(v - means[inverse]) ** 2)
+        # Group boundaries in bucket order for the reductions
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        mins = np.minimum.reduceat(v[order], bounds)
+        maxs = np.maximum.reduceat(v[order], bounds)
+        firsts = np.minimum.reduceat(t[order], bounds)
+        lasts = np.maximum.reduceat(t[order], bounds)
+        for i, start in enumerate(starts):
+            key = bucket_key(start, resolution)
+            bucket = buckets.setdefault(key, {'start': bucket_start(key, resolution)})
+            bucket[name] = {
+                'count': int(counts[i]),
+                'mean': float(means[i]),
+                'm2': float(m2[i]),
+                'min': float(mins[i]),
+                'max': float(maxs[i]),
+                'first': float(firsts[i]),
+                'last': float(lasts[i]),
+            }
+    return dict(sorted(buckets.items()))
+
+
+def bucket_start(key, resolution):
+    """Epoch seconds at which a bucket starts."""
+    fmt = "%Y-%m-%d" if resolution == 'daily' else "%Y-%m-%d %H:00"
+    return datetime.datetime.strptime(key, fmt).timestamp()
+
+
+class RollupStore:
+    """
+    Hourly and daily rollups of one data file, updated one reading at a time.
+
+    Changes are kept in memory and written by save() or save_if_due():
+    changed buckets that have closed are appended to the archive and the
+    open ones rewrite the sidecar file. Every save has a generation number,
+    stored with both, so a bucket archived by a save that crashed before
+    rewriting the sidecar still wins over the sidecar's older copy. After a
+    crash, catch_up() folds in the readings that reached the data file after
+    the last save.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.archive = archive_path(path)
+        self.lock = threading.Lock()
+        self.buckets = {resolution: {} for resolution in RESOLUTIONS}
+        self.changed = {resolution: set() for resolution in RESOLUTIONS}  # Not archived yet
+        self.through = None  # Time of the latest reading included
+        self.generation = 0
+        self.dirty = False
+        self.last_save = time.monotonic()
+
+    def load(self):
+        """
+        Load the archive and the sidecar file if it exists.
+
+        Returns:
+            bool: True if rollups were loaded
+        """
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            logger.error(f"Ignoring unreadable rollup file {self.path}: {e}")
+            return False
+        version = state.get('version')
+        if version not in (1, VERSION):
+            logger.warning(f"Ignoring rollup file {self.path} with version {version}")
+            return False
+        buckets = {resolution: {} for resolution in RESOLUTIONS}
+        generations = {resolution: {} for resolution in RESOLUTIONS}
+        if version == VERSION:
+            for generation, resolution, key, bucket in self._read_archive():
+                if generation >= generations[resolution].get(key, 0):
+                    buckets[resolution][key] = bucket
+                    generations[resolution][key] = generation
+        # Version 1 kept every bucket in the sidecar; the first save archives them
+        generation = state.get('generation', 0)
+        for resolution in RESOLUTIONS:
+            for key, bucket in state['buckets'].get(resolution, {}).items():
+                if generation >= generations[resolution].get(key, 0):
+                    buckets[resolution][key] = bucket
+        with self.lock:
+            self.buckets = buckets
+            self.changed = {resolution: set(state['buckets'].get(resolution, {}))
+                            for resolution in RESOLUTIONS}
+            self.through = state.get('through')
+            self.generation = max([generation] + [max(g.values(), default=0)
+                                                  for g in generations.values()])
+        return True
+
+    def _read_archive(self):
+        """(generation, resolution, key, bucket) of each complete archive line."""
+        try:
+            f = open(self.archive, 'r')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # Torn by a crash while appending
+                try:
+                    entry = json.loads(line)
+                    yield entry['generation'], entry['resolution'], entry['key'], entry['bucket']
+                except (ValueError, KeyError) as e:
+                    logger.warning(f"Skipping unreadable line in {self.archive}: {e}")
+
+    def update(self, time_, values):
+        """
+        Add one reading.
+
+        Args:
+            time_: Epoch seconds of the reading
+            values: Dict mapping NUMERIC_COLUMNS names to values (None if the
+                sensor failed)
+        """
+        local = (datetime.datetime.fromtimestamp(time_) - EPOCH).total_seconds()
+        with self.lock:
+            for resolution, width in RESOLUTIONS.items():
+                key = bucket_key(local // width * width, resolution)
+                bucket = self.buckets[resolution].get(key)
+                if bucket is None:
+                    bucket = self.buckets[resolution][key] = {
+                        'start': bucket_start(key, resolution)}
+                self.changed[resolution].add(key)
+                for name, value in values.items():
+                    if value is None or name not in NUMERIC_COLUMNS:
+                        continue
+                    if name in bucket:
+                        add_value(bucket[name], time_, float(value))
+                    else:
+                        bucket[name] = new_stats(time_, float(value))
+            self.through = time_ if self.through is None else max(self.through, time_)
+            self.dirty = True
+
+    def merge(self, data):
+        """Fold a block of readings (arrays as from read_range()) into the rollups."""
+        if not len(data['time']):
+            return
+        for resolution in RESOLUTIONS:
+            block = aggregate(data, resolution)
+            with self.lock:
+                buckets = self.buckets[resolution]
+                self.changed[resolution].update(block)
+                for key, bucket in block.items():
+                    existing = buckets.get(key)
+                    if existing is None:
+                        buckets[key] = bucket
+                        continue
+                    for name in NUMERIC_COLUMNS:
+                        if name in bucket:
+                            existing[name] = (merge_stats(existing[name], bucket[name])
+                                              if name in existing else bucket[name])
+        with self.lock:
+            latest = float(np.max(data['time']))
+            self.through = latest if self.through is None else max(self.through, latest)
+            self.dirty = True
+
+    def catch_up(self, source):
+        """
+        Fold in readings of the data file newer than the latest one included.
+
+        Args:
+            source: As for load_data()
+
+        Returns:
+            int: Number of readings added
+        """
+        data = load_data(source, start=self.through)
+        if self.through is not None:
+            newer = data['time'] > self.through
+            data = {name: values[newer] for name, values in data.items()}
+        self.merge(data)
+        if len(data['time']):
+            logger.info(f"Added {len(data['time'])} readings to the rollups {self.path}")
+        return len(data['time'])
+
+    def save(self, rewrite=False):
+        """
+        Append the changed buckets that have closed to the archive and write
+        the open ones to the sidecar file.
+
+        Args:
+            rewrite: Replace the archive with all closed buckets instead
+        """
+        with self.lock:
+            generation = self.generation + 1
+            closed_before = self.through if self.through is not None else -math.inf
+            lines = []
+            open_buckets = {resolution: {} for resolution in RESOLUTIONS}
+            for resolution, width in RESOLUTIONS.items():
+                keys = self.buckets[resolution] if rewrite else self.changed[resolution]
+                for key in sorted(keys):
+                    bucket = self.buckets[resolution][key]
+                    # Readings are only ever late by a little, so a bucket that
+                    # ended before the latest reading is done
+                    if bucket['start'] + width <= closed_before:
+                        lines.append(json.dumps({'generation': generation, 'resolution': resolution,
+                                                 'key': key, 'bucket': bucket}) + '\n')
+                    else:
+                        open_buckets[resolution][key] = bucket
+            if rewrite:
+                partial = self.archive + '.partial'
+                with open(partial, 'w') as f:
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(partial, self.archive)
+            elif lines:
+                with open(self.archive, 'ab+') as f:
+                    if f.seek(0, os.SEEK_END):
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':
+                            f.write(b'\n')  # End a line torn by a crash
+                    f.writelines(line.encode() for line in lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+            state = {
+                'version': VERSION,
+                'generation': generation,
+                'through': self.through,
+                'buckets': open_buckets,
+            }
+            write_json_atomic(state, self.path)
+            self.generation = generation
+            self.changed = {resolution: set(buckets) for resolution, buckets in open_buckets.items()}
+            self.dirty = False
+            self.last_save = time.monotonic()
+
+    def save_if_due(self, interval):
+        """Save if there are changes and the last save is older than interval seconds."""
+        if self.dirty and time.monotonic() - self.last_save >= interval:
+            try:
+                self.save()
+            except OSError as e:
+                logger.error(f"Error saving rollups to {self.path}: {e}")
+
+    def summary(self, resolution, start=None, end=None):
+        """
+        Buckets of one resolution overlapping a time range.
+
+        Args:
+            resolution: One of RESOLUTIONS
+            start, end: Epoch seconds, or None for no bound
+
+        Returns:
+            list: Dicts with the bucket key, start time and the statistics of
+            each sensor, in time order
+        """
+        result = []
+        with self.lock:
+            buckets = sorted(self.buckets[resolution].items())
+        for key, bucket in buckets:
+            if start is not None and bucket['start'] + RESOLUTIONS[resolution] <= start:
+                continue
+            if end is not None and bucket['start'] > end:
+                break
+            entry = {'bucket': key, 'start': bucket['start']}
+            for name in NUMERIC_COLUMNS:
+                if name in bucket:
+                    entry[name] = describe(bucket[name])
+            result.append(entry)
+        return result
+
+
+class RollupCache:
+    """Rollups of a sidecar file, reloaded only when the file changes."""
+    def __init__(self, path):
+        self.path = path
+        self.key = None
+        self.store = RollupStore(path)
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the current rollups.
+
+        Returns:
+            RollupStore: Empty if the sidecar file does not exist
+        """
+        try:
+            st = os.stat(self.path)
+            key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            key = None
+        try:
+            st = os.stat(self.store.archive)
+            key = key and key + (st.st_ino, st.st_size)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            if key != self.key:
+                self.store = RollupStore(self.path)
+                if key is not None:
+                    self.store.load()
+                self.key = key
+            return self.store
+
+
+def load_data(source, start=None):
+    """
+    Read the timestamps and sensor values of a data file and its partitions.
+
+    Args:
+        source: Data file path (river_data.csv or a binary store ending in
+            .bin) or a partitions.PartitionSet
+        start: Epoch seconds, or None to read everything
+
+    Returns:
+        dict: 'time' and NUMERIC_COLUMNS arrays, as from read_range()
+    """
+    if not isinstance(source, PartitionSet):
+        source = PartitionSet(source)
+    return source.read_range(start=start)
+
+
+def rebuild(data_path, path=None, partition_dir=None):
+    """
+    Recompute the rollups of a data file from its raw readings.
+
+    Args:
+        data_path: Data file path
+        path: Rollup file (default: next to the data file)
+        partition_dir: Partition directory, if not that of the data file
+
+    Returns:
+        RollupStore: The rebuilt rollups, already saved
+    """
+    store = RollupStore(path or rollup_path(data_path))
+    store.merge(load_data(PartitionSet(data_path, partition_dir)))
+    store.save(rewrite=True)
+    return store
+
+
+def main():
+    """Rebuild or print the rollups of a data file."""
+    parser = argparse.ArgumentParser(description="PiAquaPulse hourly and daily rollups")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rebuild_parser = subparsers.add_parser('rebuild', help="Recompute the rollups from the raw data")
+    rebuild_parser.add_argument('data_file')
+    rebuild_parser.add_argument('--partition-dir', help="Partition directory, if partitioned")
+    show_parser = subparsers.add_parser('show', help="Print the rollups")
+    show_parser.add_argument('data_file')
+    show_parser.add_argument('--resolution', choices=sorted(RESOLUTIONS), default='daily')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        start = time.perf_counter()
+        store = rebuild(args.data_file, partition_dir=args.partition_dir)
+        print(f"Rebuilt {len(store.buckets['hourly'])} hourly and {len(store.buckets['daily'])} "
+              f"daily buckets in {time.perf_counter() - start:.2f}s -> {store.path}")
+    else:
+        store = RollupStore(rollup_path(args.data_file))
+        if not store.load():
+            parser.error(f"No rollups for {args.data_file}; run the rebuild command first")
+        for entry in store.summary(args.resolution):
+            stats = ", ".join(f"{name} mean={entry[name]['mean']:.2f} min={entry[name]['min']:.2f} "
+                              f"max={entry[name]['max']:.2f} n={entry[name]['count']}"
+                              for name in NUMERIC_COLUMNS if name in entry)
+            print(f"{entry['bucket']}: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Spatial index of GPS-tagged readings
+
+In the data file a position is one quoted "lat,lon" text column (or NO
+FIX), which cannot be searched by area without parsing every row. So, as
+each reading with a GPS fix is stored, PAPScript.py also appends it to a
+positions sidecar next to the data file (river_data.positions.bin for
+river_data.csv) in the binary store format of binstore.py: time, sensor
+values and fixed-point latitude and longitude, in time order.
+
+dashapp.py memory-maps the sidecar and keeps a grid index over it: the
+positions are bucketed into cells of CELL_SIZE degrees, and each cell
+holds the sorted record numbers of its readings. The index is extended
+with the records appended since the last query, so a /spatial query reads
+only the cells that overlap its bounding box and, within them, only the
+readings of its time range. Queries matching more readings than a map can
+usefully draw are aggregated into a coarser grid.
+
+The sidecar can be rebuilt from the data file (or its partitions) at any
+time:
+
+    python3 spatial.py rebuild river_data.csv
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import os
+import math
+import time
+import logging
+import argparse
+import threading
+import numpy as np
+
+from datastore import NUMERIC_COLUMNS, format_timestamp, parse_timestamps, parse_numbers
+from binstore import (BinaryStore, RECORD_DTYPE, COORDINATE_SCALE, FLAG_MANUAL,
+                      FLAG_TEMP_ERROR, FLAG_PH_ERROR, FLAG_TURBIDITY_ERROR, FLAG_NO_FIX,
+                      check_header, open_records, encode_records, HEADER, MAGIC, VERSION)
+from partitions import PartitionSet, open_partition
+
+logger = logging.getLogger(__name__)
+
+# Numeric position columns of new CSV data files
+POSITION_COLUMNS = ('Latitude', 'Longitude')
+
+# Grid cell size of the index in degrees (0.001 is about 110 m north-south)
+CELL_SIZE = 0.001
+
+# Queries whose cells hold more than 1 / SCAN_FRACTION of the readings in
+# their time range filter the whole range instead of gathering the cells
+SCAN_FRACTION = 4
+
+# Error flag of each sensor value, as set by binstore.make_record()
+ERROR_FLAGS = {
+    'temperature': FLAG_TEMP_ERROR,
+    'ph': FLAG_PH_ERROR,
+    'turbidity': FLAG_TURBIDITY_ERROR,
+}
+
+
+def positions_path(data_path):
+    """Sidecar positions file for a data file."""
+    return os.path.splitext(data_path)[0] + '.positions.bin'
+
+
+def has_fix(records):
+    """Mask of the records that have a GPS position."""
+    return (records['flags'] & FLAG_NO_FIX) == 0
+
+
+def read_position_lines(lines, start=None):
+    """
+    Read the readings with a GPS fix from data file lines (bytes) in time order.
+
+    Args:
+        lines: Iterable of data file lines, e.g. an open partition
+        start: Epoch seconds; only readings after it are returned (None = all)
+
+    Returns:
+        numpy.ndarray: Records of binstore.RECORD_DTYPE
+    """
+    # Timestamps have whole seconds and sort as strings
+    start_key = format_timestamp(start).encode() if start is not None else None
+    timestamps, values, coordinates, manual = [], [], [], []
+    for line in lines:
+        if not line.endswith(b'\n'):
+            break
+        # Leading columns never contain commas; a position is quoted
+        fields = line.split(b',', 4)
+        if len(fields) < 5 or not fields[0][:1].isdigit() or not fields[4].startswith(b'"'):
+            continue  # Header, malformed row or no fix
+        if start_key is not None and fields[0] <= start_key:
+            continue
+        position, _, rest = fields[4][1:].partition(b'"')
+        latitude, _, longitude = position.partition(b',')
+        timestamps.append(fields[0])
+        values.append(fields[1:4])
+        coordinates.append((latitude, longitude))
+        manual.append(rest.lstrip(b',"').startswith(b'Manual'))
+    records = np.zeros(len(timestamps), dtype=RECORD_DTYPE)
+    if not timestamps:
+        return records
+    records['time'] = parse_timestamps(timestamps)
+    columns = list(zip(*values))
+    for name, column in NUMERIC_COLUMNS.items():
+        parsed = parse_numbers(columns[column - 1])
+        records[name] = parsed
+        records['flags'] |= np.where(np.isnan(parsed), ERROR_FLAGS[name], 0).astype(np.uint32)
+    latitudes, longitudes = zip(*coordinates)
+    records['latitude'] = np.round(parse_numbers(latitudes) * COORDINATE_SCALE)
+    records['longitude'] = np.round(parse_numbers(longitudes) * COORDINATE_SCALE)
+    records['flags'] |= np.where(manual, FLAG_MANUAL, 0).astype(np.uint32)
+    return records
+
+
+def read_positions(source, start=None):
+    """
+    Read the readings with a GPS fix from a data file and its partitions.
+
+    Args:
+        source: PartitionSet
+        start: Epoch seconds; only readings after it are returned (None = all)
+
+    Returns:
+        numpy.ndarray: Records of binstore.RECORD_DTYPE in time order
+    """
+    chunks = []
+    for partition in source.covering(start):
+        try:
+            with open_partition(partition.path) as f:
+                if source.binary:
+                    check_header(f, partition.path)
+                    data = f.read()
+                    usable = len(data) - len(data) % RECORD_DTYPE.itemsize
+                    records = np.frombuffer(data[:usable], dtype=RECORD_DTYPE)
+                    if start is not None:
+                        records = records[records['time'] > start]
+                    chunks.append(records[has_fix(records)])
+                else:
+                    chunks.append(read_position_lines(f, start))
+        except FileNotFoundError:
+            continue  # Compressed or removed since the listing
+    if not chunks:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(chunks)
+
+
+def last_time(path):
+    """Time of the last record of a positions file, or None if it has none."""
+    try:
+        records = open_records(path)
+    except (FileNotFoundError, ValueError):
+        return None
+    return float(records['time'][-1]) if len(records) else None
+
+
+def catch_up(path, source):
+    """
+    Append readings of the data file newer than the last one in the positions file.
+
+    Args:
+        path: Positions file
+        source: PartitionSet of the data file
+
+    Returns:
+        int: Number of readings added
+    """
+    records = read_positions(source, last_time(path))
+    if len(records):
+        BinaryStore(path).append(records)
+        logger.info(f"Added {len(records)} positions to {path}")
+    return len(records)
+
+
+def rebuild(data_path, path=None, partition_dir=None):
+    """
+    Recreate the positions file of a data file from its readings.
+
+    Returns:
+        int: Number of readings with a position
+    """
+    path = path or positions_path(data_path)
+    records = read_positions(PartitionSet(data_path, partition_dir))
+    partial = path + '.partial'
+    with open(partial, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize))
+        f.write(encode_records(records))
+    os.replace(partial, path)
+    return len(records)
+
+
+def cell_bounds(bbox, cell_size):
+    """Grid rows and columns covering a (min lon, min lat, max lon, max lat) box."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return (math.floor(min_lat / cell_size), math.floor(max_lat / cell_size),
+            math.floor(min_lon / cell_size), math.floor(max_lon / cell_size))
+
+
+class SpatialIndex:
+    """
+    Grid index over a positions file, extended as the file grows.
+
+    Cells are keyed by (row, column) of the grid; each holds arrays of the
+    record numbers of its readings, in increasing (and so time) order.
+    """
+    def __init__(self, path, cell_size=CELL_SIZE):
+        self.path = path
+        self.cell_size = cell_size
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self.cells = {}  # (row, column) -> list of record number arrays
+        self.in_order = True
+        self.file_key = None
+
+    def refresh(self):
+        """
+        Index records appended since the last refresh.
+
+        Returns:
+            bool: False if there is no positions file
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            with self.lock:
+                self._reset()
+            return False
+        with self.lock:
+            if self.file_key is not None and (st.st_ino, st.st_size) == self.file_key:
+                return True
+            if self.file_key is not None and st.st_ino != self.file_key[0]:
+                self._reset()  # Rebuilt
+            try:
+                records = open_records(self.path)
+            except ValueError as e:
+                logger.error(f"Cannot index {self.path}: {e}")
+                return False
+            indexed = len(self.records)
+            if len(records) < indexed:
+                self._reset()
+                indexed = 0
+            self._add(records, indexed)
+            self.records = records
+            self.file_key = (st.st_ino, st.st_size)
+            return True
+
+    def _add(self, records, first):
+        new = records[first:]
+        if not len(new):
+            return
+        times = new['time']
+        previous = records['time'][first - 1:first] if first else times[:0]
+        if np.any(np.diff(np.concatenate([previous, times])) < 0):
+            self.in_order = False
+        rows = np.floor(new['latitude'] / COORDINATE_SCALE / self.cell_size).astype(np.int64)
+        columns = np.floor(new['longitude'] / COORDINATE_SCALE / self.cell_size).astype(np.int64)
+        # Group the new record numbers by cell in one (stable) sort
+        order = np.lexsort((columns, rows))
+        rows, columns = rows[order], columns[order]
+        boundaries = np.flatnonzero((np.diff(rows) != 0) | (np.diff(columns) != 0)) + 1
+        starts = np.concatenate([[0], boundaries])
+        for begin, end in zip(starts, np.append(boundaries, len(order))):
+            chunks = self.cells.setdefault((int(rows[begin]), int(columns[begin])), [])
+            chunks.append(order[begin:end] + first)
+            if len(chunks) > 8:
+                chunks[:] = [np.concatenate(chunks)]
+
+    def query(self, bbox=None, start=None, end=None):
+        """
+        Find the readings inside a bounding box and time range.
+
+        Args:
+            bbox: (min lon, min lat, max lon, max lat) in degrees, or None for anywhere
+            start: Epoch seconds (inclusive), or None for no lower bound
+            end: Epoch seconds (inclusive), or None for no upper bound
+
+        Returns:
+            numpy.ndarray: Matching records of binstore.RECORD_DTYPE in file order
+        """
+        self.refresh()
+        with self.lock:
+            records = self.records
+            in_order = self.in_order
+            if in_order:
+                first = np.searchsorted(records['time'], start) if start is not None else 0
+                last = (np.searchsorted(records['time'], end, side='right')
+                        if end is not None else len(records))
+            else:
+                first, last = 0, len(records)
+            selected = self._cell_records(bbox, first, last) if bbox is not None else None
+        # Boxes holding most of the time range are cheaper to filter as a slice
+        matches = records[first:last] if selected is None else records[selected]
+        keep = np.ones(len(matches), dtype=bool)
+        if not in_order:
+            if start is not None:
+                keep &= matches['time'] >= start
+            if end is not None:
+                keep &= matches['time'] <= end
+        if bbox is not None:
+            # Cells on the edge of the box extend beyond it
+            min_lon, min_lat, max_lon, max_lat = (round(v * COORDINATE_SCALE) for v in bbox)
+            keep &= ((matches['latitude'] >= min_lat) & (matches['latitude'] <= max_lat)
+                     & (matches['longitude'] >= min_lon) & (matches['longitude'] <= max_lon))
+        return matches if keep.all() else matches[keep]
+
+    def _cell_records(self, bbox, first, last):
+        """Record numbers in the cells overlapping bbox, or None to scan first:last."""
+        min_row, max_row, min_column, max_column = cell_bounds(bbox, self.cell_size)
+        if (max_row - min_row + 1) * (max_column - min_column + 1) <= len(self.cells):
+            keys = [(row, column) for row in range(min_row, max_row + 1)
+                    for column in range(min_column, max_column + 1)]
+        else:
+            keys = [(row, column) for row, column in self.cells
+                    if min_row <= row <= max_row and min_column <= column <= max_column]
+        selected = []
+        total = 0
+        for key in keys:
+            chunks = self.cells.get(key)
+            if chunks is None:
+                continue
+            if len(chunks) > 1:
+                chunks[:] = [np.concatenate(chunks)]
+            numbers = chunks[0]
+            selected.append(numbers[np.searchsorted(numbers, first):np.searchsorted(numbers, last)])
+            total += len(selected[-1])
+        if total > (last - first) // SCAN_FRACTION:
+            return None
+        if not selected:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(selected))
+
+
+def aggregate(records, max_cells, bbox=None):
+    """
+    Summarize readings on a grid of at most max_cells square cells.
+
+    Args:
+        records: Records of binstore.RECORD_DTYPE with a position
+        max_cells: Upper limit on the number of grid cells
+        bbox: Area the grid covers (default: the extent of the readings)
+
+    Returns:
+        tuple: (cell size in degrees, list of dicts with each occupied cell's
+        bounds, reading count, mean position, time range and sensor means)
+    """
+    latitudes = records['latitude'] / COORDINATE_SCALE
+    longitudes = records['longitude'] / COORDINATE_SCALE
+    if bbox is None:
+        bbox = (longitudes.min(), latitudes.min(), longitudes.max(), latitudes.max())
+    min_lon, min_lat, max_lon, max_lat = bbox
+    side = max(int(math.sqrt(max_cells)), 1)
+    size = max(max_lon - min_lon, max_lat - min_lat) / side or CELL_SIZE
+    columns = max(math.ceil((max_lon - min_lon) / size), 1)
+    rows = np.clip(((latitudes - min_lat) / size).astype(np.int64), 0, side - 1)
+    cols = np.clip(((longitudes - min_lon) / size).astype(np.int64), 0, columns - 1)
+    # At most side * columns <= max_cells cells, so dense per-cell arrays are small
+    ids = rows * columns + cols
+    cell_count = side * columns
+    counts = np.bincount(ids, minlength=cell_count)
+    cells = np.flatnonzero(counts)
+
+    def mean(values):
+        valid = ~np.isnan(values)
+        totals = np.bincount(ids, weights=np.where(valid, values, 0.0), minlength=cell_count)
+        valid_counts = np.bincount(ids, weights=valid, minlength=cell_count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.round(totals[cells] / valid_counts[cells], 2).tolist()
+
+    means = {name: mean(records[name]) for name in NUMERIC_COLUMNS}
+    mean_lat = np.bincount(ids, weights=latitudes, minlength=cell_count)[cells] / counts[cells]
+    mean_lon = np.bincount(ids, weights=longitudes, minlength=cell_count)[cells] / counts[cells]
+    first = np.full(cell_count, np.inf)
+    last = np.full(cell_count, -np.inf)
+    np.minimum.at(first, ids, records['time'])
+    np.maximum.at(last, ids, records['time'])
+    row, column = np.divmod(cells, columns)
+    bounds = np.round(np.column_stack([min_lon + column * size, min_lat + row * size,
+                                       min_lon + (column + 1) * size, min_lat + (row + 1) * size]), 6)
+
+    result = []
+    for i, entry in enumerate(zip(bounds.tolist(), counts[cells].tolist(),
+                                  np.round(mean_lat, 6).tolist(), np.round(mean_lon, 6).tolist(),
+                                  first[cells].tolist(), last[cells].tolist())):
+        entry = dict(zip(('bounds', 'count', 'latitude', 'longitude', 'start', 'end'), entry))
+        for name, values in means.items():
+            entry[name] = None if values[i] != values[i] else values[i]  # NaN: no valid value
+        result.append(entry)
+    return size, result
+
+
+def main():
+    """Rebuild the positions file of a data file."""
+    parser = argparse.ArgumentParser(description="PiAquaPulse spatial index")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rebuild_parser = subparsers.add_parser('rebuild', help="Recreate the positions file from the data")
+    rebuild_parser.add_argument('data_file')
+    rebuild_parser.add_argument('--partition-dir', help="Partition directory, if partitioned")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = rebuild(args.data_file, partition_dir=args.partition_dir)
+    print(f"Indexed {count} readings with a position in {time.perf_counter() - start:.2f}s "
+          f"-> {positions_path(args.data_file)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+"""
+PiAquaPulse - Upload readings to a collection server
+
+Runs next to PAPScript.py and sends every row of the CSV data file (and its
+partitions) to UPLOAD_URL, in order, as gzip-compressed JSON batches:
+
+    POST /ingest
+    Content-Encoding: gzip
+    Idempotency-Key: <station>-<sha256 of the batch>
+
+    {"station": "river-pi-1", "columns": [...], "rows": [[...], ...]}
+
+Progress is kept in a cursor file (UPLOAD_CURSOR_FILE) that is synced to
+disk. Before a batch is sent its byte range is recorded in the cursor, and
+after a power loss or network outage that exact batch is sent again with
+the same idempotency key, so a server that remembers keys stores every
+reading exactly once.
+
+The connection is kept alive between batches. Failed uploads back off
+exponentially (with jitter, honouring Retry-After), and the batch size
+adapts to the link: it grows by UPLOAD_BATCH_STEP rows while batches
+upload within UPLOAD_TARGET_SECONDS and halves when they are slow or fail.
+
+    python3 uploader.py                          # Upload using PAPScript.py's CONFIG
+    python3 uploader.py --url http://127.0.0.1:8080/ingest
+    python3 uploader.py serve --port 8080        # Local stand-in server for testing
+
+Author: Aaron Jacobs
+Project: https://github.com/aaronjacobs-chelt/PiAquaPulse
+License: MIT License
+"""
+
+import csv
+import json
+import gzip
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import http.client
+import http.server
+import urllib.parse
+import email.utils
+
+from datastore import write_json_atomic
+from partitions import PartitionSet, open_partition
+
+logger = logging.getLogger(__name__)
+
+# Retry delays in seconds: BACKOFF_BASE * 2^failures, capped at BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+# Smallest adaptive batch size (rows)
+MIN_BATCH = 10
+
+
+def encode_batch(station, columns, rows):
+    """
+    Encode a batch request body.
+
+    Args:
+        station: Station ID
+        columns: Column names of the data file
+        rows: Rows of string fields
+
+    Returns:
+        bytes: Gzip-compressed JSON
+    """
+    body = json.dumps({'station': station, 'columns': columns, 'rows': list(rows)})
+    return gzip.compress(body.encode('utf-8'), compresslevel=6)
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header, given as seconds or an HTTP-date.
+
+    Returns:
+        float: Seconds (0 for a date in the past), or None if absent or invalid
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class Cursor:
+    """
+    Durable upload position: a partition label (None for the single data
+    file) and a byte offset into it, plus the batch being sent, if any.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.label = None
+        self.offset = 0
+        self.pending = None  # {'label', 'start', 'end', 'key'} of an unacknowledged batch
+        self.rows_uploaded = 0
+
+    def load(self):
+        """Load the cursor file if it exists. Returns True if it did."""
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.label = state.get('label')
+        self.offset = state.get('offset', 0)
+        self.pending = state.get('pending')
+        self.rows_uploaded = state.get('rows_uploaded', 0)
+        return True
+
+    def save(self):
+        """Write the cursor and sync it to disk."""
+        write_json_atomic({
+            'label': self.label,
+            'offset': self.offset,
+            'pending': self.pending,
+            'rows_uploaded': self.rows_uploaded,
+        }, self.path, fsync=True)
+
+
+class RowSource:
+    """
+    Reads complete rows of a data file and its partitions in order, from a
+    (label, offset) position.
+
+    The file being read is kept open between batches, so walking through a
+    compressed partition does not decompress it again for every batch.
+    """
+    def __init__(self, partition_set):
+        self.partition_set = partition_set
+        self.handle = None
+        self.handle_path = None
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+            self.handle_path = None
+
+    def _open(self, path, offset):
+        if self.handle_path != path or self.handle.tell() != offset:
+            # A partition may have been compressed since it was opened
+            self.close()
+            self.handle = open_partition(path)
+            self.handle_path = path
+            self.handle.seek(offset)
+        return self.handle
+
+    def _header(self, path):
+        with open_partition(path) as f:
+            header = f.readline()
+        return header, next(csv.reader([header.decode('utf-8')]), [])
+
+    def read(self, label, offset, max_rows):
+        """
+        Read up to max_rows complete rows, moving on to the next partition
+        once a closed one has been read completely.
+
+        Args:
+            label, offset: Position to read from
+            max_rows: Maximum number of rows
+
+        Returns:
+            tuple: (label, start, end, columns, lines), where lines are the
+            raw rows (bytes) between byte offsets start and end of the
+            partition; lines is empty when there is nothing new
+        """
+        partitions = self.partition_set.partitions()
+        # The legacy single data file (label None) comes before all partitions
+        position = label or ''
+        remaining = [p for p in partitions if (p.label or '') >= position]
+        for i, partition in enumerate(remaining):
+            if partition.label != label:
+                offset = 0  # The cursor's partition is finished or gone
+            header, columns = self._header(partition.path)
+            start = max(offset, len(header))
+            f = self._open(partition.path, start)
+            lines = []
+            end = start
+            while len(lines) < max_rows:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # End of the data, or a row still being written; a row
+                    # left partial by a crash in a closed partition is skipped
+                    self.close()
+                    break
+                lines.append(line)
+                end += len(line)
+            if lines or i + 1 == len(remaining):
+                return partition.label, start, end, columns, lines
+        return label, offset, offset, None, []
+
+    def read_exact(self, label, start, end):
+        """Read the rows between two byte offsets of a partition again."""
+        for partition in self.partition_set.partitions():
+            if partition.label == label:
+                with open_partition(partition.path) as f:
+                    header = f.readline()
+                    f.seek(start)
+                    data = f.read(end - start)
+                columns = next(csv.reader([header.decode('utf-8')]), [])
+                return columns, data.splitlines(keepends=True)
+        raise FileNotFoundError(f"Partition {label} of {self.partition_set.data_file} is gone")
+
+
+class BatchSizer:
+    """
+    Additive-increase, multiplicative-decrease batch size.
+
+    A batch that uploads within the target time grows the next one by step
+    rows; a slow or failed batch halves it.
+    """
+    def __init__(self, initial=100, step=100, minimum=MIN_BATCH, maximum=5000, target=5.0):
+        self.size = initial
+        self.step = step
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+
+    def success(self, rows, seconds):
+        if seconds > self.target:
+            self.decrease()
+        elif rows >= self.size:
+            # Only grow when the batch was full, i.e. there was a backlog
+            self.size = min(self.size + self.step, self.maximum)
+
+    def decrease(self):
+        self.size = max(self.size // 2, self.minimum)
+
+
+class UploadError(Exception):
+    """An upload that may succeed if retried later."""
+    def __init__(self, message, retry_after=None, too_large=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.too_large = too_large
+
+
+class Uploader:
+    """Sends the rows after the cursor to the collection server, in order."""
+    def __init__(self, url, station, partition_set, cursor, token=None,
+                 sizer=None, poll_interval=30.0, timeout=30.0):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Upload URL must be http or https: {url}")
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        self.station = station
+        self.source = RowSource(partition_set)
+        self.cursor = cursor
+        self.token = token
+        self.sizer = sizer or BatchSizer()
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.connection = None
+        self.failures = 0
+        self.stop_event = threading.Event()
+
+    def _connect(self):
+        if self.connection is None:
+            cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            self.connection = cls(self.netloc, timeout=self.timeout)
+        return self.connection
+
+    def _disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def batch_key(self, lines):
+        """Idempotency key: the same rows always get the same key."""
+        digest = hashlib.sha256()
+        for line in lines:
+            digest.update(line)
+        return f"{self.station}-{digest.hexdigest()[:32]}"
+
+    def encode(self, columns, lines):
+        """Gzip-compressed JSON body for a batch."""
+        return encode_batch(self.station, columns,
+                            csv.reader(line.decode('utf-8') for line in lines))
+
+    def post(self, key, body):
+        """
+        Send one batch over the kept-alive connection.
+
+        Raises:
+            UploadError: If the batch was not accepted
+        """
+        headers = {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+            'Idempotency-Key': key,
+        }
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        try:
+            connection = self._connect()
+            connection.request('POST', self.path, body=body, headers=headers)
+            response = connection.getresponse()
+            detail = response.read(500)  # Always drain, to reuse the connection
+        except (OSError, http.client.HTTPException) as e:
+            self._disconnect()
+            raise UploadError(f"Connection error: {e}")
+        if response.will_close:
+            self._disconnect()
+        if 200 <= response.status < 300 or response.status == 409:
+            return  # 409: the server already has this batch
+        message = f"HTTP {response.status}: {detail.decode('utf-8', 'replace').strip()}"
+        raise UploadError(message,
+                          retry_after=parse_retry_after(response.getheader('Retry-After')),
+                          too_large=response.status == 413)
+
+    def upload_once(self):
+        """
+        Upload the next batch, resending an unacknowledged one first.
+
+        Returns:
+            int: Rows uploaded (0 when there was nothing new)
+
+        Raises:
+            UploadError: If the batch was not accepted
+        """
+        cursor = self.cursor
+        if cursor.pending:
+            pending = cursor.pending
+            columns, lines = self.source.read_exact(pending['label'], pending['start'], pending['end'])
+            label, start, end = pending['label'], pending['start'], pending['end']
+        else:
+            label, start, end, columns, lines = self.source.read(
+                cursor.label, cursor.offset, self.sizer.size)
+            if not lines:
+                if (label, end) != (cursor.label, cursor.offset):
+                    cursor.label, cursor.offset = label, end  # Moved on to a new partition
+                    cursor.save()
+                return 0
+            cursor.pending = {'label': label, 'start': start, 'end': end,
+                              'key': self.batch_key(lines)}
+            cursor.save()
+
+        body = self.encode(columns, lines)
+        began = time.monotonic()
+        try:
+            self.post(cursor.pending['key'], body)
+        except UploadError as e:
+            if e.too_large and len(lines) > 1:
+                # Never accepted, so it can be split without breaking exactly-once
+                self.sizer.size = max(len(lines) // 2, 1)
+                cursor.pending = None
+                cursor.save()
+            raise
+        elapsed = time.monotonic() - began
+
+        cursor.label, cursor.offset = label, end
+        cursor.pending = None
+        cursor.rows_uploaded += len(lines)
+        cursor.save()
+        self.sizer.success(len(lines), elapsed)
+        logger.info(f"Uploaded {len(lines)} rows ({len(body)} bytes) in {elapsed:.2f}s, "
+                    f"next batch {self.sizer.size} rows")
+        return len(lines)
+
+    def backoff_delay(self, retry_after=None):
+        """Delay before the next attempt after self.failures failures in a row."""
+        delay = min(BACKOFF_BASE * 2 ** self.failures, BACKOFF_MAX)
+        delay = random.uniform(delay / 2, delay)  # Jitter, so stations do not retry in step
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def run(self):
+        """Upload until stop() is called."""
+        logger.info(f"Uploading {self.source.partition_set.data_file} to "
+                    f"{self.scheme}://{self.netloc}{self.path} as '{self.station}'")
+        while not self.stop_event.is_set():
+            try:
+                uploaded = self.upload_once()
+            except UploadError as e:
+                self.failures += 1
+                if not e.too_large:
+                    self.sizer.decrease()
+                delay = self.backoff_delay(e.retry_after)
+                logger.warning(f"Upload failed ({e}), retrying in {delay:.1f}s")
+                self.stop_event.wait(delay)
+                continue
+            except OSError as e:
+                logger.error(f"Error reading data for upload: {e}")
+                self.stop_event.wait(self.poll_interval)
+                continue
+            self.failures = 0
+            if not uploaded:
+                self.stop_event.wait(self.poll_interval)
+        self._disconnect()
+        self.source.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class StandInCollector(http.server.ThreadingHTTPServer):
+    """
+    Minimal collection server for testing uploads: remembers idempotency
+    keys, appends new rows to a CSV file and can fail a share of requests
+    to imitate a poor link.
+    """
+    def __init__(self, address, output, fail_rate=0.0, delay=0.0):
+        super().__init__(address, StandInHandler)
+        self.output = output
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.keys = set()
+        self.rows = 0
+        self.lock = threading.Lock()
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if server.delay:
+            time.sleep(server.delay)
+        if random.random() < server.fail_rate:
+            self.reply(503, "Simulated failure", {'Retry-After': '1'})
+            return
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            batch = json.loads(body)
+        except ValueError as e:
+            self.reply(400, f"Bad batch: {e}")
+            return
+        key = self.headers.get('Idempotency-Key')
+        with server.lock:
+            if key in server.keys:
+                self.reply(200, "Duplicate batch ignored")
+                return
+            with open(server.output, 'a', newline='') as f:
+                writer = csv.writer(f)
+                for row in batch['rows']:
+                    writer.writerow([batch['station']] + row)
+            server.keys.add(key)
+            server.rows += len(batch['rows'])
+        self.reply(200, f"Stored {len(batch['rows'])} rows")
+
+    def reply(self, status, message, headers=None):
+        data = (message + '\n').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main():
+    """Run the uploader, or the stand-in server."""
+    from PAPScript import CONFIG, configure_logging
+    parser = argparse.ArgumentParser(description="PiAquaPulse uploader")
+    parser.add_argument('--url', default=CONFIG['UPLOAD_URL'], help="Collection server ingest URL")
+    parser.add_argument('--station', default=CONFIG['STATION_ID'], help="Station ID sent with each batch")
+    parser.add_argument('--data-file', default=CONFIG['BINARY_DATA_FILE'] if CONFIG['STORAGE_BACKEND'] == 'binary'
+                        else CONFIG['DATA_FILE'], help="CSV data file")
+    parser.add_argument('--partition-dir', default=CONFIG['PARTITION_DIR'], help="Partition directory")
+    parser.add_argument('--cursor', default=CONFIG['UPLOAD_CURSOR_FILE'], help="Cursor file")
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help="Run a local stand-in collection server")
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--output', default='collected.csv', help="CSV file for received rows")
+    serve_parser.add_argument('--fail-rate', type=float, default=0.0,
+                              help="Share of requests to fail with 503")
+    serve_parser.add_argument('--delay', type=float, default=0.0, help="Seconds to delay each reply")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.command == 'serve':
+        server = StandInCollector(('', args.port), args.output, args.fail_rate, args.delay)
+        logger.info(f"Stand-in collector listening on port {args.port}, writing {args.output}")
+        server.serve_forever()
+        return
+
+    if not args.url:
+        parser.error("No upload URL: set UPLOAD_URL in PAPScript.py or pass --url")
+    if args.data_file.endswith('.bin'):
+        parser.error(f"{args.data_file} is a binary data file; the uploader only reads CSV data files "
+                     f"(convert it with binstore.py export, or log with the CSV storage backend)")
+    cursor = Cursor(args.cursor)
+    cursor.load()
+    uploader = Uploader(
+        args.url, args.station, PartitionSet(args.data_file, args.partition_dir), cursor,
+        token=CONFIG['UPLOAD_TOKEN'],
+        sizer=BatchSizer(initial=CONFIG['UPLOAD_INITIAL_BATCH'], step=CONFIG['UPLOAD_BATCH_STEP'],
+                         maximum=CONFIG['UPLOAD_MAX_BATCH'], target=CONFIG['UPLOAD_TARGET_SECONDS']),
+        poll_interval=CONFIG['UPLOAD_POLL_INTERVAL']
+    )
+    try:
+        uploader.run()
+    except KeyboardInterrupt:
+        uploader.stop()
+        logger.info("Uploader stopped")
+
+
+if __name__ == "__main__":
+    main()